@@ -1,9 +1,11 @@
 import os
 import time
+import threading
 import logging
 import telebot
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
 from faster_whisper import WhisperModel
+from storage import JobQueue
 
 BOT_TOKEN = os.environ.get("BOT_TOKEN", "7188814271:AAE6mUVUXnrMH9bQEdywNJLSrxfUfjZAh90")
 MAX_UPLOAD_MB = int(os.environ.get("MAX_UPLOAD_MB", "20"))
@@ -11,6 +13,14 @@ MAX_UPLOAD_SIZE = MAX_UPLOAD_MB * 1024 * 1024
 MAX_MESSAGE_CHUNK = 4095
 REQUIRED_CHANNEL = os.environ.get("REQUIRED_CHANNEL", "")
 DOWNLOADS_DIR = os.environ.get("DOWNLOADS_DIR", "./downloads")
+PENDING_TTL = int(os.environ.get("PENDING_TTL", "3600"))
+JOBS_DB = os.environ.get("JOBS_DB", os.path.join(DOWNLOADS_DIR, "whisper_jobs.sqlite3"))
+JOB_BATCH = int(os.environ.get("JOB_BATCH", "10"))
+JOB_RETENTION = int(os.environ.get("JOB_RETENTION", str(86400)))
+JOB_LEASE = int(os.environ.get("JOB_LEASE", str(2 * 3600)))
+VAD_ENABLED = os.environ.get("VAD_ENABLED", "1") == "1"
+VAD_MIN_SILENCE_MS = int(os.environ.get("VAD_MIN_SILENCE_MS", "1000"))
+VAD_PADDING_MS = int(os.environ.get("VAD_PADDING_MS", "250"))
 
 os.makedirs(DOWNLOADS_DIR, exist_ok=True)
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
@@ -38,8 +48,8 @@ LANGS = [
 
 user_mode = {}
 user_selected_lang = {}
-pending_files = {}
-user_transcriptions = {}
+
+job_queue = JobQueue(JOBS_DB, PENDING_TTL, JOB_RETENTION, JOB_LEASE, JOB_BATCH)
 
 bot = telebot.TeleBot(BOT_TOKEN, threaded=False)
 
@@ -72,12 +82,28 @@ def ensure_joined(message):
     bot.reply_to(message, "First join the channel", reply_markup=kb)
     return False
 
+def remove_job_file(job):
+    path = job.get("path")
+    if path and os.path.exists(path):
+        os.remove(path)
+
+def expire_jobs():
+    for job in job_queue.expire():
+        remove_job_file(job)
+
 def whisper_transcribe(path, language):
-    segments, _ = model.transcribe(path, language=language)
+    vad_parameters = {"min_silence_duration_ms": VAD_MIN_SILENCE_MS, "speech_pad_ms": VAD_PADDING_MS} if VAD_ENABLED else None
+    segments, info = model.transcribe(path, language=language, vad_filter=VAD_ENABLED, vad_parameters=vad_parameters)
     text = []
     for s in segments:
         text.append(s.text)
-    return "".join(text).strip()
+    if VAD_ENABLED and info.duration:
+        speech = getattr(info, "duration_after_vad", None) or info.duration
+        logging.info(f"Speech ratio {speech / info.duration:.2f} ({speech:.1f}s of {info.duration:.1f}s)")
+    text = "".join(text).strip()
+    if not text:
+        raise ValueError("No speech detected in this file")
+    return text
 
 def send_long_text(chat_id, text, reply_id, uid):
     mode = get_user_mode(uid)
@@ -132,20 +158,37 @@ def lang_cb(call):
     except:
         pass
     bot.answer_callback_query(call.id, f"Language set: {lbl}")
-    pending = pending_files.pop(chat_id, None)
-    if not pending:
-        return
-    path = pending["path"]
-    msg = pending["message"]
-    bot.send_chat_action(chat_id, "typing")
+    if job_queue.release(chat_id, code):
+        drain_chat_jobs(chat_id)
+
+def run_file_job(job):
+    chat_id = job["chat_id"]
+    error = None
     try:
-        text = whisper_transcribe(path, code)
-        sent = send_long_text(chat_id, text, msg.id, msg.from_user.id)
-        if sent:
-            user_transcriptions.setdefault(chat_id, {})[sent.message_id] = text
+        bot.send_chat_action(chat_id, "typing")
+    except:
+        pass
+    try:
+        text = whisper_transcribe(job["path"], job["lang"])
+        send_long_text(chat_id, text, job["message_id"], job["user_id"])
+    except Exception as e:
+        error = str(e) or e.__class__.__name__
+        bot.send_message(chat_id, f"Error: {e}", reply_to_message_id=job["message_id"])
     finally:
-        if os.path.exists(path):
-            os.remove(path)
+        remove_job_file(job)
+        job_queue.finish(job["id"], error)
+
+def resume_jobs(chat_ids):
+    for chat_id in chat_ids:
+        drain_chat_jobs(chat_id)
+
+def drain_chat_jobs(chat_id):
+    while True:
+        jobs = job_queue.claim(chat_id)
+        if not jobs:
+            return
+        for job in jobs:
+            run_file_job(job)
 
 @bot.message_handler(content_types=["voice","audio","video","document"])
 def media_handler(message):
@@ -155,28 +198,28 @@ def media_handler(message):
     if getattr(media, "file_size", 0) > MAX_UPLOAD_SIZE:
         bot.reply_to(message, "File too large")
         return
-    file_path = os.path.join(DOWNLOADS_DIR, f"{message.id}_{media.file_unique_id}")
+    file_path = os.path.join(DOWNLOADS_DIR, f"{message.chat.id}_{message.id}_{media.file_unique_id}")
     bot.send_chat_action(message.chat.id, "typing")
+    queued = False
     try:
+        expire_jobs()
         info = bot.get_file(media.file_id)
         data = bot.download_file(info.file_path)
         with open(file_path, "wb") as f:
             f.write(data)
         lang = user_selected_lang.get(message.chat.id)
+        job_queue.add(message.chat.id, {"path": file_path, "message_id": message.id, "user_id": message.from_user.id}, lang)
+        queued = True
         if not lang:
-            pending_files[message.chat.id] = {"path": file_path, "message": message}
             kb = build_lang_keyboard("file")
             bot.reply_to(message, "Select language:", reply_markup=kb)
             return
-        text = whisper_transcribe(file_path, lang)
-        sent = send_long_text(message.chat.id, text, message.id, message.from_user.id)
-        if sent:
-            user_transcriptions.setdefault(message.chat.id, {})[sent.message_id] = text
+        drain_chat_jobs(message.chat.id)
     except Exception as e:
         bot.reply_to(message, f"Error: {e}")
-    finally:
-        if os.path.exists(file_path):
+        if not queued and os.path.exists(file_path):
             os.remove(file_path)
 
 if __name__ == "__main__":
+    threading.Thread(target=resume_jobs, args=(job_queue.recover(),), daemon=True).start()
     bot.infinity_polling(timeout=60, long_polling_timeout=60)
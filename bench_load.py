@@ -0,0 +1,422 @@
+import os
+import re
+import sys
+import json
+import math
+import time
+import queue
+import random
+import socket
+import argparse
+import tempfile
+import importlib
+import threading
+import multiprocessing
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_TOKEN = "123456:bench"
+BLOCK = os.urandom(1024 * 1024)
+WORDS = "the quick brown fox jumps over a lazy dog while the bot keeps transcribing every voice note".split()
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def read_body(handler):
+    if "chunked" in (handler.headers.get("Transfer-Encoding") or "").lower():
+        parts = []
+        while True:
+            size = int(handler.rfile.readline().strip().split(b";")[0], 16)
+            if not size:
+                handler.rfile.readline()
+                return b"".join(parts)
+            parts.append(handler.rfile.read(size))
+            handler.rfile.readline()
+    return handler.rfile.read(int(handler.headers.get("Content-Length") or 0))
+
+def send_json(handler, status, body, headers=None):
+    raw = json.dumps(body).encode("utf-8")
+    handler.send_response(status)
+    handler.send_header("Content-Type", "application/json")
+    handler.send_header("Content-Length", str(len(raw)))
+    for k, v in (headers or {}).items():
+        handler.send_header(k, v)
+    handler.end_headers()
+    handler.wfile.write(raw)
+
+def fake_text(prefix, chars):
+    out = [prefix]
+    while sum(len(w) + 1 for w in out) < chars:
+        out.append(random.choice(WORDS))
+    return " ".join(out)
+
+def request_params(handler, body):
+    params = {k: v[0] for k, v in parse_qs(urlparse(handler.path).query).items()}
+    ctype = handler.headers.get("Content-Type") or ""
+    if "application/json" in ctype and body:
+        params.update(json.loads(body))
+    elif "x-www-form-urlencoded" in ctype and body:
+        params.update({k: v[0] for k, v in parse_qs(body.decode("utf-8")).items()})
+    elif "multipart/form-data" in ctype:
+        for m in re.finditer(rb'name="([^"]+)"(?:; filename="[^"]*")?\r\n(?:[^\r\n]+\r\n)*\r\n(.*?)\r\n--', body, re.S):
+            params[m.group(1).decode()] = m.group(2).decode("utf-8", "replace")
+    return params
+
+def reply_target(params):
+    if params.get("reply_to_message_id"):
+        return int(params["reply_to_message_id"])
+    rp = params.get("reply_parameters")
+    if isinstance(rp, str):
+        rp = json.loads(rp)
+    return int((rp or {}).get("message_id") or 0)
+
+def make_telegram_handler(cfg, events):
+    ids = {"next": 1000000}
+    lock = threading.Lock()
+    class TelegramHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        def log_message(self, *args):
+            pass
+        def do_GET(self):
+            self.handle_request(b"")
+        def do_POST(self):
+            self.handle_request(read_body(self))
+        def handle_request(self, body):
+            path = urlparse(self.path).path
+            if cfg.tg_latency:
+                time.sleep(random.expovariate(1.0 / cfg.tg_latency))
+            if path.startswith("/file/"):
+                size = int(os.path.basename(path).split("-")[0])
+                self.send_response(200)
+                self.send_header("Content-Length", str(size))
+                self.end_headers()
+                sent = 0
+                while sent < size:
+                    piece = BLOCK[:min(len(BLOCK), size - sent)]
+                    self.wfile.write(piece)
+                    sent += len(piece)
+                return
+            method = path.rsplit("/", 1)[-1]
+            params = request_params(self, body)
+            if method in ("sendMessage", "editMessageText", "sendDocument") and random.random() < cfg.tg_429:
+                send_json(self, 429, {"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1", "parameters": {"retry_after": 1}})
+                return
+            chat_id = int(params.get("chat_id") or 0)
+            if method in ("sendMessage", "sendDocument", "forwardMessage"):
+                with lock:
+                    ids["next"] += 1
+                    message_id = ids["next"]
+                text = params.get("text") or params.get("caption") or ""
+                kind = None
+                if method == "sendDocument":
+                    kind = "summary" if b"SUMMARY" in body else "transcript" if b"TRANSCRIPT" in body else None
+                elif "TRANSCRIPT" in text:
+                    kind = "transcript"
+                elif "SUMMARY" in text:
+                    kind = "summary"
+                elif "lang|" in str(params.get("reply_markup") or ""):
+                    kind = "lang_keyboard"
+                elif text.startswith("❌") or text.startswith("Error"):
+                    kind = "error"
+                if kind and method != "forwardMessage":
+                    events.put((chat_id, kind, message_id, reply_target(params), time.time()))
+                send_json(self, 200, {"ok": True, "result": {"message_id": message_id, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}, "from": {"id": 1, "is_bot": True, "first_name": "bot"}, "text": text[:100] or "document"}})
+            elif method == "editMessageReplyMarkup" and re.search(r"(summarize|translate)_menu\|", str(params.get("reply_markup") or "")):
+                events.put((chat_id, "actions", int(params.get("message_id") or 0), 0, time.time()))
+                send_json(self, 200, {"ok": True, "result": True})
+            elif method == "getFile":
+                file_id = params.get("file_id", "0-x")
+                send_json(self, 200, {"ok": True, "result": {"file_id": file_id, "file_unique_id": file_id, "file_size": int(file_id.split("-")[0]), "file_path": f"media/{file_id}"}})
+            elif method == "getChatMember":
+                send_json(self, 200, {"ok": True, "result": {"status": "member", "user": {"id": int(params.get("user_id") or 0), "is_bot": False, "first_name": "bench"}}})
+            else:
+                send_json(self, 200, {"ok": True, "result": True})
+    return TelegramHandler
+
+def make_gemini_handler(cfg):
+    class GeminiHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        def log_message(self, *args):
+            pass
+        def do_POST(self):
+            body = read_body(self)
+            media = b"inline_data" in body
+            streaming = ":streamGenerateContent" in self.path
+            median = cfg.gemini_media_latency if media else cfg.gemini_text_latency
+            latency = random.lognormvariate(math.log(max(median, 0.001)), cfg.gemini_sigma)
+            time.sleep(min(latency, cfg.gemini_first_token) if streaming else latency)
+            roll = random.random()
+            if roll < cfg.gemini_429:
+                send_json(self, 429, {"error": {"code": 429, "status": "RESOURCE_EXHAUSTED", "details": [
+                    {"@type": "type.googleapis.com/google.rpc.QuotaFailure", "violations": [{"quotaId": "GenerateRequestsPerMinutePerProjectPerModel"}]},
+                    {"@type": "type.googleapis.com/google.rpc.RetryInfo", "retryDelay": "1s"}]}})
+                return
+            if roll < cfg.gemini_429 + cfg.gemini_503:
+                send_json(self, 503, {"error": {"code": 503, "status": "UNAVAILABLE"}})
+                return
+            text = fake_text("TRANSCRIPT", cfg.transcript_chars) if media else fake_text("SUMMARY", 200)
+            usage = {"totalTokenCount": len(body) // 4 + len(text) // 4}
+            if streaming:
+                self.stream_sse(text, usage, max(0.0, latency - cfg.gemini_first_token))
+                return
+            send_json(self, 200, {"candidates": [{"content": {"parts": [{"text": text}]}}], "usageMetadata": usage})
+        def stream_sse(self, text, usage, remaining):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.close_connection = True
+            words = text.split(" ")
+            step = max(1, math.ceil(len(words) / max(1, cfg.stream_chunks)))
+            starts = range(0, len(words), step)
+            for n, i in enumerate(starts):
+                last = n == len(starts) - 1
+                event = {"candidates": [{"content": {"parts": [{"text": " ".join(words[i:i + step]) + ("" if last else " ")}]}}]}
+                if last:
+                    event["usageMetadata"] = usage
+                self.wfile.write(b"data: " + json.dumps(event).encode("utf-8") + b"\r\n\r\n")
+                self.wfile.flush()
+                if not last:
+                    time.sleep(remaining / len(starts))
+    return GeminiHandler
+
+def serve_fakes(cfg, tg_port, gemini_port, events):
+    servers = [ThreadingHTTPServer(("127.0.0.1", tg_port), make_telegram_handler(cfg, events)), ThreadingHTTPServer(("127.0.0.1", gemini_port), make_gemini_handler(cfg))]
+    for server in servers:
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    while True:
+        time.sleep(3600)
+
+def wait_for_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"fake server on port {port} did not start")
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * pct))]
+
+def bot_thread_count():
+    main_thread = threading.main_thread()
+    return sum(1 for t in threading.enumerate() if t is not main_thread and not t.name.startswith("bench-"))
+
+def read_rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    return 0.0
+
+class Driver:
+    def __init__(self, cfg, mod, events):
+        self.cfg = cfg
+        self.mod = mod
+        self.client = mod.flask_app.test_client()
+        self.lock = threading.Lock()
+        self.update_id = 0
+        self.updates = 0
+        self.rejected = 0
+        self.failed = 0
+        self.latencies = {"transcript": [], "actions": [], "summary": [], "lang_keyboard": []}
+        self.inboxes = {}
+        self.peak_rss = 0.0
+        self.peak_threads = 0
+        self.running = True
+        threading.Thread(target=self._route_events, args=(events,), name="bench-events", daemon=True).start()
+        threading.Thread(target=self._monitor, name="bench-monitor", daemon=True).start()
+    def _route_events(self, events):
+        while True:
+            chat_id, kind, message_id, reply_to, at = events.get()
+            with self.lock:
+                inbox = self.inboxes.get(chat_id)
+            if inbox is not None:
+                inbox.put((kind, message_id, reply_to, at))
+    def _monitor(self):
+        while self.running:
+            self.peak_rss = max(self.peak_rss, read_rss_mb())
+            self.peak_threads = max(self.peak_threads, bot_thread_count())
+            time.sleep(0.1)
+    def post(self, update):
+        with self.lock:
+            self.update_id += 1
+            update["update_id"] = self.update_id
+        raw = json.dumps(update)
+        while True:
+            resp = self.client.post(self.mod.WEBHOOK_PATH, data=raw, content_type="application/json")
+            if resp.status_code != 429:
+                break
+            with self.lock:
+                self.rejected += 1
+            time.sleep(float(resp.headers.get("Retry-After") or 1) / 10)
+        with self.lock:
+            self.updates += 1
+        return time.time()
+    def wait(self, inbox, kind, started):
+        deadline = started + self.cfg.timeout
+        while True:
+            try:
+                got, message_id, reply_to, at = inbox.get(timeout=max(0.01, deadline - time.time()))
+            except queue.Empty:
+                return None
+            if got == kind:
+                with self.lock:
+                    self.latencies[kind].append(at - started)
+                return message_id
+            if got == "error":
+                return None
+    def run_chat(self, i):
+        cfg = self.cfg
+        chat_id = 700000000 + i
+        user = {"id": chat_id, "is_bot": False, "first_name": "bench"}
+        chat = {"id": chat_id, "type": "private"}
+        inbox = queue.Queue()
+        with self.lock:
+            self.inboxes[chat_id] = inbox
+        if hasattr(self.mod, "user_gemini_keys"):
+            self.mod.user_gemini_keys[chat_id] = "bench-key"
+        pending = random.random() < cfg.pending_ratio
+        if not pending:
+            self.mod.user_selected_lang[chat_id] = "auto"
+        for n in range(cfg.messages_per_chat):
+            message_id = n * 10 + 1
+            video = random.random() < cfg.video_ratio
+            size = int(random.uniform(0.5, 1.5) * (cfg.video_kb if video else cfg.voice_kb) * 1024)
+            media = {"file_id": f"{size}-{chat_id}-{message_id}", "file_unique_id": f"u{chat_id}x{message_id}x{random.random()}", "duration": max(1, size // 4000), "file_size": size}
+            msg = {"message_id": message_id, "date": int(time.time()), "chat": chat, "from": user}
+            if video:
+                msg["video"] = dict(media, width=640, height=360, mime_type="video/mp4")
+            else:
+                msg["voice"] = dict(media, mime_type="audio/ogg")
+            started = self.post({"message": msg})
+            if pending and n == 0:
+                keyboard_id = self.wait(inbox, "lang_keyboard", started)
+                if keyboard_id is None:
+                    self._fail()
+                    return
+                started = self.post(self.callback(user, chat, keyboard_id, "lang|auto|Auto|file"))
+            transcript_id = self.wait(inbox, "transcript", started)
+            if transcript_id is None:
+                self._fail()
+                continue
+            if random.random() < cfg.summarize_ratio:
+                if cfg.stream:
+                    transcript_id = self.wait(inbox, "actions", started)
+                    if transcript_id is None:
+                        self._fail()
+                        continue
+                started = self.post(self.callback(user, chat, transcript_id, f"summopt|Short|{transcript_id}"))
+                if self.wait(inbox, "summary", started) is None:
+                    self._fail()
+    def callback(self, user, chat, message_id, data):
+        return {"callback_query": {"id": str(random.getrandbits(48)), "from": user, "chat_instance": "bench", "data": data, "message": {"message_id": message_id, "date": int(time.time()), "chat": chat, "from": {"id": 1, "is_bot": True, "first_name": "bot"}, "text": "bench"}}}
+    def _fail(self):
+        with self.lock:
+            self.failed += 1
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Replay synthetic Telegram updates against webhook() with local Telegram and Gemini stand-ins.")
+    p.add_argument("--module", default="main", help="bot module to load (main or doq)")
+    p.add_argument("--chats", type=int, default=100)
+    p.add_argument("--concurrency", type=int, default=50)
+    p.add_argument("--messages-per-chat", type=int, default=2)
+    p.add_argument("--video-ratio", type=float, default=0.2)
+    p.add_argument("--voice-kb", type=int, default=60)
+    p.add_argument("--video-kb", type=int, default=4096)
+    p.add_argument("--pending-ratio", type=float, default=0.3, help="share of chats that go through the language keyboard")
+    p.add_argument("--summarize-ratio", type=float, default=0.3)
+    p.add_argument("--transcript-chars", type=int, default=1500)
+    p.add_argument("--tg-latency", type=float, default=0.02, help="mean Telegram latency, seconds")
+    p.add_argument("--tg-429", type=float, default=0.0, help="share of sends answered with 429")
+    p.add_argument("--gemini-media-latency", type=float, default=2.0, help="median generateContent latency for media, seconds")
+    p.add_argument("--gemini-text-latency", type=float, default=0.8)
+    p.add_argument("--gemini-sigma", type=float, default=0.5, help="lognormal sigma of Gemini latency")
+    p.add_argument("--stream", action="store_true", help="run the bot with GEMINI_STREAMING=1 against the SSE stand-in")
+    p.add_argument("--gemini-first-token", type=float, default=0.4, help="seconds before the first SSE chunk")
+    p.add_argument("--stream-chunks", type=int, default=20, help="SSE chunks per streamed response")
+    p.add_argument("--stream-edit-interval", type=float, default=1.0)
+    p.add_argument("--gemini-429", type=float, default=0.0)
+    p.add_argument("--gemini-503", type=float, default=0.0)
+    p.add_argument("--keys", type=int, default=4, help="number of fake Gemini keys")
+    p.add_argument("--timeout", type=float, default=120)
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--json", help="write the report to this file")
+    return p.parse_args()
+
+def main():
+    cfg = parse_args()
+    random.seed(cfg.seed)
+    tg_port, gemini_port = free_port(), free_port()
+    events = multiprocessing.Queue()
+    fakes = multiprocessing.Process(target=serve_fakes, args=(cfg, tg_port, gemini_port, events), daemon=True)
+    fakes.start()
+    wait_for_port(tg_port)
+    wait_for_port(gemini_port)
+    workdir = tempfile.mkdtemp(prefix="bench_load_")
+    os.environ.update({
+        "BOT_TOKEN": BENCH_TOKEN,
+        "TELEGRAM_API_URL": f"http://127.0.0.1:{tg_port}",
+        "GEMINI_API_BASE": f"http://127.0.0.1:{gemini_port}",
+        "GEMINI_KEYS": ",".join(f"bench-key-{i}" for i in range(cfg.keys)),
+        "FLASH_LITE_KEYS": "",
+        "DOWNLOADS_DIR": workdir,
+        "REQUIRED_CHANNEL": "",
+        "NORMALIZE_AUDIO": "0",
+        "VAD_ENABLED": "0",
+        "GEMINI_STREAMING": "1" if cfg.stream else "0",
+        "STREAM_EDIT_INTERVAL": str(cfg.stream_edit_interval),
+        "MONGO_URI": "mongodb://127.0.0.1:1/bench"
+    })
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    mod = importlib.import_module(cfg.module)
+    driver = Driver(cfg, mod, events)
+    baseline_rss, baseline_threads = read_rss_mb(), bot_thread_count()
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=cfg.concurrency, thread_name_prefix="bench-driver") as pool:
+        list(pool.map(driver.run_chat, range(cfg.chats)))
+    elapsed = time.time() - started
+    driver.running = False
+    report = {
+        "module": cfg.module,
+        "chats": cfg.chats,
+        "concurrency": cfg.concurrency,
+        "updates": driver.updates,
+        "elapsed": round(elapsed, 3),
+        "updates_per_sec": round(driver.updates / elapsed, 2) if elapsed else 0.0,
+        "rejected_429": driver.rejected,
+        "failed": driver.failed,
+        "baseline_rss_mb": round(baseline_rss, 1),
+        "peak_rss_mb": round(driver.peak_rss, 1),
+        "rss_includes_driver": True,
+        "baseline_threads": baseline_threads,
+        "peak_threads": driver.peak_threads,
+        "threads_exclude_driver": True
+    }
+    for kind, samples in driver.latencies.items():
+        report[kind] = {"count": len(samples), "p50": round(percentile(samples, 0.5), 3), "p95": round(percentile(samples, 0.95), 3), "p99": round(percentile(samples, 0.99), 3)}
+    print(f"{cfg.module}: {driver.updates} updates in {elapsed:.2f}s -> {report['updates_per_sec']} updates/s ({driver.rejected} rejected with 429, {driver.failed} failed)")
+    for kind in driver.latencies:
+        r = report[kind]
+        print(f"{kind:>14}: n={r['count']:<5} p50 {r['p50']:.3f}s  p95 {r['p95']:.3f}s  p99 {r['p99']:.3f}s")
+    print(f"peak RSS {driver.peak_rss:.1f} MB (baseline {baseline_rss:.1f} MB, includes the in-process driver and Flask test client)")
+    print(f"peak bot threads {driver.peak_threads} (baseline {baseline_threads}, driver threads excluded; webhook handlers run on driver threads)")
+    if cfg.json:
+        with open(cfg.json, "w") as f:
+            json.dump(report, f, indent=2)
+    fakes.terminate()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+import os
+import sys
+import json
+import time
+import base64
+import hashlib
+import tempfile
+import tracemalloc
+
+os.environ.setdefault("BOT_TOKEN", "123456:bench")
+
+from main import InlineMediaBody, MediaSpool
+
+SIZE_MB = int(os.environ.get("BENCH_SIZE_MB", sys.argv[1] if len(sys.argv) > 1 else "20"))
+PROMPT = "Transcribe the audio accurately in its original language."
+MIME = "audio/ogg"
+
+def legacy_body(path):
+    with open(path, "rb") as f:
+        file_content = f.read()
+    b64_data = base64.b64encode(file_content).decode('utf-8')
+    payload = {"contents": [{"parts": [{"text": PROMPT}, {"inline_data": {"mime_type": MIME, "data": b64_data}}]}]}
+    body = json.dumps(payload).encode('utf-8')
+    return len(body), hashlib.sha256(body).hexdigest()
+
+def streaming_body(path):
+    digest = hashlib.sha256()
+    total = 0
+    spool = MediaSpool(open(path, "rb"), os.path.getsize(path))
+    try:
+        body = InlineMediaBody(PROMPT, MIME, spool)
+        for chunk in body:
+            total += len(chunk)
+            digest.update(chunk)
+        if total != len(body):
+            raise AssertionError(f"Content-Length mismatch: {len(body)} != {total}")
+    finally:
+        spool.release()
+    return total, digest.hexdigest()
+
+def measure(fn, path):
+    tracemalloc.start()
+    started = time.perf_counter()
+    size, digest = fn(path)
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return size, digest, peak, elapsed
+
+def main():
+    with tempfile.NamedTemporaryFile(delete=False) as f:
+        for _ in range(SIZE_MB):
+            f.write(os.urandom(1024 * 1024))
+        path = f.name
+    try:
+        results = {}
+        for name, fn in (("legacy", legacy_body), ("streaming", streaming_body)):
+            results[name] = measure(fn, path)
+            size, _, peak, elapsed = results[name]
+            print(f"{name:>10}: body {size / 1048576:.1f} MB, peak {peak / 1048576:.2f} MB, {elapsed:.2f}s")
+        if results["legacy"][1] != results["streaming"][1]:
+            raise AssertionError("Streaming body differs from legacy JSON payload")
+        print(f"file {SIZE_MB} MB, peak reduced {results['legacy'][2] / max(results['streaming'][2], 1):.0f}x")
+    finally:
+        os.remove(path)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+import os
+import sys
+import time
+
+os.environ.setdefault("BOT_TOKEN", "123456:bench")
+
+import main
+
+def b64_len(size):
+    return 4 * ((size + 2) // 3)
+
+def time_gemini(spool, mime_type):
+    prompt = main.build_transcribe_prompt(None)
+    def perform(key, model):
+        return main._generate_from_spool(key, model, prompt, mime_type, spool)
+    started = time.perf_counter()
+    main.execute_gemini_action(perform, kind="media")
+    return time.perf_counter() - started
+
+def main_bench(path, mime_type, with_gemini):
+    if not main.ffmpeg_available():
+        sys.exit(f"{main.FFMPEG_BINARY} not found")
+    original = main.MediaSpool(open(path, "rb"), os.path.getsize(path))
+    started = time.perf_counter()
+    normalized = main.normalize_audio(original)
+    transcode = time.perf_counter() - started
+    print(f"original:   {original.size / 1048576:8.2f} MB, inline {b64_len(original.size) / 1048576:8.2f} MB ({mime_type})")
+    if normalized is None:
+        print(f"normalized: skipped ({dict(main.normalize_stats)})")
+    else:
+        print(f"normalized: {normalized.size / 1048576:8.2f} MB, inline {b64_len(normalized.size) / 1048576:8.2f} MB (audio/ogg), transcode {transcode:.2f}s")
+        print(f"upload bytes reduced {original.size / max(normalized.size, 1):.1f}x")
+    if with_gemini:
+        before = time_gemini(original, mime_type)
+        print(f"gemini original:   {before:.2f}s")
+        if normalized is not None:
+            after = time_gemini(normalized, "audio/ogg")
+            print(f"gemini normalized: {after:.2f}s (+{transcode:.2f}s transcode), {before / max(after + transcode, 0.001):.1f}x faster end to end")
+    original.release()
+    if normalized is not None:
+        normalized.release()
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        sys.exit("usage: python bench_normalize.py <media file> [mime type] [--gemini]")
+    args = [a for a in sys.argv[1:] if a != "--gemini"]
+    main_bench(args[0], args[1] if len(args) > 1 else "video/mp4", "--gemini" in sys.argv)
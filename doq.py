@@ -6,9 +6,16 @@ import logging
 import time
 import base64
 import mimetypes
+import collections
+import tempfile
+from urllib.parse import urlparse
 from flask import Flask, request, abort
 import telebot
+from telebot import apihelper
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton, Update
+from storage import TranscriptStore
 import pymongo
 
 BOT_TOKEN = os.environ.get("BOT_TOKEN", "")
@@ -20,12 +27,27 @@ REQUEST_TIMEOUT = int(os.environ.get("REQUEST_TIMEOUT", "300"))
 MAX_UPLOAD_MB = int(os.environ.get("MAX_UPLOAD_MB", "20"))
 MAX_UPLOAD_SIZE = MAX_UPLOAD_MB * 1024 * 1024
 MAX_MESSAGE_CHUNK = 4095
+WORKER_POOL_SIZE = int(os.environ.get("WORKER_POOL_SIZE", "8"))
+FAST_LANE_WORKERS = int(os.environ.get("FAST_LANE_WORKERS", "2"))
+DISPATCH_QUEUE_SIZE = int(os.environ.get("DISPATCH_QUEUE_SIZE", "100"))
+FAST_LANE_QUEUE_SIZE = int(os.environ.get("FAST_LANE_QUEUE_SIZE", "500"))
+DISPATCH_RETRY_AFTER = int(os.environ.get("DISPATCH_RETRY_AFTER", "5"))
+STREAM_CHUNK_SIZE = int(os.environ.get("STREAM_CHUNK_SIZE", "49152"))
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", str(WORKER_POOL_SIZE + FAST_LANE_WORKERS + 4)))
+HTTP_RETRIES = int(os.environ.get("HTTP_RETRIES", "2"))
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "https://api.telegram.org").rstrip("/")
+GEMINI_API_BASE = os.environ.get("GEMINI_API_BASE", "https://generativelanguage.googleapis.com").rstrip("/")
 DOWNLOADS_DIR = os.environ.get("DOWNLOADS_DIR", "./downloads")
 GEMINI_KEY = os.environ.get("GEMINI_KEY", "")
 GEMINI_KEYS = os.environ.get("GEMINI_KEYS", GEMINI_KEY)
 GEMINI_MODEL = os.environ.get("GEMINI_MODEL", "gemini-2.5-flash")
 GEMINI_FALLBACK_MODEL = os.environ.get("GEMINI_FALLBACK_MODEL", "gemini-2.5-flash-lite")
 MAX_USAGE_COUNT = int(os.environ.get("MAX_USAGE_COUNT", "18"))
+TRANSCRIPT_STORE_MAX_MB = int(os.environ.get("TRANSCRIPT_STORE_MAX_MB", "64"))
+TRANSCRIPT_STORE_TTL = int(os.environ.get("TRANSCRIPT_STORE_TTL", str(2 * 86400)))
+TRANSCRIPT_STORE_SPILL = os.environ.get("TRANSCRIPT_STORE_SPILL", "")
+PENDING_TTL = int(os.environ.get("PENDING_TTL", "3600"))
+SERVE_MODE = os.environ.get("SERVE_MODE", "threads")
 
 DB_USER = os.environ.get("DB_USER", "")
 DB_PASSWORD = os.environ.get("DB_PASSWORD", "")
@@ -51,14 +73,59 @@ LANGS = [
 ]
 
 user_mode = {}
-user_transcriptions = {}
+user_transcriptions = TranscriptStore(TRANSCRIPT_STORE_MAX_MB * 1024 * 1024, TRANSCRIPT_STORE_TTL, TRANSCRIPT_STORE_SPILL)
 action_usage = {}
 user_selected_lang = {}
 pending_files = {}
 user_gemini_keys = {}
 user_model_usage = {}
 
-bot = telebot.TeleBot(BOT_TOKEN, threaded=True)
+class HttpMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hosts = {}
+    def record(self, resp, *args, **kwargs):
+        host = urlparse(resp.url).hostname or "unknown"
+        with self.lock:
+            h = self.hosts.setdefault(host, {"requests": 0, "errors": 0, "elapsed_total": 0.0})
+            h["requests"] += 1
+            if resp.status_code >= 400:
+                h["errors"] += 1
+            h["elapsed_total"] += resp.elapsed.total_seconds()
+    def stats(self, session):
+        with self.lock:
+            out = {}
+            for host, h in self.hosts.items():
+                out[host] = {
+                    "requests": h["requests"],
+                    "errors": h["errors"],
+                    "avg_ms": round(h["elapsed_total"] * 1000 / h["requests"], 1) if h["requests"] else 0.0,
+                    "connections_opened": 0
+                }
+        for adapter in session.adapters.values():
+            pools = adapter.poolmanager.pools
+            for pool_key in list(pools.keys()):
+                pool = pools.get(pool_key)
+                if pool is not None and pool.host in out:
+                    out[pool.host]["connections_opened"] += pool.num_connections
+        return out
+
+def build_http_session(pool_size=HTTP_POOL_SIZE, retries=HTTP_RETRIES):
+    session = requests.Session()
+    retry = Retry(total=retries, connect=retries, backoff_factor=0.5, status_forcelist=(500, 502, 503, 504), allowed_methods=frozenset(["GET", "HEAD"]), raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.hooks["response"].append(http_metrics.record)
+    return session
+
+http_metrics = HttpMetrics()
+http_session = build_http_session()
+apihelper.session = http_session
+apihelper.API_URL = TELEGRAM_API_URL + "/bot{0}/{1}"
+apihelper.FILE_URL = TELEGRAM_API_URL + "/file/bot{0}/{1}"
+
+bot = telebot.TeleBot(BOT_TOKEN, threaded=False)
 flask_app = Flask(__name__)
 
 client_mongo = None
@@ -167,10 +234,52 @@ def get_current_model(uid):
     persist_user_model_usage(uid_i)
     return GEMINI_MODEL
 
+class InlineMediaBody:
+    def __init__(self, prompt, mime_type, media_file, size, chunk_size=STREAM_CHUNK_SIZE):
+        self.prefix = ('{"contents": [{"parts": [{"text": ' + json.dumps(prompt) + '}, {"inline_data": {"mime_type": ' + json.dumps(mime_type) + ', "data": "').encode('utf-8')
+        self.suffix = b'"}}]}]}'
+        self.fd = media_file.fileno()
+        self.size = size
+        self.chunk_size = max(3, chunk_size - chunk_size % 3)
+    def __len__(self):
+        return len(self.prefix) + 4 * ((self.size + 2) // 3) + len(self.suffix)
+    def __iter__(self):
+        yield self.prefix
+        offset = 0
+        carry = b""
+        while offset < self.size:
+            chunk = os.pread(self.fd, self.chunk_size, offset)
+            if not chunk:
+                break
+            offset += len(chunk)
+            chunk = carry + chunk
+            cut = len(chunk) - len(chunk) % 3
+            carry = chunk[cut:]
+            yield base64.b64encode(chunk[:cut])
+        if carry:
+            yield base64.b64encode(carry)
+        yield self.suffix
+
+def download_to_tempfile(file_url):
+    media_file = tempfile.TemporaryFile(dir=DOWNLOADS_DIR)
+    try:
+        with http_session.get(file_url, stream=True, timeout=REQUEST_TIMEOUT) as resp:
+            resp.raise_for_status()
+            for chunk in resp.iter_content(STREAM_CHUNK_SIZE):
+                media_file.write(chunk)
+        media_file.flush()
+        return media_file, media_file.tell()
+    except:
+        media_file.close()
+        raise
+
 def gemini_api_call(endpoint, payload, key):
-    url = f"https://generativelanguage.googleapis.com/v1beta/{endpoint}?key={key}"
+    url = f"{GEMINI_API_BASE}/v1beta/{endpoint}?key={key}"
     headers = {"Content-Type": "application/json"}
-    resp = requests.post(url, headers=headers, json=payload, timeout=REQUEST_TIMEOUT)
+    if isinstance(payload, InlineMediaBody):
+        resp = http_session.post(url, headers=headers, data=payload, timeout=REQUEST_TIMEOUT)
+    else:
+        resp = http_session.post(url, headers=headers, json=payload, timeout=REQUEST_TIMEOUT)
     resp.raise_for_status()
     return resp.json()
 
@@ -190,8 +299,6 @@ def transcribe_media_gemini(file_url, mime_type, language_code, uid):
     key = get_user_key_db(uid)
     if not key:
         raise RuntimeError("GEMINI_KEY not configured for user")
-    file_content = requests.get(file_url, timeout=REQUEST_TIMEOUT).content
-    b64_data = base64.b64encode(file_content).decode('utf-8')
     prompt = f"""
 Transcribe the audio accurately in its original language.
 
@@ -208,25 +315,23 @@ Formatting rules:
 Return ONLY the final formatted transcription.
 """
     current_model = get_current_model(uid)
-    payload = {
-        "contents": [{
-            "parts": [
-                {"text": prompt},
-                {
-                    "inline_data": {
-                        "mime_type": mime_type,
-                        "data": b64_data
-                    }
-                }
-            ]
-        }]
-    }
-    data = gemini_api_call(f"models/{current_model}:generateContent", payload, key)
+    media_file, media_size = download_to_tempfile(file_url)
+    try:
+        payload = InlineMediaBody(prompt, mime_type, media_file, media_size)
+        data = gemini_api_call(f"models/{current_model}:generateContent", payload, key)
+    finally:
+        media_file.close()
     try:
         return data["candidates"][0]["content"]["parts"][0]["text"]
     except Exception as e:
         raise RuntimeError(f"Gemini Transcription Error: {e}")
 
+def prune_pending_files():
+    cutoff = time.time() - PENDING_TTL
+    for chat_id, pending in list(pending_files.items()):
+        if pending.get("created", 0) < cutoff:
+            pending_files.pop(chat_id, None)
+
 def build_action_keyboard(text_len):
     btns = []
     if text_len > 1000:
@@ -334,15 +439,16 @@ def lang_cb(call):
         return
     file_url = pending.get("url")
     mime_type = pending.get("mime")
-    orig_msg = pending.get("message")
+    orig_msg_id = pending.get("message_id")
+    uid = pending.get("user_id")
     bot.send_chat_action(chat_id, 'typing')
     try:
-        text = transcribe_media_gemini(file_url, mime_type, code, orig_msg.from_user.id)
+        text = transcribe_media_gemini(file_url, mime_type, code, uid)
         if not text:
             raise ValueError("Empty transcription")
-        sent = send_long_text(chat_id, text, orig_msg.id, orig_msg.from_user.id)
+        sent = send_long_text(chat_id, text, orig_msg_id, uid)
         if sent:
-            user_transcriptions.setdefault(chat_id, {})[sent.message_id] = {"text": text, "origin": orig_msg.id}
+            user_transcriptions.put(chat_id, sent.message_id, text, orig_msg_id)
             if len(text) > 0:
                 try:
                     bot.edit_message_reply_markup(chat_id, sent.message_id, reply_markup=build_action_keyboard(len(text)))
@@ -387,10 +493,10 @@ def process_text_action(call, origin_msg_id, log_action, prompt_instr):
         origin_id = int(origin_msg_id)
     except:
         origin_id = call.message.message_id
-    data = user_transcriptions.get(chat_id, {}).get(origin_id)
+    data = user_transcriptions.get(chat_id, origin_id)
     if not data:
         if call.message.reply_to_message:
-             data = user_transcriptions.get(chat_id, {}).get(call.message.reply_to_message.message_id)
+             data = user_transcriptions.get(chat_id, call.message.reply_to_message.message_id)
     if not data:
         bot.answer_callback_query(call.id, "Data not found (expired). Resend file.", show_alert=True)
         return
@@ -422,10 +528,11 @@ def handle_media(message):
     bot.send_chat_action(message.chat.id, 'typing')
     try:
         file_info = bot.get_file(media.file_id)
-        telegram_file_url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file_info.file_path}"
+        telegram_file_url = f"{TELEGRAM_API_URL}/file/bot{BOT_TOKEN}/{file_info.file_path}"
         lang = user_selected_lang.get(message.chat.id)
         if not lang:
-            pending_files[message.chat.id] = {"url": telegram_file_url, "mime": mime_type, "message": message}
+            prune_pending_files()
+            pending_files[message.chat.id] = {"url": telegram_file_url, "mime": mime_type, "message_id": message.id, "user_id": message.from_user.id, "created": time.time()}
             kb = build_lang_keyboard("file")
             bot.reply_to(message, "Select the language spoken in your audio or video:", reply_markup=kb)
             return
@@ -434,7 +541,7 @@ def handle_media(message):
             raise ValueError("Empty response")
         sent = send_long_text(message.chat.id, text, message.id, message.from_user.id)
         if sent:
-            user_transcriptions.setdefault(message.chat.id, {})[sent.message_id] = {"text": text, "origin": message.id}
+            user_transcriptions.put(message.chat.id, sent.message_id, text, message.id)
             if len(text) > 0:
                 try:
                     bot.edit_message_reply_markup(message.chat.id, sent.message_id, reply_markup=build_action_keyboard(len(text)))
@@ -460,13 +567,117 @@ def send_long_text(chat_id, text, reply_id, uid, action="Transcript"):
             return sent
     return bot.send_message(chat_id, text, reply_to_message_id=reply_id)
 
+class UpdateDispatcher:
+    def __init__(self, name, workers, max_queue):
+        self.name = name
+        self.workers = max(1, workers)
+        self.max_queue = max_queue
+        self.cond = threading.Condition()
+        self.ready = collections.deque()
+        self.chats = {}
+        self.active = set()
+        self.depth = 0
+        self.busy = 0
+        self.processed = 0
+        self.rejected = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.recent_waits = collections.deque(maxlen=1000)
+        for i in range(self.workers):
+            threading.Thread(target=self._worker, name=f"{name}-{i}", daemon=True).start()
+    def submit(self, key, fn, *args):
+        with self.cond:
+            if self.depth >= self.max_queue:
+                self.rejected += 1
+                return False
+            q = self.chats.setdefault(key, collections.deque())
+            q.append((time.time(), fn, args))
+            self.depth += 1
+            if key not in self.active and len(q) == 1:
+                self.ready.append(key)
+                self.cond.notify()
+            return True
+    def _worker(self):
+        while True:
+            with self.cond:
+                while not self.ready:
+                    self.cond.wait()
+                key = self.ready.popleft()
+                q = self.chats[key]
+                enqueued_at, fn, args = q.popleft()
+                self.depth -= 1
+                self.active.add(key)
+                self.busy += 1
+                waited = time.time() - enqueued_at
+                self.wait_total += waited
+                self.wait_max = max(self.wait_max, waited)
+                self.recent_waits.append(waited)
+            try:
+                fn(*args)
+            except Exception as e:
+                logging.exception(f"{self.name} worker error: {e}")
+            finally:
+                with self.cond:
+                    self.active.discard(key)
+                    self.busy -= 1
+                    self.processed += 1
+                    if q:
+                        self.ready.append(key)
+                        self.cond.notify()
+                    else:
+                        self.chats.pop(key, None)
+    def stats(self):
+        with self.cond:
+            waits = sorted(self.recent_waits)
+            p95 = waits[int(len(waits) * 0.95) - 1] if waits else 0.0
+            return {
+                "workers": self.workers,
+                "busy": self.busy,
+                "queue_depth": self.depth,
+                "queue_max": self.max_queue,
+                "chats_queued": len(self.chats),
+                "processed": self.processed,
+                "rejected": self.rejected,
+                "wait_avg": round(self.wait_total / self.processed, 3) if self.processed else 0.0,
+                "wait_p95": round(p95, 3),
+                "wait_max": round(self.wait_max, 3)
+            }
+
+media_dispatcher = UpdateDispatcher("media", WORKER_POOL_SIZE, DISPATCH_QUEUE_SIZE)
+fast_dispatcher = UpdateDispatcher("fast", FAST_LANE_WORKERS, FAST_LANE_QUEUE_SIZE)
+
+def _route_update(upd):
+    msg = upd.get("message") or upd.get("edited_message") or upd.get("channel_post")
+    if msg:
+        chat_id = (msg.get("chat") or {}).get("id")
+        if any(k in msg for k in ("voice", "audio", "video", "document")):
+            return media_dispatcher, chat_id
+        return fast_dispatcher, chat_id
+    cq = upd.get("callback_query")
+    if cq:
+        chat_id = ((cq.get("message") or {}).get("chat") or {}).get("id") or (cq.get("from") or {}).get("id")
+        data = cq.get("data") or ""
+        if data.startswith("lang|") or data.startswith("summopt|"):
+            return media_dispatcher, chat_id
+        return fast_dispatcher, chat_id
+    return fast_dispatcher, upd.get("update_id")
+
 def _process_webhook_update(raw):
     try:
-        upd = Update.de_json(raw.decode('utf-8'))
+        upd = Update.de_json(raw)
         bot.process_new_updates([upd])
     except Exception as e:
         logging.exception(f"Error processing update: {e}")
 
+def dispatch_update(data):
+    try:
+        raw = json.loads(data.decode('utf-8'))
+    except Exception as e:
+        logging.warning(f"Invalid update payload: {e}")
+        return True
+    dispatcher, key = _route_update(raw)
+    return dispatcher.submit(key, _process_webhook_update, raw)
+
 @flask_app.route("/", methods=["GET"])
 def index():
     return "Bot Running", 200
@@ -475,11 +686,19 @@ def index():
 def webhook():
     if request.headers.get('content-type') == 'application/json':
         data = request.get_data()
-        threading.Thread(target=_process_webhook_update, args=(data,), daemon=True).start()
+        if not dispatch_update(data):
+            return '', 429, {"Retry-After": str(DISPATCH_RETRY_AFTER)}
         return '', 200
     abort(403)
 
+@flask_app.route("/stats", methods=["GET"])
+def stats():
+    body = {"fast": fast_dispatcher.stats(), "media": media_dispatcher.stats(), "http": http_metrics.stats(http_session), "transcripts": user_transcriptions.stats(), "pending_files": len(pending_files)}
+    return json.dumps(body), 200, {"Content-Type": "application/json"}
+
 if __name__ == "__main__":
+    if SERVE_MODE != "threads":
+        logging.warning(f"SERVE_MODE={SERVE_MODE} is not supported here: doq.py keeps per-user keys and usage in MongoDB through blocking pymongo calls on every update, so it always serves the threaded Flask webhook")
     if WEBHOOK_URL:
         bot.remove_webhook()
         time.sleep(0.5)
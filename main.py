@@ -6,10 +6,40 @@ import logging
 import time
 import base64
 import mimetypes
-import random
+import collections
+import tempfile
+import sqlite3
+import zlib
+import gzip
+import zipfile
+import io
+import math
+import hashlib
+import queue
+import heapq
+import asyncio
+import contextvars
+import contextlib
+import re
+import shutil
+import subprocess
+import atexit
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+from urllib.parse import urlparse
 from flask import Flask, request, abort
 import telebot
+from telebot import apihelper
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton, Update
+from storage import TranscriptStore, JobQueue
+try:
+    import aiohttp
+    from aiohttp import web
+except ImportError:
+    aiohttp = None
 
 BOT_TOKEN = os.environ.get("BOT_TOKEN", "")
 WEBHOOK_URL_BASE = os.environ.get("WEBHOOK_URL_BASE", "")
@@ -20,71 +50,473 @@ REQUEST_TIMEOUT = int(os.environ.get("REQUEST_TIMEOUT", "300"))
 MAX_UPLOAD_MB = int(os.environ.get("MAX_UPLOAD_MB", "20"))
 MAX_UPLOAD_SIZE = MAX_UPLOAD_MB * 1024 * 1024
 MAX_MESSAGE_CHUNK = 4095
+SEND_GLOBAL_RATE = float(os.environ.get("SEND_GLOBAL_RATE", "25"))
+SEND_CHAT_RATE = float(os.environ.get("SEND_CHAT_RATE", "1"))
+SEND_CHAT_BURST = float(os.environ.get("SEND_CHAT_BURST", "3"))
+SEND_GROUP_RATE = float(os.environ.get("SEND_GROUP_RATE", str(20 / 60.0)))
+SEND_RETRIES = int(os.environ.get("SEND_RETRIES", "5"))
+WORKER_POOL_SIZE = int(os.environ.get("WORKER_POOL_SIZE", "8"))
+FAST_LANE_WORKERS = int(os.environ.get("FAST_LANE_WORKERS", "2"))
+DISPATCH_QUEUE_SIZE = int(os.environ.get("DISPATCH_QUEUE_SIZE", "100"))
+FAST_LANE_QUEUE_SIZE = int(os.environ.get("FAST_LANE_QUEUE_SIZE", "500"))
+DISPATCH_RETRY_AFTER = int(os.environ.get("DISPATCH_RETRY_AFTER", "5"))
+SJF_ENABLED = os.environ.get("SJF_ENABLED", "1") == "1"
+SJF_COST_WEIGHT = float(os.environ.get("SJF_COST_WEIGHT", "2"))
+SJF_BASE_COST = float(os.environ.get("SJF_BASE_COST", "2"))
+SJF_INITIAL_RATE = float(os.environ.get("SJF_INITIAL_RATE", "0.15"))
+SJF_BYTES_PER_SECOND = float(os.environ.get("SJF_BYTES_PER_SECOND", "16000"))
+STREAM_CHUNK_SIZE = int(os.environ.get("STREAM_CHUNK_SIZE", "49152"))
+GEMINI_STREAMING = os.environ.get("GEMINI_STREAMING", "0") == "1"
+STREAM_EDIT_INTERVAL = float(os.environ.get("STREAM_EDIT_INTERVAL", "1"))
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", str(WORKER_POOL_SIZE + FAST_LANE_WORKERS + 4)))
+HTTP_RETRIES = int(os.environ.get("HTTP_RETRIES", "2"))
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "https://api.telegram.org").rstrip("/")
+GEMINI_API_BASE = os.environ.get("GEMINI_API_BASE", "https://generativelanguage.googleapis.com").rstrip("/")
+SERVE_MODE = os.environ.get("SERVE_MODE", "threads")
+ASYNC_MAX_INFLIGHT = int(os.environ.get("ASYNC_MAX_INFLIGHT", "5000"))
+ASYNC_HTTP_POOL_SIZE = int(os.environ.get("ASYNC_HTTP_POOL_SIZE", "200"))
+ASYNC_BODY_CHUNK_SIZE = int(os.environ.get("ASYNC_BODY_CHUNK_SIZE", str(1024 * 1024)))
 REQUIRED_CHANNEL = os.environ.get("REQUIRED_CHANNEL", "")
+MEMBERSHIP_TTL = int(os.environ.get("MEMBERSHIP_TTL", "900"))
+MEMBERSHIP_NEGATIVE_TTL = int(os.environ.get("MEMBERSHIP_NEGATIVE_TTL", "30"))
+MEMBERSHIP_REFRESH_AHEAD = int(os.environ.get("MEMBERSHIP_REFRESH_AHEAD", "120"))
+MEMBERSHIP_MAX_ITEMS = int(os.environ.get("MEMBERSHIP_MAX_ITEMS", "100000"))
 DOWNLOADS_DIR = os.environ.get("DOWNLOADS_DIR", "./downloads")
 GEMINI_KEYS = os.environ.get("GEMINI_KEYS", "")
 FLASH_LITE_KEYS = os.environ.get("FLASH_LITE_KEYS", "")
 GEMINI_MODEL_FLASH = os.environ.get("GEMINI_MODEL_FLASH", "gemini-2.5-flash")
 GEMINI_MODEL_FLASH_LITE = os.environ.get("GEMINI_MODEL_FLASH_LITE", "gemini-2.5-flash-lite")
 KEY_BACKOFF_SECONDS = int(os.environ.get("KEY_BACKOFF_SECONDS", "86400"))
+KEY_RPM = float(os.environ.get("KEY_RPM", "0"))
+KEY_TPM = float(os.environ.get("KEY_TPM", "0"))
+KEY_WAIT_SECONDS = float(os.environ.get("KEY_WAIT_SECONDS", "5"))
+KEY_STATE_DIR = os.environ.get("KEY_STATE_DIR", DOWNLOADS_DIR)
+HEDGE_ENABLED = os.environ.get("HEDGE_ENABLED", "0") == "1"
+HEDGE_DELAY = float(os.environ.get("HEDGE_DELAY", "20"))
+HEDGE_MIN_DELAY = float(os.environ.get("HEDGE_MIN_DELAY", "2"))
+HEDGE_BUDGET_RATIO = float(os.environ.get("HEDGE_BUDGET_RATIO", "0.1"))
+HEDGE_BUDGET_BURST = float(os.environ.get("HEDGE_BUDGET_BURST", "3"))
 ADMIN_ID = int(os.environ.get("ADMIN_ID", "6964068910"))
+TRANSCRIPT_STORE_MAX_MB = int(os.environ.get("TRANSCRIPT_STORE_MAX_MB", "64"))
+TRANSCRIPT_STORE_TTL = int(os.environ.get("TRANSCRIPT_STORE_TTL", str(2 * 86400)))
+TRANSCRIPT_STORE_SPILL = os.environ.get("TRANSCRIPT_STORE_SPILL", "")
+PENDING_TTL = int(os.environ.get("PENDING_TTL", "3600"))
+JOBS_DB = os.environ.get("JOBS_DB", os.path.join(DOWNLOADS_DIR, "jobs.sqlite3"))
+JOB_BATCH = int(os.environ.get("JOB_BATCH", "10"))
+JOB_RETENTION = int(os.environ.get("JOB_RETENTION", str(86400)))
+JOB_LEASE = int(os.environ.get("JOB_LEASE", str(2 * 3600)))
+UPDATE_DEDUPE_WINDOW = int(os.environ.get("UPDATE_DEDUPE_WINDOW", "20000"))
+UPDATE_DEDUPE_DB = os.environ.get("UPDATE_DEDUPE_DB", os.path.join(DOWNLOADS_DIR, "updates.sqlite3"))
+UPDATE_DEDUPE_FLUSH = float(os.environ.get("UPDATE_DEDUPE_FLUSH", "1"))
+PROGRESS_EDITS_PER_SEC = float(os.environ.get("PROGRESS_EDITS_PER_SEC", "8"))
+PROGRESS_CHAT_INTERVAL = float(os.environ.get("PROGRESS_CHAT_INTERVAL", "3"))
+TRANSCRIPT_CACHE_ITEMS = int(os.environ.get("TRANSCRIPT_CACHE_ITEMS", "500"))
+TRANSCRIPT_CACHE_TTL = int(os.environ.get("TRANSCRIPT_CACHE_TTL", str(7 * 86400)))
+TRANSCRIPT_CACHE_MAX_ROWS = int(os.environ.get("TRANSCRIPT_CACHE_MAX_ROWS", "20000"))
+TRANSCRIPT_CACHE_DB = os.environ.get("TRANSCRIPT_CACHE_DB", os.path.join(DOWNLOADS_DIR, "transcripts.sqlite3"))
+TRANSCRIBE_PROMPT_VERSION = "1"
+TEXT_CACHE_ITEMS = int(os.environ.get("TEXT_CACHE_ITEMS", "1000"))
+TEXT_CACHE_TTL = int(os.environ.get("TEXT_CACHE_TTL", str(7 * 86400)))
+TEXT_CACHE_MAX_ROWS = int(os.environ.get("TEXT_CACHE_MAX_ROWS", "50000"))
+SUMMARY_MAP_THRESHOLD = int(os.environ.get("SUMMARY_MAP_THRESHOLD", "24000"))
+SUMMARY_CHUNK_CHARS = int(os.environ.get("SUMMARY_CHUNK_CHARS", "12000"))
+SUMMARY_WORKERS = int(os.environ.get("SUMMARY_WORKERS", "4"))
+SUMMARY_MAX_LEVELS = int(os.environ.get("SUMMARY_MAX_LEVELS", "3"))
+TRANSLATE_GROUP_SIZE = int(os.environ.get("TRANSLATE_GROUP_SIZE", "3"))
+TRANSLATE_GROUP_MAX_CHARS = int(os.environ.get("TRANSLATE_GROUP_MAX_CHARS", "6000"))
+TRANSLATE_WORKERS = int(os.environ.get("TRANSLATE_WORKERS", "4"))
+TEXT_CACHE_DB = os.environ.get("TEXT_CACHE_DB", os.path.join(DOWNLOADS_DIR, "text_results.sqlite3"))
+FFMPEG_BINARY = os.environ.get("FFMPEG_BINARY", "ffmpeg")
+LONG_MEDIA_SECONDS = int(os.environ.get("LONG_MEDIA_SECONDS", "600"))
+LONG_MEDIA_PROBE_BYTES = int(os.environ.get("LONG_MEDIA_PROBE_BYTES", str(8 * 1024 * 1024)))
+SEGMENT_SECONDS = int(os.environ.get("SEGMENT_SECONDS", "300"))
+SEGMENT_OVERLAP = float(os.environ.get("SEGMENT_OVERLAP", "2"))
+SEGMENT_WORKERS = int(os.environ.get("SEGMENT_WORKERS", "4"))
+SEGMENT_RETRIES = int(os.environ.get("SEGMENT_RETRIES", "2"))
+SEGMENT_TIMINGS_MAX_BYTES = int(os.environ.get("SEGMENT_TIMINGS_MAX_BYTES", str(2 * 1024 * 1024)))
+TEXT_FILE_COMPRESS_BYTES = int(os.environ.get("TEXT_FILE_COMPRESS_BYTES", str(1024 * 1024)))
+TEXT_FILE_COMPRESSION = os.environ.get("TEXT_FILE_COMPRESSION", "gzip").lower()
+SILENCE_NOISE_DB = int(os.environ.get("SILENCE_NOISE_DB", "-35"))
+SILENCE_MIN_SECONDS = float(os.environ.get("SILENCE_MIN_SECONDS", "0.4"))
+VAD_ENABLED = os.environ.get("VAD_ENABLED", "1") == "1"
+VAD_MIN_SILENCE = float(os.environ.get("VAD_MIN_SILENCE", "1.0"))
+VAD_PADDING = float(os.environ.get("VAD_PADDING", "0.25"))
+VAD_MIN_SAVING = float(os.environ.get("VAD_MIN_SAVING", "0.1"))
+VAD_MAX_REGIONS = int(os.environ.get("VAD_MAX_REGIONS", "400"))
+VAD_MIN_SECONDS = float(os.environ.get("VAD_MIN_SECONDS", "30"))
+VAD_MIN_BYTES = int(os.environ.get("VAD_MIN_BYTES", str(128 * 1024)))
+NORMALIZE_AUDIO = os.environ.get("NORMALIZE_AUDIO", "1") == "1"
+NORMALIZE_BITRATE_KBPS = int(os.environ.get("NORMALIZE_BITRATE_KBPS", "24"))
+NORMALIZE_MIN_BYTES = int(os.environ.get("NORMALIZE_MIN_BYTES", str(256 * 1024)))
+NORMALIZE_MAX_RATIO = float(os.environ.get("NORMALIZE_MAX_RATIO", "0.8"))
+NORMALIZED_DIR = os.environ.get("NORMALIZED_DIR", os.path.join(DOWNLOADS_DIR, "normalized"))
+NORMALIZED_CACHE_MAX_MB = int(os.environ.get("NORMALIZED_CACHE_MAX_MB", "512"))
 
 os.makedirs(DOWNLOADS_DIR, exist_ok=True)
+os.makedirs(NORMALIZED_DIR, exist_ok=True)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+class KeyState:
+    __slots__ = ("inflight", "latency", "errors", "failures", "disabled_until", "rpm_tokens", "tpm_tokens", "refilled", "requests", "rate_limited")
+    def __init__(self, rpm, tpm):
+        self.inflight = 0
+        self.latency = 5.0
+        self.errors = 0.0
+        self.failures = 0
+        self.disabled_until = 0.0
+        self.rpm_tokens = rpm
+        self.tpm_tokens = tpm
+        self.refilled = time.time()
+        self.requests = 0
+        self.rate_limited = 0
+
+def key_id(key):
+    return hashlib.sha256(str(key).encode('utf-8')).hexdigest()[:10]
+
+def seconds_until_quota_reset():
+    try:
+        now = datetime.now(ZoneInfo("America/Los_Angeles"))
+        midnight = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+        return (midnight - now).total_seconds() + 60
+    except Exception:
+        return KEY_BACKOFF_SECONDS
+
+def classify_gemini_error(e):
+    resp = getattr(e, "response", None)
+    if not isinstance(e, requests.exceptions.HTTPError) or resp is None:
+        return None, None, None
+    code = resp.status_code
+    scope = None
+    retry_after = None
+    if code == 429:
+        try:
+            details = (resp.json().get("error") or {}).get("details") or []
+        except Exception:
+            details = []
+        for d in details:
+            kind = d.get("@type", "")
+            if kind.endswith("QuotaFailure"):
+                for v in d.get("violations") or []:
+                    quota_id = v.get("quotaId", "")
+                    if "PerDay" in quota_id:
+                        scope = "day"
+                    elif "PerMinute" in quota_id and scope != "day":
+                        scope = "minute"
+            elif kind.endswith("RetryInfo"):
+                try:
+                    retry_after = float(str(d.get("retryDelay", "")).rstrip("s"))
+                except ValueError:
+                    pass
+    return code, scope, retry_after
+
 class KeyRotator:
-    def __init__(self, keys, backoff=KEY_BACKOFF_SECONDS):
+    def __init__(self, keys, backoff=KEY_BACKOFF_SECONDS, rpm=KEY_RPM, tpm=KEY_TPM, state_path=None):
         self.keys = [k.strip() for k in keys.split(",") if k.strip()] if isinstance(keys, str) else list(keys or [])
         self.backoff = backoff
+        self.rpm = rpm
+        self.tpm = tpm
+        self.state_path = state_path
         self.pos = 0
         self.lock = threading.Lock()
-        self.disabled_until = {}
-    def _is_disabled(self, key):
-        ts = self.disabled_until.get(key)
-        if ts and time.time() < ts:
-            return True
-        return False
-    def get_key(self):
+        self.state = {k: KeyState(rpm, tpm) for k in self.keys}
+        self.saved_at = 0.0
+        self.write_lock = threading.Lock()
+        self._load()
+    def _load(self):
+        if not self.state_path or not os.path.exists(self.state_path):
+            return
+        try:
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                saved = json.load(f)
+        except Exception as e:
+            logging.warning(f"Could not load key state: {e}")
+            return
+        for key, st in self.state.items():
+            entry = saved.get(key_id(key))
+            if not entry:
+                continue
+            st.disabled_until = float(entry.get("disabled_until", 0))
+            st.latency = float(entry.get("latency", st.latency))
+            st.errors = float(entry.get("errors", 0))
+            st.failures = int(entry.get("failures", 0))
+    def _save(self, force=False):
+        if not self.state_path:
+            return
+        now = time.time()
         with self.lock:
-            if not self.keys:
+            if not force and now - self.saved_at < 60:
+                return
+            self.saved_at = now
+            snapshot = {key_id(k): {"disabled_until": st.disabled_until, "latency": round(st.latency, 3), "errors": round(st.errors, 4), "failures": st.failures} for k, st in self.state.items()}
+        threading.Thread(target=self._write, args=(snapshot,), name="key-state", daemon=True).start()
+    def _write(self, snapshot):
+        with self.write_lock:
+            try:
+                tmp = self.state_path + ".tmp"
+                with open(tmp, "w", encoding="utf-8") as f:
+                    json.dump(snapshot, f)
+                os.replace(tmp, self.state_path)
+            except Exception as e:
+                logging.warning(f"Could not save key state: {e}")
+    def _refill(self, st, now):
+        elapsed = now - st.refilled
+        st.refilled = now
+        if self.rpm:
+            st.rpm_tokens = min(self.rpm, st.rpm_tokens + elapsed * self.rpm / 60.0)
+        if self.tpm:
+            st.tpm_tokens = min(self.tpm, st.tpm_tokens + elapsed * self.tpm / 60.0)
+    def _is_disabled(self, key):
+        return self.state[key].disabled_until > time.time()
+    def get_key(self, exclude=(), wait=0.0):
+        deadline = time.time() + wait
+        while True:
+            with self.lock:
+                if not self.keys:
+                    return None
+                now = time.time()
+                n = len(self.keys)
+                best = None
+                best_score = None
+                soonest = None
+                for i in range(n):
+                    key = self.keys[(self.pos + i) % n]
+                    st = self.state[key]
+                    if key in exclude or st.disabled_until > now:
+                        continue
+                    self._refill(st, now)
+                    ready_at = now
+                    if self.rpm and st.rpm_tokens < 1:
+                        ready_at = max(ready_at, now + (1 - st.rpm_tokens) * 60.0 / self.rpm)
+                    if self.tpm and st.tpm_tokens <= 0:
+                        ready_at = max(ready_at, now + (1 - st.tpm_tokens) * 60.0 / self.tpm)
+                    if ready_at > now:
+                        soonest = ready_at if soonest is None else min(soonest, ready_at)
+                        continue
+                    score = (st.inflight + 1) * st.latency * (1 + 4 * st.errors)
+                    if best is None or score < best_score:
+                        best, best_score = key, score
+                if best is not None:
+                    st = self.state[best]
+                    st.inflight += 1
+                    st.requests += 1
+                    if self.rpm:
+                        st.rpm_tokens -= 1
+                    self.pos = (self.keys.index(best) + 1) % n
+                    return best
+            if soonest is None or soonest > deadline:
                 return None
-            tried = 0
-            n = len(self.keys)
-            while tried < n:
-                key = self.keys[self.pos]
-                self.pos = (self.pos + 1) % n
-                tried += 1
-                if not self._is_disabled(key):
-                    return key
+            time.sleep(max(0.05, soonest - time.time()))
+    def mark_success(self, key, latency=None, tokens=0):
+        with self.lock:
+            st = self.state.get(key)
+            if st is None:
+                return
+            st.inflight = max(0, st.inflight - 1)
+            if latency is not None:
+                st.latency = 0.7 * st.latency + 0.3 * latency
+            st.errors *= 0.7
+            st.failures = 0
+            st.disabled_until = 0.0
+            if self.tpm and tokens:
+                st.tpm_tokens -= tokens
+        self._save()
+    def mark_failure(self, key, reason_code=None, backoff_override=None, scope=None, retry_after=None):
+        with self.lock:
+            st = self.state.get(key)
+            if st is None:
+                return
+            st.inflight = max(0, st.inflight - 1)
+            st.errors = 0.7 * st.errors + 0.3
+            st.failures += 1
+            if backoff_override is not None:
+                backoff = backoff_override
+            elif reason_code == 429 and scope == "day":
+                backoff = seconds_until_quota_reset()
+            elif reason_code == 429:
+                backoff = min(self.backoff, (retry_after or 60) * 2 ** min(st.failures - 1, 6))
+            else:
+                backoff = min(self.backoff, 300, 10 * 2 ** min(st.failures - 1, 5))
+            if reason_code == 429:
+                st.rate_limited += 1
+            st.disabled_until = time.time() + backoff
+        self._save(force=backoff > 60)
+    def release(self, key):
+        with self.lock:
+            st = self.state.get(key)
+            if st is not None:
+                st.inflight = max(0, st.inflight - 1)
+    def any_available(self):
+        with self.lock:
+            now = time.time()
+            return any(self.state[k].disabled_until <= now for k in self.keys)
+    def stats(self):
+        with self.lock:
+            now = time.time()
+            return {key_id(k): {
+                "inflight": st.inflight,
+                "latency": round(st.latency, 2),
+                "errors": round(st.errors, 3),
+                "requests": st.requests,
+                "rate_limited": st.rate_limited,
+                "disabled_for": round(max(0.0, st.disabled_until - now))
+            } for k, st in self.state.items()}
+
+flash_rotator = KeyRotator(GEMINI_KEYS, state_path=os.path.join(KEY_STATE_DIR, "flash_keys.json"))
+flash_lite_rotator = KeyRotator(FLASH_LITE_KEYS, state_path=os.path.join(KEY_STATE_DIR, "flash_lite_keys.json"))
+
+class TranscriptCache:
+    def __init__(self, path, max_items, ttl, max_rows):
+        self.max_items = max_items
+        self.ttl = ttl
+        self.max_rows = max_rows
+        self.lock = threading.Lock()
+        self.mem = collections.OrderedDict()
+        self.hits_memory = 0
+        self.hits_disk = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.db = None
+        if path:
+            try:
+                self.db = sqlite3.connect(path, check_same_thread=False)
+                self.db.execute("CREATE TABLE IF NOT EXISTS transcripts (key TEXT PRIMARY KEY, data BLOB, created REAL, accessed REAL)")
+                self.db.execute("CREATE INDEX IF NOT EXISTS transcripts_accessed ON transcripts (accessed)")
+                self.db.commit()
+            except Exception as e:
+                logging.warning(f"Transcript cache DB unavailable: {e}")
+                self.db = None
+    def _remember(self, key, text, expires):
+        self.mem[key] = (expires, text)
+        self.mem.move_to_end(key)
+        while len(self.mem) > self.max_items:
+            self.mem.popitem(last=False)
+            self.evictions += 1
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            item = self.mem.get(key)
+            if item:
+                if item[0] > now:
+                    self.mem.move_to_end(key)
+                    self.hits_memory += 1
+                    return item[1]
+                self.mem.pop(key, None)
+                self.evictions += 1
+            if self.db is not None:
+                try:
+                    row = self.db.execute("SELECT data, created FROM transcripts WHERE key = ?", (key,)).fetchone()
+                    if row and row[1] + self.ttl > now:
+                        text = zlib.decompress(row[0]).decode('utf-8')
+                        self.db.execute("UPDATE transcripts SET accessed = ? WHERE key = ?", (now, key))
+                        self.db.commit()
+                        self._remember(key, text, row[1] + self.ttl)
+                        self.hits_disk += 1
+                        return text
+                except Exception as e:
+                    logging.warning(f"Transcript cache read failed: {e}")
+            self.misses += 1
             return None
-    def mark_success(self, key):
+    def put(self, key, text):
+        now = time.time()
+        with self.lock:
+            self._remember(key, text, now + self.ttl)
+            self.stores += 1
+            if self.db is None:
+                return
+            try:
+                self.db.execute("INSERT OR REPLACE INTO transcripts (key, data, created, accessed) VALUES (?, ?, ?, ?)", (key, zlib.compress(text.encode('utf-8')), now, now))
+                if self.stores % 50 == 1:
+                    cur = self.db.execute("DELETE FROM transcripts WHERE created < ?", (now - self.ttl,))
+                    self.evictions += max(cur.rowcount, 0)
+                    cur = self.db.execute("DELETE FROM transcripts WHERE key IN (SELECT key FROM transcripts ORDER BY accessed DESC LIMIT -1 OFFSET ?)", (self.max_rows,))
+                    self.evictions += max(cur.rowcount, 0)
+                self.db.commit()
+            except Exception as e:
+                logging.warning(f"Transcript cache write failed: {e}")
+    def stats(self):
         with self.lock:
-            if key in self.disabled_until:
-                self.disabled_until.pop(key, None)
-            if key in self.keys:
+            rows = 0
+            if self.db is not None:
                 try:
-                    i = self.keys.index(key)
-                    self.pos = (i + 1) % len(self.keys)
-                except ValueError:
+                    rows = self.db.execute("SELECT COUNT(*) FROM transcripts").fetchone()[0]
+                except Exception:
                     pass
-    def mark_failure(self, key, reason_code=None, backoff_override=None):
+            lookups = self.hits_memory + self.hits_disk + self.misses
+            return {
+                "memory_entries": len(self.mem),
+                "disk_entries": rows,
+                "hits_memory": self.hits_memory,
+                "hits_disk": self.hits_disk,
+                "misses": self.misses,
+                "hit_rate": round((self.hits_memory + self.hits_disk) / lookups, 3) if lookups else 0.0,
+                "stores": self.stores,
+                "evictions": self.evictions
+            }
+
+transcript_cache = TranscriptCache(TRANSCRIPT_CACHE_DB, TRANSCRIPT_CACHE_ITEMS, TRANSCRIPT_CACHE_TTL, TRANSCRIPT_CACHE_MAX_ROWS)
+
+def transcript_cache_key(file_unique_id, lang_code):
+    return f"{file_unique_id}|{lang_code or 'auto'}|{GEMINI_MODEL_FLASH}|{TRANSCRIBE_PROMPT_VERSION}"
+
+class Flight:
+    __slots__ = ("done", "result", "error", "followers")
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.followers = 0
+
+class SingleFlight:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.leaders = 0
+        self.coalesced = 0
+        self.shared_errors = 0
+    def do(self, key, fn, *args):
         with self.lock:
-            backoff = backoff_override if backoff_override is not None else self.backoff
-            if reason_code == 429:
-                self.disabled_until[key] = time.time() + backoff
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+                self.leaders += 1
             else:
-                self.disabled_until[key] = time.time() + min(backoff, 10)
-    def any_available(self):
+                flight.followers += 1
+                self.coalesced += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = fn(*args)
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                self.flights.pop(key, None)
+                if flight.error is not None:
+                    self.shared_errors += flight.followers
+            flight.done.set()
+    def stats(self):
         with self.lock:
-            now = time.time()
-            for k in self.keys:
-                ts = self.disabled_until.get(k)
-                if not ts or now >= ts:
-                    return True
-            return False
+            return {
+                "in_flight": len(self.flights),
+                "leaders": self.leaders,
+                "coalesced": self.coalesced,
+                "shared_errors": self.shared_errors
+            }
+
+transcription_flights = SingleFlight()
+text_cache = TranscriptCache(TEXT_CACHE_DB, TEXT_CACHE_ITEMS, TEXT_CACHE_TTL, TEXT_CACHE_MAX_ROWS)
+text_flights = SingleFlight()
 
-flash_rotator = KeyRotator(GEMINI_KEYS)
-flash_lite_rotator = KeyRotator(FLASH_LITE_KEYS)
+def text_cache_key(text, instruction):
+    instruction = " ".join(instruction.lower().split())
+    return f"{hashlib.sha256(text.encode('utf-8')).hexdigest()}|{hashlib.sha256(instruction.encode('utf-8')).hexdigest()[:16]}|{GEMINI_MODEL_FLASH}"
 
 LANGS = [
 ("🇬🇧 English","en"), ("🇸🇦 العربية","ar"), ("🇪🇸 Español","es"), ("🇫🇷 Français","fr"),
@@ -104,88 +536,785 @@ LANGS = [
 LANG_MAP = {code: lbl for lbl, code in LANGS}
 
 user_mode = {}
-user_transcriptions = {}
+user_file_format = {}
+user_transcriptions = TranscriptStore(TRANSCRIPT_STORE_MAX_MB * 1024 * 1024, TRANSCRIPT_STORE_TTL, TRANSCRIPT_STORE_SPILL)
 action_usage = {}
 user_selected_lang = {}
-pending_files = {}
+translate_selections = {}
+
+job_queue = JobQueue(JOBS_DB, PENDING_TTL, JOB_RETENTION, JOB_LEASE, JOB_BATCH)
+
+class HttpMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hosts = {}
+    def record(self, resp, *args, **kwargs):
+        host = urlparse(resp.url).hostname or "unknown"
+        with self.lock:
+            h = self.hosts.setdefault(host, {"requests": 0, "errors": 0, "elapsed_total": 0.0})
+            h["requests"] += 1
+            if resp.status_code >= 400:
+                h["errors"] += 1
+            h["elapsed_total"] += resp.elapsed.total_seconds()
+    def stats(self, session):
+        with self.lock:
+            out = {}
+            for host, h in self.hosts.items():
+                out[host] = {
+                    "requests": h["requests"],
+                    "errors": h["errors"],
+                    "avg_ms": round(h["elapsed_total"] * 1000 / h["requests"], 1) if h["requests"] else 0.0,
+                    "connections_opened": 0
+                }
+        for adapter in session.adapters.values():
+            pools = adapter.poolmanager.pools
+            for pool_key in list(pools.keys()):
+                pool = pools.get(pool_key)
+                if pool is not None and pool.host in out:
+                    out[pool.host]["connections_opened"] += pool.num_connections
+        return out
+
+def build_http_session(pool_size=HTTP_POOL_SIZE, retries=HTTP_RETRIES):
+    session = requests.Session()
+    retry = Retry(total=retries, connect=retries, backoff_factor=0.5, status_forcelist=(500, 502, 503, 504), allowed_methods=frozenset(["GET", "HEAD"]), raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.hooks["response"].append(http_metrics.record)
+    return session
+
+def _prom_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{json.dumps(str(v))[1:-1]}"' for k, v in labels) + "}"
+
+class StageMetrics:
+    buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = collections.defaultdict(float)
+    def observe(self, stage, seconds, **labels):
+        key = (stage, tuple(sorted(labels.items())))
+        with self.lock:
+            h = self.histograms.get(key)
+            if h is None:
+                h = self.histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    h[0][i] += 1
+            h[1] += seconds
+            h[2] += 1
+    @contextlib.contextmanager
+    def timer(self, stage, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started, **labels)
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+    def add(self, gauge, value):
+        with self.lock:
+            self.gauges[gauge] += value
+    def render(self, gauges):
+        lines = ["# HELP bot_stage_seconds Latency of each pipeline stage.", "# TYPE bot_stage_seconds histogram"]
+        with self.lock:
+            for (stage, labels), (counts, total, n) in sorted(self.histograms.items()):
+                base = (("stage", stage),) + labels
+                for bound, count in zip(self.buckets, counts):
+                    lines.append(f"bot_stage_seconds_bucket{_prom_labels(base + (('le', bound),))} {count}")
+                lines.append(f"bot_stage_seconds_bucket{_prom_labels(base + (('le', '+Inf'),))} {n}")
+                lines.append(f"bot_stage_seconds_sum{_prom_labels(base)} {total:.6f}")
+                lines.append(f"bot_stage_seconds_count{_prom_labels(base)} {n}")
+            names = sorted({name for name, _ in self.counters})
+            for name in names:
+                lines.append(f"# TYPE bot_{name} counter")
+                for (n, labels), value in sorted(self.counters.items()):
+                    if n == name:
+                        lines.append(f"bot_{name}{_prom_labels(labels)} {value}")
+            gauges = list(gauges) + [(name, (), value) for name, value in self.gauges.items()]
+        for name in sorted({g[0] for g in gauges}):
+            lines.append(f"# TYPE bot_{name} gauge")
+            for n, labels, value in gauges:
+                if n == name:
+                    lines.append(f"bot_{name}{_prom_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+http_metrics = HttpMetrics()
+stage_metrics = StageMetrics()
+http_session = build_http_session()
+apihelper.session = http_session
+apihelper.API_URL = TELEGRAM_API_URL + "/bot{0}/{1}"
+apihelper.FILE_URL = TELEGRAM_API_URL + "/file/bot{0}/{1}"
 
-bot = telebot.TeleBot(BOT_TOKEN, threaded=True)
+bot = telebot.TeleBot(BOT_TOKEN, threaded=False)
 flask_app = Flask(__name__)
 
+PRIORITY_RESULT = 0
+PRIORITY_PROGRESS = 2
+
+def utf16_len(text):
+    return len(text.encode('utf-16-le')) // 2
+
+def split_message(text, limit=MAX_MESSAGE_CHUNK):
+    if utf16_len(text) <= limit:
+        return [text] if text else []
+    chunks = []
+    rest = text
+    while utf16_len(rest) > limit:
+        lo, hi = 0, len(rest)
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if utf16_len(rest[:mid]) <= limit:
+                lo = mid
+            else:
+                hi = mid - 1
+        window = rest[:lo]
+        cut = 0
+        for sep in ("\n\n", "\n", ". ", "! ", "? ", "。", " "):
+            pos = window.rfind(sep)
+            if pos > lo // 2:
+                cut = pos + len(sep)
+                break
+        cut = cut or lo
+        chunks.append(rest[:cut].rstrip())
+        rest = rest[cut:].lstrip()
+    if rest:
+        chunks.append(rest)
+    return [c for c in chunks if c]
+
+class OutboundLimiter:
+    def __init__(self, global_rate, chat_rate, chat_burst, group_rate, retries):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.retries = retries
+        self.cond = threading.Condition()
+        self.global_tokens = global_rate
+        self.refilled = time.time()
+        self.chats = {}
+        self.waiting = {}
+        self.seq = 0
+        self.sent = 0
+        self.waited = 0.0
+        self.retried = 0
+        self.skipped = 0
+    def _chat(self, chat_id, now):
+        st = self.chats.get(chat_id)
+        if st is None:
+            if len(self.chats) > 5000:
+                self.chats = {c: v for c, v in self.chats.items() if v[2] > now or now - v[1] < 60}
+            burst = self.chat_burst if chat_id is None or chat_id > 0 else 1
+            st = self.chats[chat_id] = [burst, now, 0.0]
+        rate = self.chat_rate if chat_id is None or chat_id > 0 else self.group_rate
+        burst = self.chat_burst if chat_id is None or chat_id > 0 else 1
+        st[0] = min(burst, st[0] + (now - st[1]) * rate)
+        st[1] = now
+        return st, rate
+    def _ready_in(self, chat_id, now):
+        st, rate = self._chat(chat_id, now)
+        wait = max(0.0, st[2] - now)
+        if st[0] < 1:
+            wait = max(wait, (1 - st[0]) / rate)
+        if self.global_tokens < 1:
+            wait = max(wait, (1 - self.global_tokens) / self.global_rate)
+        return wait
+    def _refill(self, now):
+        self.global_tokens = min(self.global_rate, self.global_tokens + (now - self.refilled) * self.global_rate)
+        self.refilled = now
+    def _preempted(self, priority, now):
+        return any(p < priority and self._ready_in(c, now) <= 0 for p, c in self.waiting.values())
+    def _grant(self, chat_id, priority, started):
+        now = time.time()
+        self._refill(now)
+        wait = self._ready_in(chat_id, now)
+        if wait <= 0 and not self._preempted(priority, now):
+            self.chats[chat_id][0] -= 1
+            self.global_tokens -= 1
+            self.waited += now - started
+            self.cond.notify_all()
+            return None
+        return wait
+    def acquire(self, chat_id, priority=PRIORITY_RESULT, block=True):
+        started = time.time()
+        with self.cond:
+            self.seq += 1
+            seq = self.seq
+            try:
+                while True:
+                    wait = self._grant(chat_id, priority, started)
+                    if wait is None:
+                        return True
+                    if not block:
+                        self.skipped += 1
+                        return False
+                    self.waiting[seq] = (priority, chat_id)
+                    self.cond.wait(timeout=min(1.0, max(0.01, wait)))
+            finally:
+                self.waiting.pop(seq, None)
+    async def acquire_async(self, chat_id, priority=PRIORITY_RESULT):
+        started = time.time()
+        with self.cond:
+            self.seq += 1
+            seq = self.seq
+        try:
+            while True:
+                with self.cond:
+                    wait = self._grant(chat_id, priority, started)
+                    if wait is None:
+                        return True
+                    self.waiting[seq] = (priority, chat_id)
+                await asyncio.sleep(min(1.0, max(0.01, wait)))
+        finally:
+            with self.cond:
+                self.waiting.pop(seq, None)
+    def penalize(self, chat_id, retry_after):
+        with self.cond:
+            st, _ = self._chat(chat_id, time.time())
+            st[2] = max(st[2], time.time() + retry_after)
+            st[0] = min(st[0], 0)
+    def on_sent(self):
+        with self.cond:
+            self.sent += 1
+    def on_retried(self):
+        with self.cond:
+            self.retried += 1
+    def call(self, chat_id, priority, fn, *args, **kwargs):
+        for attempt in range(self.retries + 1):
+            self.acquire(chat_id, priority)
+            try:
+                result = fn(*args, **kwargs)
+                self.on_sent()
+                return result
+            except apihelper.ApiTelegramException as e:
+                if e.error_code != 429 or attempt == self.retries:
+                    raise
+                retry_after = ((e.result_json or {}).get("parameters") or {}).get("retry_after", 5)
+                self.penalize(chat_id, retry_after)
+                self.on_retried()
+                logging.warning(f"Telegram 429 for chat {chat_id}, retrying in {retry_after}s")
+    def stats(self):
+        with self.cond:
+            return {
+                "sent": self.sent,
+                "waiting": len(self.waiting),
+                "wait_total": round(self.waited, 2),
+                "retried_429": self.retried,
+                "progress_skipped": self.skipped,
+                "chats_tracked": len(self.chats)
+            }
+
+outbound = OutboundLimiter(SEND_GLOBAL_RATE, SEND_CHAT_RATE, SEND_CHAT_BURST, SEND_GROUP_RATE, SEND_RETRIES)
+
+class ProgressJob:
+    __slots__ = ("chat_id", "message_id", "stage", "done", "total", "stage_started", "last_text", "last_edit")
+    def __init__(self, chat_id, message_id, stage):
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.stage = stage
+        self.done = 0
+        self.total = 0
+        self.stage_started = time.time()
+        self.last_text = None
+        self.last_edit = 0.0
+
+class ProgressBoard:
+    bars = 12
+    stages = {"Queued": (0, 5), "Downloading": (5, 30), "Normalizing": (30, 33), "Detecting speech": (33, 35), "Uploading": (35, 60), "Waiting for Gemini": (60, 95), "Transcribing segments": (30, 95), "Sending": (95, 100)}
+    def __init__(self, edits_per_sec, chat_interval):
+        self.min_gap = 1.0 / max(edits_per_sec, 0.1)
+        self.chat_interval = chat_interval
+        self.lock = threading.Lock()
+        self.current = contextvars.ContextVar("progress_job", default=None)
+        self.jobs = {}
+        self.chat_next = {}
+        self.next_edit = 0.0
+        self.paused_until = 0.0
+        self.edits = 0
+        self.rate_limited = 0
+    def run_in_thread(self):
+        threading.Thread(target=self._run, name="progress", daemon=True).start()
+    def render(self, job, now):
+        lo, hi = self.stages.get(job.stage, (0, 95))
+        if job.total:
+            frac = min(1.0, job.done / job.total)
+        else:
+            frac = 1 - math.exp(-(now - job.stage_started) / 20.0)
+        percent = int(lo + (hi - lo) * frac)
+        filled = int(percent * self.bars / 100)
+        return f"{job.stage}: {percent}% [{'█' * filled}{'░' * (self.bars - filled)}]"
+    def start(self, chat_id, reply_to_message_id):
+        job = ProgressJob(chat_id, None, "Queued")
+        try:
+            msg = outbound.call(chat_id, PRIORITY_PROGRESS, bot.send_message, chat_id, self.render(job, job.stage_started), reply_to_message_id=reply_to_message_id)
+        except Exception:
+            return None
+        job.message_id = msg.message_id
+        job.last_text = msg.text
+        job.last_edit = time.time()
+        with self.lock:
+            self.jobs[(chat_id, job.message_id)] = job
+        self.current.set(job)
+        return job
+    def report(self, stage, done=0, total=0):
+        job = self.current.get()
+        if job is None:
+            return
+        if job.stage != stage:
+            job.stage = stage
+            job.stage_started = time.time()
+        job.done = done
+        job.total = total
+    def finish(self, job):
+        self.current.set(None)
+        if job is None:
+            return
+        with self.lock:
+            self.jobs.pop((job.chat_id, job.message_id), None)
+        try:
+            bot.delete_message(job.chat_id, job.message_id)
+        except:
+            pass
+    def _next_due(self, now):
+        with self.lock:
+            if len(self.chat_next) > 2 * len(self.jobs) + 100:
+                self.chat_next = {c: t for c, t in self.chat_next.items() if t > now}
+            best = None
+            for job in self.jobs.values():
+                if self.chat_next.get(job.chat_id, 0) > now:
+                    continue
+                text = self.render(job, now)
+                if text == job.last_text:
+                    continue
+                if best is None or job.last_edit < best[0].last_edit:
+                    best = (job, text)
+            if best is None:
+                return None, None
+            best[0].last_edit = now
+            self.chat_next[best[0].chat_id] = now + self.chat_interval
+            return best
+    def _take(self):
+        now = time.time()
+        if now < self.paused_until or now < self.next_edit:
+            return None, None
+        job, text = self._next_due(now)
+        if job is None or not outbound.acquire(job.chat_id, PRIORITY_PROGRESS, block=False):
+            return None, None
+        return job, text
+    def _pause(self, job, retry_after):
+        self.paused_until = time.time() + retry_after
+        outbound.penalize(job.chat_id, retry_after)
+        self.rate_limited += 1
+    def _run(self):
+        while True:
+            time.sleep(0.1)
+            job, text = self._take()
+            if job is None:
+                continue
+            try:
+                bot.edit_message_text(text, job.chat_id, job.message_id)
+                self.edits += 1
+            except apihelper.ApiTelegramException as e:
+                if e.error_code == 429:
+                    self._pause(job, ((e.result_json or {}).get("parameters") or {}).get("retry_after", 5))
+            except:
+                pass
+            job.last_text = text
+            self.next_edit = time.time() + self.min_gap
+    async def arun(self):
+        while True:
+            await asyncio.sleep(0.1)
+            job, text = self._take()
+            if job is None:
+                continue
+            try:
+                await async_bot.call("editMessageText", text=text, chat_id=job.chat_id, message_id=job.message_id)
+                self.edits += 1
+            except TelegramError as e:
+                if e.error_code == 429:
+                    self._pause(job, e.retry_after or 5)
+            except Exception:
+                pass
+            job.last_text = text
+            self.next_edit = time.time() + self.min_gap
+    def stats(self):
+        with self.lock:
+            return {
+                "active": len(self.jobs),
+                "edits": self.edits,
+                "rate_limited": self.rate_limited,
+                "paused_for": round(max(0.0, self.paused_until - time.time()), 1)
+            }
+
+progress_board = ProgressBoard(PROGRESS_EDITS_PER_SEC, PROGRESS_CHAT_INTERVAL)
+
 def notify_admin(message, file_type):
     try:
         bot.forward_message(ADMIN_ID, message.chat.id, message.message_id)
     except:
         pass
 
+media_pins = collections.Counter()
+media_pin_lock = threading.Lock()
+
+class MediaSpool:
+    def __init__(self, media_file, size, remove_path=None, pinned=None):
+        self.file = media_file
+        self.size = size
+        self.remove_path = remove_path
+        self.pinned = pinned
+        self.refs = 1
+        self.lock = threading.Lock()
+    def acquire(self):
+        with self.lock:
+            if self.refs == 0:
+                raise HedgeCancelled("Media already released")
+            self.refs += 1
+    def release(self):
+        with self.lock:
+            self.refs -= 1
+            if self.refs == 0:
+                self.file.close()
+                if self.remove_path and os.path.exists(self.remove_path):
+                    os.remove(self.remove_path)
+                if self.pinned:
+                    with media_pin_lock:
+                        media_pins[self.pinned] -= 1
+                        if media_pins[self.pinned] <= 0:
+                            del media_pins[self.pinned]
+
+class InlineMediaBody:
+    def __init__(self, prompt, mime_type, spool, chunk_size=STREAM_CHUNK_SIZE):
+        self.prefix = ('{"contents": [{"parts": [{"text": ' + json.dumps(prompt) + '}, {"inline_data": {"mime_type": ' + json.dumps(mime_type) + ', "data": "').encode('utf-8')
+        self.suffix = b'"}}]}]}'
+        self.spool = spool
+        self.size = spool.size
+        self.chunk_size = max(3, chunk_size - chunk_size % 3)
+    def __len__(self):
+        return len(self.prefix) + 4 * ((self.size + 2) // 3) + len(self.suffix)
+    def __iter__(self):
+        yield self.prefix
+        self.spool.acquire()
+        stage_metrics.add("upload_bytes_in_flight", self.size)
+        encoding = 0.0
+        try:
+            fd = self.spool.file.fileno()
+            offset = 0
+            carry = b""
+            cancel = getattr(hedge_local, "cancel", None)
+            while offset < self.size:
+                if cancel is not None and cancel.is_set():
+                    raise HedgeCancelled("Upload cancelled, another request won")
+                chunk = os.pread(fd, self.chunk_size, offset)
+                if not chunk:
+                    break
+                offset += len(chunk)
+                progress_board.report("Uploading", offset, self.size)
+                chunk = carry + chunk
+                cut = len(chunk) - len(chunk) % 3
+                carry = chunk[cut:]
+                started = time.perf_counter()
+                encoded = base64.b64encode(chunk[:cut])
+                encoding += time.perf_counter() - started
+                yield encoded
+            if carry:
+                yield base64.b64encode(carry)
+        finally:
+            stage_metrics.add("upload_bytes_in_flight", -self.size)
+            stage_metrics.observe("base64_encode", encoding)
+            self.spool.release()
+        yield self.suffix
+        progress_board.report("Waiting for Gemini")
+
+def download_to_tempfile(file_url):
+    media_file = tempfile.NamedTemporaryFile(dir=DOWNLOADS_DIR)
+    received = 0
+    try:
+        with stage_metrics.timer("download"), http_session.get(file_url, stream=True, timeout=REQUEST_TIMEOUT) as resp:
+            resp.raise_for_status()
+            total = int(resp.headers.get("Content-Length") or 0)
+            for chunk in resp.iter_content(STREAM_CHUNK_SIZE):
+                media_file.write(chunk)
+                received += len(chunk)
+                stage_metrics.add("download_bytes_in_flight", len(chunk))
+                progress_board.report("Downloading", received, total)
+        media_file.flush()
+        return media_file, received
+    except:
+        media_file.close()
+        raise
+    finally:
+        stage_metrics.add("download_bytes_in_flight", -received)
+
+gemini_usage = threading.local()
+gemini_stream_sink = contextvars.ContextVar("gemini_stream_sink", default=None)
+gemini_models_used = contextvars.ContextVar("gemini_models_used", default=None)
+
+def note_gemini_model(model):
+    used = gemini_models_used.get()
+    if used is not None:
+        used.add(model)
+
+@contextlib.contextmanager
+def track_gemini_models():
+    used = set()
+    token = gemini_models_used.set(used)
+    try:
+        yield used
+    finally:
+        gemini_models_used.reset(token)
+
+def answered_by_primary(used):
+    return used == {GEMINI_MODEL_FLASH}
+
 def gemini_api_call(endpoint, payload, key):
-    url = f"https://generativelanguage.googleapis.com/v1beta/{endpoint}?key={key}"
+    url = f"{GEMINI_API_BASE}/v1beta/{endpoint}?key={key}"
     headers = {"Content-Type": "application/json"}
-    resp = requests.post(url, headers=headers, json=payload, timeout=REQUEST_TIMEOUT)
+    if isinstance(payload, InlineMediaBody):
+        resp = http_session.post(url, headers=headers, data=payload, timeout=REQUEST_TIMEOUT)
+    else:
+        resp = http_session.post(url, headers=headers, json=payload, timeout=REQUEST_TIMEOUT)
     resp.raise_for_status()
-    return resp.json()
+    data = resp.json()
+    gemini_usage.tokens = (data.get("usageMetadata") or {}).get("totalTokenCount", 0)
+    return data
+
+def stream_chunk_text(chunk):
+    candidates = chunk.get("candidates") or [{}]
+    parts = (candidates[0].get("content") or {}).get("parts") or []
+    return "".join(p.get("text", "") for p in parts)
+
+def gemini_stream_call(model, payload, key, sink):
+    url = f"{GEMINI_API_BASE}/v1beta/models/{model}:streamGenerateContent?alt=sse&key={key}"
+    headers = {"Content-Type": "application/json", "Accept": "text/event-stream"}
+    if isinstance(payload, InlineMediaBody):
+        resp = http_session.post(url, headers=headers, data=payload, timeout=REQUEST_TIMEOUT, stream=True)
+    else:
+        resp = http_session.post(url, headers=headers, json=payload, timeout=REQUEST_TIMEOUT, stream=True)
+    with resp:
+        resp.raise_for_status()
+        token = sink.begin()
+        pieces = []
+        try:
+            cancel = getattr(hedge_local, "cancel", None)
+            for line in resp.iter_lines(decode_unicode=True):
+                if cancel is not None and cancel.is_set():
+                    raise HedgeCancelled("Stream cancelled, another request won")
+                if not line or not line.startswith("data:"):
+                    continue
+                chunk = json.loads(line[5:])
+                usage = chunk.get("usageMetadata")
+                if usage:
+                    gemini_usage.tokens = usage.get("totalTokenCount", 0)
+                piece = stream_chunk_text(chunk)
+                if piece:
+                    pieces.append(piece)
+                    sink.stream(token, piece)
+        except:
+            sink.abandon(token)
+            raise
+    if not pieces:
+        sink.abandon(token)
+        raise RuntimeError("Unexpected Gemini response")
+    return "".join(pieces)
+
+class HedgeCancelled(Exception):
+    pass
+
+class LatencyTracker:
+    def __init__(self, size=200):
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.size = size
+    def record(self, kind, seconds):
+        with self.lock:
+            self.samples.setdefault(kind, collections.deque(maxlen=self.size)).append(seconds)
+    def percentile(self, kind, pct, minimum=20):
+        with self.lock:
+            samples = sorted(self.samples.get(kind, ()))
+        if len(samples) < minimum:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * pct))]
+
+class HedgeBudget:
+    def __init__(self, ratio, burst):
+        self.ratio = ratio
+        self.burst = burst
+        self.tokens = burst
+        self.lock = threading.Lock()
+        self.primary = 0
+        self.fired = 0
+        self.wins = 0
+        self.denied = 0
+        self.cancelled = 0
+    def on_primary(self):
+        with self.lock:
+            self.primary += 1
+            self.tokens = min(self.burst, self.tokens + self.ratio)
+    def take(self):
+        with self.lock:
+            if self.tokens >= 1:
+                self.tokens -= 1
+                self.fired += 1
+                return True
+            self.denied += 1
+            return False
+    def refund(self):
+        with self.lock:
+            self.fired -= 1
+            self.tokens += 1
+    def on_win(self):
+        with self.lock:
+            self.wins += 1
+    def on_cancel(self):
+        with self.lock:
+            self.cancelled += 1
+    def stats(self):
+        with self.lock:
+            return {
+                "enabled": HEDGE_ENABLED,
+                "primary_requests": self.primary,
+                "hedges_fired": self.fired,
+                "hedge_wins": self.wins,
+                "denied_by_budget": self.denied,
+                "losers_cancelled": self.cancelled,
+                "p95_media": gemini_latency.percentile("media", 0.95),
+                "p95_text": gemini_latency.percentile("text", 0.95)
+            }
+
+gemini_latency = LatencyTracker()
+hedge_budget = HedgeBudget(HEDGE_BUDGET_RATIO, HEDGE_BUDGET_BURST)
+hedge_local = threading.local()
+
+def record_gemini_outcome(label, key, model, kind, outcome, seconds):
+    stage_metrics.inc("gemini_key_outcomes_total", pool=label.lower(), key=key_id(key), outcome=outcome)
+    stage_metrics.observe("gemini", seconds, model=model, kind=kind, outcome=outcome)
 
-def execute_gemini_action(action_callback):
+def _attempt(rotator, key, model, label, kind, action_callback):
+    started = time.time()
+    try:
+        gemini_usage.tokens = 0
+        result = action_callback(key, model)
+    except Exception as e:
+        cancel = getattr(hedge_local, "cancel", None)
+        if cancel is not None and cancel.is_set():
+            rotator.release(key)
+            record_gemini_outcome(label, key, model, kind, "cancelled", time.time() - started)
+            raise HedgeCancelled(str(e))
+        code, scope, retry_after = classify_gemini_error(e)
+        rotator.mark_failure(key, reason_code=code, scope=scope, retry_after=retry_after)
+        record_gemini_outcome(label, key, model, kind, "rate_limited" if code == 429 else "error", time.time() - started)
+        logging.warning(f"{label} key error {key_id(key)}: {e}")
+        raise
+    latency = time.time() - started
+    rotator.mark_success(key, latency, getattr(gemini_usage, "tokens", 0))
+    gemini_latency.record(kind, latency)
+    record_gemini_outcome(label, key, model, kind, "success", latency)
+    return result
+
+def _run_with_rotator(rotator, model, label, kind, action_callback):
     last_exc = None
-    flash_attempted = False
-    flash_failed_all = True
-    total_flash_keys = len(flash_rotator.keys) or 0
-    for _ in range(total_flash_keys if total_flash_keys > 0 else 1):
-        key = flash_rotator.get_key()
+    tried = set()
+    for _ in range(len(rotator.keys) or 1):
+        key = rotator.get_key(exclude=tried, wait=KEY_WAIT_SECONDS)
         if not key:
             break
-        flash_attempted = True
+        tried.add(key)
         try:
-            result = action_callback(key, GEMINI_MODEL_FLASH)
-            flash_rotator.mark_success(key)
-            return result
+            return True, _attempt(rotator, key, model, label, kind, action_callback), None
         except Exception as e:
             last_exc = e
-            code = None
-            if isinstance(e, requests.exceptions.HTTPError) and getattr(e, "response", None) is not None:
-                try:
-                    code = e.response.status_code
-                except Exception:
-                    code = None
-            if code == 429:
-                flash_rotator.mark_failure(key, reason_code=429)
-            else:
-                flash_rotator.mark_failure(key, reason_code=code)
-            logging.warning(f"Flash key error {str(key)[:4]}: {e}")
-    if flash_attempted and not flash_rotator.any_available():
-        flash_failed_all = True
-    else:
-        flash_failed_all = last_exc is not None
-    if flash_failed_all and flash_lite_rotator.keys:
-        total_lite = len(flash_lite_rotator.keys) or 0
-        for _ in range(total_lite if total_lite > 0 else 1):
-            key = flash_lite_rotator.get_key()
-            if not key:
-                break
-            try:
-                result = action_callback(key, GEMINI_MODEL_FLASH_LITE)
-                flash_lite_rotator.mark_success(key)
-                return result
-            except Exception as e:
-                last_exc = e
-                code = None
-                if isinstance(e, requests.exceptions.HTTPError) and getattr(e, "response", None) is not None:
-                    try:
-                        code = e.response.status_code
-                    except Exception:
-                        code = None
-                if code == 429:
-                    flash_lite_rotator.mark_failure(key, reason_code=429)
+    return False, None, last_exc
+
+def _execute_hedged(action_callback, kind):
+    pools = [(flash_rotator, GEMINI_MODEL_FLASH, "Flash"), (flash_lite_rotator, GEMINI_MODEL_FLASH_LITE, "Flash-Lite")]
+    tried = {label: set() for _, _, label in pools}
+    results = queue.Queue()
+    cancel = threading.Event()
+    progress_job = progress_board.current.get()
+    stream_sink = gemini_stream_sink.get()
+    def run(rotator, key, model, label, hedge):
+        hedge_local.cancel = cancel
+        progress_board.current.set(None if hedge else progress_job)
+        gemini_stream_sink.set(None if hedge else stream_sink)
+        try:
+            results.put((hedge, True, (_attempt(rotator, key, model, label, kind, action_callback), model)))
+        except HedgeCancelled:
+            hedge_budget.on_cancel()
+        except Exception as e:
+            results.put((hedge, False, e))
+    def launch(hedge):
+        for rotator, model, label in pools:
+            if not rotator.keys:
+                continue
+            key = rotator.get_key(exclude=tried[label], wait=0 if hedge else KEY_WAIT_SECONDS)
+            if key:
+                tried[label].add(key)
+                threading.Thread(target=run, args=(rotator, key, model, label, hedge), daemon=True).start()
+                return True
+        return False
+    last_exc = None
+    hedged = False
+    running = 0
+    if launch(False):
+        running = 1
+        hedge_budget.on_primary()
+    while running:
+        delay = None
+        if not hedged:
+            delay = max(HEDGE_MIN_DELAY, gemini_latency.percentile(kind, 0.95) or HEDGE_DELAY)
+        try:
+            hedge, ok, value = results.get(timeout=delay)
+        except queue.Empty:
+            hedged = True
+            if hedge_budget.take():
+                if launch(True):
+                    running += 1
                 else:
-                    flash_lite_rotator.mark_failure(key, reason_code=code)
-                logging.warning(f"Flash-Lite key error {str(key)[:4]}: {e}")
+                    hedge_budget.refund()
+            continue
+        running -= 1
+        if ok:
+            cancel.set()
+            if hedge:
+                hedge_budget.on_win()
+            note_gemini_model(value[1])
+            return value[0]
+        last_exc = value
+        if running == 0 and launch(False):
+            running = 1
+    raise RuntimeError(f"Gemini failed after rotations. Last error: {last_exc}")
+
+def execute_gemini_action(action_callback, kind="text"):
+    if HEDGE_ENABLED:
+        return _execute_hedged(action_callback, kind)
+    ok, result, last_exc = _run_with_rotator(flash_rotator, GEMINI_MODEL_FLASH, "Flash", kind, action_callback)
+    if ok:
+        note_gemini_model(GEMINI_MODEL_FLASH)
+        return result
+    if flash_lite_rotator.keys:
+        ok, result, lite_exc = _run_with_rotator(flash_lite_rotator, GEMINI_MODEL_FLASH_LITE, "Flash-Lite", kind, action_callback)
+        if ok:
+            note_gemini_model(GEMINI_MODEL_FLASH_LITE)
+            return result
+        last_exc = lite_exc or last_exc
     raise RuntimeError(f"Gemini failed after rotations. Last error: {last_exc}")
 
-def ask_gemini(text, instruction):
+def ask_gemini(text, instruction, generation_config=None):
     if not flash_rotator.keys and not flash_lite_rotator.keys:
         raise RuntimeError("GEMINI_KEY(s) not configured")
     def perform(key, model):
         payload = {"contents": [{"parts": [{"text": f"{instruction}\n\n{text}"}]}]}
+        if generation_config:
+            payload["generationConfig"] = generation_config
+        sink = gemini_stream_sink.get()
+        if sink is not None:
+            return gemini_stream_call(model, payload, key, sink)
         data = gemini_api_call(f"models/{model}:generateContent", payload, key)
         try:
             return data["candidates"][0]["content"]["parts"][0]["text"]
@@ -193,11 +1322,134 @@ def ask_gemini(text, instruction):
             raise RuntimeError("Unexpected Gemini response")
     return execute_gemini_action(perform)
 
-def transcribe_media_gemini(file_url, mime_type, target_lang_label):
-    if not flash_rotator.keys and not flash_lite_rotator.keys:
-        raise RuntimeError("GEMINI_KEY not configured")
-    file_content = requests.get(file_url, timeout=REQUEST_TIMEOUT).content
-    b64_data = base64.b64encode(file_content).decode('utf-8')
+def _ask_and_cache(cache_key, text, instruction):
+    with track_gemini_models() as used:
+        res = ask_gemini(text, instruction)
+    if res and answered_by_primary(used):
+        text_cache.put(cache_key, res)
+    return res
+
+def cached_ask_gemini(text, instruction):
+    cache_key = text_cache_key(text, instruction)
+    res = text_cache.get(cache_key)
+    if res is not None:
+        return res
+    return text_flights.do(cache_key, _ask_and_cache, cache_key, text, instruction)
+
+def split_paragraphs(text, max_chars=SUMMARY_CHUNK_CHARS):
+    pieces = []
+    for para in re.split(r"\n\s*\n", text):
+        para = para.strip()
+        while len(para) > max_chars:
+            cut = max_chars
+            for sep in ("\n", ". ", " "):
+                at = para.rfind(sep, 0, max_chars)
+                if at > max_chars // 2:
+                    cut = at + 1
+                    break
+            pieces.append(para[:cut].strip())
+            para = para[cut:].strip()
+        if para:
+            pieces.append(para)
+    chunks = []
+    current = ""
+    for para in pieces:
+        if current and len(current) + len(para) + 2 > max_chars:
+            chunks.append(current)
+            current = para
+        else:
+            current = f"{current}\n\n{para}" if current else para
+    if current:
+        chunks.append(current)
+    return chunks
+
+def summary_map_instruction(lang_label):
+    return f"Summarize this part of a longer transcript in {lang_label}. Keep every key point, name, number and decision. No extra text — return only the summary."
+
+def summary_reduce_instruction(prompt_instr):
+    return f"The text below joins summaries of consecutive parts of one long transcript. Treat it as a single document.\n{prompt_instr}"
+
+summary_lock = threading.Lock()
+summary_stats = {"direct": 0, "map_reduce": 0, "map_chunks": 0, "map_levels": 0}
+
+def _count_summary(**counts):
+    with summary_lock:
+        for name, value in counts.items():
+            summary_stats[name] += value
+
+def map_reduce_summarize(text, prompt_instr, map_instr):
+    if len(text) <= SUMMARY_MAP_THRESHOLD:
+        _count_summary(direct=1)
+        return cached_ask_gemini(text, prompt_instr)
+    _count_summary(map_reduce=1)
+    with ThreadPoolExecutor(max_workers=max(1, SUMMARY_WORKERS)) as pool:
+        for _ in range(max(1, SUMMARY_MAX_LEVELS)):
+            chunks = split_paragraphs(text)
+            _count_summary(map_chunks=len(chunks), map_levels=1)
+            shorter = "\n\n".join(pool.map(lambda chunk: cached_ask_gemini(chunk, map_instr).strip(), chunks))
+            if len(shorter) >= len(text):
+                break
+            text = shorter
+            if len(text) <= SUMMARY_MAP_THRESHOLD:
+                break
+    return cached_ask_gemini(text, summary_reduce_instruction(prompt_instr))
+
+def translate_instruction(lang_label):
+    return f"Translate this text in to language {lang_label}. No extra text ONLY return the translated text."
+
+def translate_group_instruction(codes):
+    langs = ", ".join(f"{code} ({LANG_MAP.get(code, code)})" for code in codes)
+    return f"Translate this text into each of these languages: {langs}. Return ONLY a JSON object whose keys are the language codes and whose values are the complete translated text."
+
+def translate_groups(text, codes):
+    size = TRANSLATE_GROUP_SIZE if len(text) <= TRANSLATE_GROUP_MAX_CHARS else 1
+    size = max(1, size)
+    return [codes[i:i + size] for i in range(0, len(codes), size)]
+
+def parse_group_translation(raw, codes):
+    m = re.search(r"\{.*\}", raw or "", re.S)
+    try:
+        out = json.loads(m.group(0)) if m else {}
+    except ValueError:
+        out = {}
+    if not isinstance(out, dict):
+        return {}
+    return {code: out[code] for code in codes if isinstance(out.get(code), str) and out[code].strip()}
+
+def _translate_group(text, codes):
+    results = {}
+    if len(codes) > 1:
+        with track_gemini_models() as used:
+            results = parse_group_translation(ask_gemini(text, translate_group_instruction(codes), {"responseMimeType": "application/json"}), codes)
+        if answered_by_primary(used):
+            for code, res in results.items():
+                text_cache.put(text_cache_key(text, translate_instruction(LANG_MAP.get(code, code))), res)
+    for code in codes:
+        if code not in results:
+            results[code] = cached_ask_gemini(text, translate_instruction(LANG_MAP.get(code, code)))
+    return results
+
+def translate_fanout(text, codes):
+    todo = []
+    for code in codes:
+        res = text_cache.get(text_cache_key(text, translate_instruction(LANG_MAP.get(code, code))))
+        if res is None:
+            todo.append(code)
+        else:
+            yield code, res, None
+    if not todo:
+        return
+    with ThreadPoolExecutor(max_workers=max(1, TRANSLATE_WORKERS)) as pool:
+        futures = {pool.submit(_translate_group, text, group): group for group in translate_groups(text, todo)}
+        for fut in as_completed(futures):
+            try:
+                for code, res in fut.result().items():
+                    yield code, res, None
+            except Exception as e:
+                for code in futures[fut]:
+                    yield code, None, e
+
+def build_transcribe_prompt(target_lang_label):
     if target_lang_label:
         prompt = f"""Transcribe the audio accurately and translate to {target_lang_label}.
 Formatting rules:
@@ -226,116 +1478,789 @@ Formatting rules:
 - Do NOT add explanations
 Return ONLY the final formatted transcription.
 """
-    def perform(key, model):
-        payload = {
-            "contents": [{
-                "parts": [
-                    {"text": prompt},
-                    {
-                        "inline_data": {
-                            "mime_type": mime_type,
-                            "data": b64_data
-                        }
-                    }
-                ]
-            }]
-        }
-        data = gemini_api_call(f"models/{model}:generateContent", payload, key)
-        try:
-            return data["candidates"][0]["content"]["parts"][0]["text"]
-        except Exception as e:
-            raise RuntimeError(f"Gemini Transcription Error: {e}")
-    return execute_gemini_action(perform)
+    return prompt
 
-def build_action_keyboard(text_len):
-    btns = []
-    if text_len > 1000:
-        btns.append([InlineKeyboardButton("Get Summarize", callback_data="summarize_menu|")])
-    return InlineKeyboardMarkup(btns)
+def ffmpeg_available():
+    return bool(shutil.which(FFMPEG_BINARY))
 
-def build_lang_keyboard(origin):
-    btns, row = [], []
-    for i, (lbl, code) in enumerate(LANGS, 1):
-        row.append(InlineKeyboardButton(lbl, callback_data=f"lang|{code}|{lbl}|{origin}"))
-        if i % 3 == 0:
-            btns.append(row)
-            row = []
-    if row:
-        btns.append(row)
-    return InlineKeyboardMarkup(btns)
+def probe_silences(path, min_silence=SILENCE_MIN_SECONDS):
+    cmd = [FFMPEG_BINARY, "-hide_banner", "-nostats", "-i", path, "-vn", "-af", f"silencedetect=noise={SILENCE_NOISE_DB}dB:d={min_silence}", "-f", "null", "-"]
+    proc = subprocess.run(cmd, capture_output=True, text=True, timeout=REQUEST_TIMEOUT)
+    duration = 0.0
+    silences = []
+    start = None
+    for line in proc.stderr.splitlines():
+        m = re.search(r"Duration: (\d+):(\d+):([\d.]+)", line)
+        if m:
+            duration = int(m.group(1)) * 3600 + int(m.group(2)) * 60 + float(m.group(3))
+            continue
+        m = re.search(r"silence_start: (-?[\d.]+)", line)
+        if m:
+            start = max(0.0, float(m.group(1)))
+            continue
+        m = re.search(r"silence_end: ([\d.]+)", line)
+        if m and start is not None:
+            silences.append((start, float(m.group(1))))
+            start = None
+    if start is not None and duration:
+        silences.append((start, duration))
+    return duration, silences
 
-def build_summarize_keyboard(origin):
-    btns = [
-        [InlineKeyboardButton("Short", callback_data=f"summopt|Short|{origin}")],
-        [InlineKeyboardButton("Detailed", callback_data=f"summopt|Detailed|{origin}")],
-        [InlineKeyboardButton("Bulleted", callback_data=f"summopt|Bulleted|{origin}")]
-    ]
-    return InlineKeyboardMarkup(btns)
+def plan_segments(duration, silences, target=SEGMENT_SECONDS, overlap=SEGMENT_OVERLAP):
+    segments = []
+    seg_start = 0.0
+    seg_overlap = False
+    pos = 0.0
+    while duration - pos > target * 1.25:
+        ideal = pos + target
+        best = None
+        for s_start, s_end in silences:
+            mid = (s_start + s_end) / 2
+            if pos + target * 0.6 <= mid <= pos + target * 1.25 and (best is None or abs(mid - ideal) < abs(best - ideal)):
+                best = mid
+        cut = best if best is not None else ideal
+        segments.append((seg_start, cut, seg_overlap))
+        seg_overlap = best is None
+        seg_start = cut - overlap if seg_overlap else cut
+        pos = cut
+    segments.append((seg_start, duration, seg_overlap))
+    return segments
 
-def ensure_joined(message):
-    if not REQUIRED_CHANNEL:
-        return True
+def extract_segment(path, start, end):
+    out = tempfile.NamedTemporaryFile(dir=DOWNLOADS_DIR, suffix=".mp3")
+    cmd = [FFMPEG_BINARY, "-hide_banner", "-loglevel", "error", "-ss", f"{start:.3f}", "-t", f"{end - start:.3f}", "-i", path, "-vn", "-ac", "1", "-ar", "16000", "-b:a", "32k", "-f", "mp3", "-y", out.name]
     try:
-        if bot.get_chat_member(REQUIRED_CHANNEL, message.from_user.id).status in ['member', 'administrator', 'creator']:
-            return True
+        subprocess.run(cmd, check=True, capture_output=True, timeout=REQUEST_TIMEOUT)
     except:
-        pass
-    clean = REQUIRED_CHANNEL.replace("@", "")
-    kb = InlineKeyboardMarkup([[InlineKeyboardButton("🔗 Join", url=f"https://t.me/{clean}")]])
-    bot.reply_to(message, "First, join my channel and come back 👍", reply_markup=kb)
-    return False
+        out.close()
+        raise
+    return MediaSpool(out, os.fstat(out.fileno()).st_size)
 
-@bot.message_handler(commands=['start', 'help'])
-def send_welcome(message):
-    if ensure_joined(message):
-        welcome_text = (
-            "👋 Salaam!\n"
-            "• Send me\n"
-            "• voice message\n"
-            "• audio file\n"
-            "• video\n"
-            "• to transcribe for free\n\n"
-            "This bot is not good. For best quality, use @MediaToTextBot"
-        )
-        kb = build_lang_keyboard("file")
-        bot.reply_to(message, welcome_text, reply_markup=kb, parse_mode="Markdown")
+def merge_overlap(prev, nxt, max_words=40):
+    norm = lambda w: re.sub(r"\W+", "", w.lower())
+    tail = [norm(w) for w in prev.split()[-max_words:]]
+    head = list(re.finditer(r"\S+", nxt))[:max_words]
+    words = [norm(m.group(0)) for m in head]
+    for n in range(min(len(tail), len(words)), 1, -1):
+        if tail[-n:] == words[:n]:
+            return nxt[head[n - 1].end():].lstrip()
+    return nxt
 
-@bot.message_handler(commands=['mode'])
-def choose_mode(message):
-    if ensure_joined(message):
-        kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton("💬 Split messages", callback_data="mode|Split messages")],
-            [InlineKeyboardButton("📄 Text File", callback_data="mode|Text File")]
-        ])
-        bot.reply_to(message, "How do I send you long transcripts?:", reply_markup=kb)
+normalize_lock = threading.Lock()
+normalize_stats = {"transcoded": 0, "cache_hits": 0, "skipped": 0, "failed": 0, "bytes_in": 0, "bytes_out": 0}
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith('mode|'))
-def mode_cb(call):
-    if not ensure_joined(call.message):
-        return
-    mode = call.data.split("|")[1]
-    user_mode[call.from_user.id] = mode
-    try:
-        bot.edit_message_text(f"you choosed: {mode}", call.message.chat.id, call.message.message_id, reply_markup=None)
-    except:
-        pass
-    bot.answer_callback_query(call.id, f"Mode set to: {mode} ☑️")
+def _count_normalize(**counts):
+    with normalize_lock:
+        for name, value in counts.items():
+            normalize_stats[name] += value
 
-@bot.message_handler(commands=['lang'])
-def lang_command(message):
-    if ensure_joined(message):
-        kb = build_lang_keyboard("file")
-        bot.reply_to(message, "Select the language spoken in your audio or video:", reply_markup=kb)
+def normalized_path(file_unique_id):
+    return os.path.join(NORMALIZED_DIR, re.sub(r"[^A-Za-z0-9_-]", "", file_unique_id) + ".ogg")
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith('lang|'))
-def lang_cb(call):
-    _, code, lbl, origin = call.data.split("|")
-    if origin != "file":
+def _open_pinned(path):
+    with media_pin_lock:
         try:
-            bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=None)
-        except:
-            pass
-        process_text_action(call, origin, f"Translate to {lbl}", f"Translate this text in to language {lbl}. No extra text ONLY return the translated text.")
+            f = open(path, "rb")
+        except OSError:
+            return None
+        media_pins[path] += 1
+    return MediaSpool(f, os.fstat(f.fileno()).st_size, pinned=path)
+
+def _evict_normalized_cache():
+    entries = []
+    for entry in os.scandir(NORMALIZED_DIR):
+        if entry.is_file() and entry.name.endswith(".ogg"):
+            st = entry.stat()
+            entries.append((st.st_mtime, st.st_size, entry.path))
+    total = sum(e[1] for e in entries)
+    with media_pin_lock:
+        for _, size, path in sorted(entries):
+            if total <= NORMALIZED_CACHE_MAX_MB * 1024 * 1024:
+                break
+            if path in media_pins:
+                continue
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+def open_normalized(file_unique_id):
+    if not file_unique_id or not NORMALIZE_AUDIO:
+        return None
+    path = normalized_path(file_unique_id)
+    spool = _open_pinned(path)
+    if spool is None:
+        return None
+    os.utime(path, None)
+    _count_normalize(cache_hits=1)
+    return spool
+
+def normalize_audio(spool, duration=0, file_unique_id=None):
+    if not NORMALIZE_AUDIO or spool.size < NORMALIZE_MIN_BYTES or not ffmpeg_available():
+        return None
+    if duration and duration * NORMALIZE_BITRATE_KBPS * 125 >= spool.size * NORMALIZE_MAX_RATIO:
+        _count_normalize(skipped=1)
+        return None
+    progress_board.report("Normalizing")
+    fd, tmp_path = tempfile.mkstemp(dir=NORMALIZED_DIR, suffix=".tmp")
+    os.close(fd)
+    cmd = [FFMPEG_BINARY, "-hide_banner", "-loglevel", "error", "-i", spool.file.name, "-map", "0:a:0", "-vn", "-ac", "1", "-ar", "16000", "-c:a", "libopus", "-b:a", f"{NORMALIZE_BITRATE_KBPS}k", "-application", "voip", "-f", "ogg", "-y", tmp_path]
+    try:
+        with stage_metrics.timer("normalize"):
+            subprocess.run(cmd, check=True, capture_output=True, timeout=REQUEST_TIMEOUT)
+        size = os.path.getsize(tmp_path)
+    except Exception as e:
+        logging.warning(f"Audio normalization failed: {e}")
+        _count_normalize(failed=1)
+        os.remove(tmp_path)
+        return None
+    if not size or size >= spool.size * NORMALIZE_MAX_RATIO:
+        _count_normalize(skipped=1)
+        os.remove(tmp_path)
+        return None
+    _count_normalize(transcoded=1, bytes_in=spool.size, bytes_out=size)
+    if not file_unique_id:
+        return MediaSpool(open(tmp_path, "rb"), size, remove_path=tmp_path)
+    path = normalized_path(file_unique_id)
+    os.replace(tmp_path, path)
+    normalized = _open_pinned(path)
+    _evict_normalized_cache()
+    return normalized
+
+def fetch_media(file_url, mime_type, duration=0, file_unique_id=None):
+    spool = open_normalized(file_unique_id)
+    if spool is not None:
+        return spool, "audio/ogg"
+    spool = MediaSpool(*download_to_tempfile(file_url))
+    normalized = normalize_audio(spool, duration, file_unique_id)
+    if normalized is None:
+        return spool, mime_type
+    spool.release()
+    return normalized, "audio/ogg"
+
+class TimestampMap:
+    __slots__ = ("regions",)
+    def __init__(self, regions):
+        self.regions = []
+        offset = 0.0
+        for start, end in regions:
+            self.regions.append((offset, start, end))
+            offset += end - start
+    def to_original(self, t):
+        for trimmed_start, start, end in self.regions:
+            if t < trimmed_start + (end - start):
+                return start + max(0.0, t - trimmed_start)
+        return self.regions[-1][2] if self.regions else t
+
+def speech_regions(duration, silences, min_silence=VAD_MIN_SILENCE, padding=VAD_PADDING):
+    regions = []
+    pos = 0.0
+    for s_start, s_end in silences:
+        if s_end - s_start < min_silence:
+            continue
+        if s_start > pos:
+            regions.append((max(0.0, pos - padding), min(duration, s_start + padding)))
+        pos = max(pos, s_end)
+    if duration > pos:
+        regions.append((max(0.0, pos - padding), duration))
+    return [(a, b) for a, b in regions if b - a > 0.05]
+
+vad_lock = threading.Lock()
+vad_stats = {"files": 0, "skipped": 0, "silent": 0, "trimmed": 0, "seconds_in": 0.0, "seconds_out": 0.0}
+
+def _count_vad(**counts):
+    with vad_lock:
+        for name, value in counts.items():
+            vad_stats[name] += value
+
+def vad_trim(spool, duration_hint=0):
+    if not VAD_ENABLED or not ffmpeg_available():
+        return spool, duration_hint, None
+    short = spool.size < VAD_MIN_BYTES or 0 < duration_hint < VAD_MIN_SECONDS
+    progress_board.report("Detecting speech")
+    try:
+        with stage_metrics.timer("vad_probe"):
+            duration, silences = probe_silences(spool.file.name, VAD_MIN_SILENCE)
+    except Exception as e:
+        logging.warning(f"VAD probe failed: {e}")
+        return spool, duration_hint, None
+    duration = duration or duration_hint
+    if not duration:
+        return spool, duration_hint, None
+    regions = speech_regions(duration, silences)
+    speech = sum(b - a for a, b in regions)
+    logging.info(f"Speech ratio {speech / duration:.2f} ({speech:.1f}s of {duration:.1f}s)")
+    _count_vad(files=1, seconds_in=duration)
+    if not regions:
+        _count_vad(silent=1)
+        raise ValueError("No speech detected in this file")
+    if short:
+        _count_vad(skipped=1, seconds_out=duration)
+        return spool, duration, None
+    if speech > duration * (1 - VAD_MIN_SAVING) or len(regions) > VAD_MAX_REGIONS:
+        _count_vad(seconds_out=duration)
+        return spool, duration, None
+    expr = "+".join(f"between(t,{a:.3f},{b:.3f})" for a, b in regions)
+    fd, tmp_path = tempfile.mkstemp(dir=DOWNLOADS_DIR, suffix=".ogg")
+    os.close(fd)
+    cmd = [FFMPEG_BINARY, "-hide_banner", "-loglevel", "error", "-i", spool.file.name, "-map", "0:a:0", "-vn", "-af", f"aselect='{expr}',asetpts=N/SR/TB", "-ac", "1", "-ar", "16000", "-c:a", "libopus", "-b:a", f"{NORMALIZE_BITRATE_KBPS}k", "-application", "voip", "-f", "ogg", "-y", tmp_path]
+    try:
+        subprocess.run(cmd, check=True, capture_output=True, timeout=REQUEST_TIMEOUT)
+    except Exception as e:
+        logging.warning(f"VAD trim failed: {e}")
+        os.remove(tmp_path)
+        _count_vad(seconds_out=duration)
+        return spool, duration, None
+    _count_vad(trimmed=1, seconds_out=speech)
+    trimmed = MediaSpool(open(tmp_path, "rb"), os.path.getsize(tmp_path), remove_path=tmp_path)
+    spool.release()
+    return trimmed, speech, TimestampMap(regions)
+
+def _generate_from_spool(key, model, prompt, mime_type, spool):
+    payload = InlineMediaBody(prompt, mime_type, spool)
+    sink = gemini_stream_sink.get()
+    if sink is not None:
+        return gemini_stream_call(model, payload, key, sink)
+    data = gemini_api_call(f"models/{model}:generateContent", payload, key)
+    try:
+        return data["candidates"][0]["content"]["parts"][0]["text"]
+    except Exception as e:
+        raise RuntimeError(f"Gemini Transcription Error: {e}")
+
+segment_timings = collections.OrderedDict()
+segment_timings_lock = threading.Lock()
+segment_timings_bytes = 0
+
+def _timings_key(text):
+    return hashlib.sha256(text.encode('utf-8')).digest()
+
+def _timings_cost(spans):
+    return 96 + 32 * len(spans)
+
+def remember_segment_timings(text, timings):
+    global segment_timings_bytes
+    if not text or not timings:
+        return
+    spans = []
+    pos = 0
+    for start, end, piece in timings:
+        at = text.find(piece, pos)
+        if at < 0:
+            return
+        pos = at + len(piece)
+        spans.append((start, end, at, pos))
+    spans = tuple(spans)
+    key = _timings_key(text)
+    with segment_timings_lock:
+        old = segment_timings.pop(key, None)
+        if old is not None:
+            segment_timings_bytes -= _timings_cost(old)
+        segment_timings[key] = spans
+        segment_timings_bytes += _timings_cost(spans)
+        while segment_timings_bytes > SEGMENT_TIMINGS_MAX_BYTES and segment_timings:
+            _, evicted = segment_timings.popitem(last=False)
+            segment_timings_bytes -= _timings_cost(evicted)
+
+def lookup_segment_timings(text):
+    key = _timings_key(text)
+    with segment_timings_lock:
+        spans = segment_timings.get(key)
+    if spans is None:
+        return None
+    return [(start, end, text[a:b]) for start, end, a, b in spans]
+
+def plan_timings(plan, stitched, timestamp_map=None):
+    timings = []
+    for (start, end, _), piece in zip(plan, stitched):
+        if not piece:
+            continue
+        if timestamp_map is not None:
+            start, end = timestamp_map.to_original(start), timestamp_map.to_original(end)
+        timings.append((start, end, piece))
+    return timings
+
+def _transcribe_segment(path, start, end, prompt, timestamp_map=None, models_used=None):
+    gemini_models_used.set(models_used)
+    seg = extract_segment(path, start, end)
+    if timestamp_map is not None:
+        start, end = timestamp_map.to_original(start), timestamp_map.to_original(end)
+    try:
+        last_exc = None
+        for attempt in range(SEGMENT_RETRIES + 1):
+            try:
+                def perform(key, model):
+                    return _generate_from_spool(key, model, prompt, "audio/mp3", seg)
+                return execute_gemini_action(perform, kind="media")
+            except Exception as e:
+                last_exc = e
+                logging.warning(f"Segment {start:.0f}-{end:.0f}s attempt {attempt + 1} failed: {e}")
+        raise last_exc
+    finally:
+        seg.release()
+
+def transcribe_long_media(spool, prompt, duration_hint=0, on_partial=None, timestamp_map=None):
+    duration, silences = probe_silences(spool.file.name)
+    duration = duration or duration_hint
+    if duration < LONG_MEDIA_SECONDS:
+        return None
+    plan = plan_segments(duration, silences)
+    results = [None] * len(plan)
+    stitched = []
+    pool = ThreadPoolExecutor(max_workers=max(1, SEGMENT_WORKERS))
+    try:
+        used = gemini_models_used.get()
+        futures = {pool.submit(_transcribe_segment, spool.file.name, start, end, prompt, timestamp_map, used): i for i, (start, end, _) in enumerate(plan)}
+        done = 0
+        for fut in as_completed(futures):
+            i = futures[fut]
+            results[i] = (fut.result() or "").strip()
+            done += 1
+            progress_board.report("Transcribing segments", done, len(plan))
+            while len(stitched) < len(plan) and results[len(stitched)] is not None:
+                idx = len(stitched)
+                piece = results[idx]
+                if idx > 0 and plan[idx][2] and stitched[-1]:
+                    piece = merge_overlap(stitched[-1], piece)
+                stitched.append(piece)
+                if on_partial and piece:
+                    on_partial(piece)
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+    text = "\n\n".join(p for p in stitched if p)
+    remember_segment_timings(text, plan_timings(plan, stitched, timestamp_map))
+    return text
+
+def transcribe_media_gemini(file_url, mime_type, target_lang_label, duration=0, on_partial=None, file_unique_id=None):
+    if not flash_rotator.keys and not flash_lite_rotator.keys:
+        raise RuntimeError("GEMINI_KEY not configured")
+    prompt = build_transcribe_prompt(target_lang_label)
+    spool, mime_type = fetch_media(file_url, mime_type, duration, file_unique_id)
+    try:
+        trimmed, duration, timestamp_map = vad_trim(spool, duration)
+        if trimmed is not spool:
+            spool, mime_type = trimmed, "audio/ogg"
+        if ffmpeg_available() and (duration >= LONG_MEDIA_SECONDS or (not duration and spool.size >= LONG_MEDIA_PROBE_BYTES)):
+            text = transcribe_long_media(spool, prompt, duration, on_partial, timestamp_map)
+            if text is not None:
+                return text
+        def perform(key, model):
+            return _generate_from_spool(key, model, prompt, mime_type, spool)
+        text = execute_gemini_action(perform, kind="media")
+        if duration and text:
+            end = timestamp_map.to_original(duration) if timestamp_map is not None else duration
+            remember_segment_timings(text, [(0, end, text.strip())])
+        return text
+    finally:
+        spool.release()
+
+def get_file_url(file_id):
+    with stage_metrics.timer("telegram_get_file"):
+        file_info = bot.get_file(file_id)
+    return f"{TELEGRAM_API_URL}/file/bot{BOT_TOKEN}/{file_info.file_path}"
+
+def _transcribe_and_cache(cache_key, file_id, mime_type, lang_label, duration, on_partial, file_unique_id):
+    with track_gemini_models() as used:
+        text = transcribe_media_gemini(get_file_url(file_id), mime_type, lang_label, duration, on_partial, file_unique_id)
+    if text and answered_by_primary(used):
+        transcript_cache.put(cache_key, text)
+    return text
+
+def transcribe_file(cache_key, file_id, mime_type, lang_label, duration=0, on_partial=None, file_unique_id=None):
+    return transcription_flights.do(cache_key, _transcribe_and_cache, cache_key, file_id, mime_type, lang_label, duration, on_partial, file_unique_id)
+
+class PartialDelivery:
+    def __init__(self, chat_id, reply_id, uid):
+        self.chat_id = chat_id
+        self.reply_id = reply_id
+        self.uid = uid
+        self.enabled = user_mode.get(uid, "Split messages") == "Split messages"
+        self.sent = None
+        self.lock = threading.Lock()
+        self.owner = None
+        self.buffer = ""
+        self.shown = []
+        self.next_edit = 0
+        self.stream_failed = False
+    def push(self, text):
+        if self.enabled:
+            self.sent = send_long_text(self.chat_id, text, self.reply_id, self.uid)
+    @contextlib.contextmanager
+    def streaming(self):
+        if not (GEMINI_STREAMING and self.enabled):
+            yield
+            return
+        token = gemini_stream_sink.set(self)
+        try:
+            yield
+        finally:
+            gemini_stream_sink.reset(token)
+    def begin(self):
+        token = object()
+        with self.lock:
+            if self.owner is None:
+                self.owner = token
+                self.buffer = ""
+        return token
+    def abandon(self, token):
+        with self.lock:
+            if self.owner is token:
+                self.owner = None
+    def _due(self, token, piece):
+        if token is not self.owner or self.stream_failed:
+            return False
+        self.buffer += piece
+        now = time.time()
+        if now < self.next_edit:
+            return False
+        self.next_edit = now + STREAM_EDIT_INTERVAL
+        return True
+    def _stream_failed(self, e):
+        self.stream_failed = True
+        logging.warning(f"Stream delivery to {self.chat_id} failed, falling back to final send: {e}")
+    def _changes(self, text):
+        chunks = split_message(text)
+        return chunks, [(i, chunk) for i, chunk in enumerate(chunks) if i >= len(self.shown) or self.shown[i][1] != chunk]
+    def _settle(self, chunks, final):
+        stale = []
+        if final:
+            stale = self.shown[len(chunks):]
+            del self.shown[len(chunks):]
+        if self.shown:
+            self.sent = self.shown[-1][0]
+        return stale
+    def _reset(self, e):
+        logging.warning(f"Final stream delivery to {self.chat_id} failed, resending in full: {e}")
+        shown, self.shown, self.sent = self.shown, [], None
+        return shown
+    def stream(self, token, piece):
+        with self.lock:
+            if not self._due(token, piece):
+                return
+            try:
+                self._render(self.buffer, False)
+            except Exception as e:
+                self._stream_failed(e)
+    def _render(self, text, final):
+        chunks, changes = self._changes(text)
+        priority = PRIORITY_RESULT if final else PRIORITY_PROGRESS
+        for i, chunk in changes:
+            if not final and not outbound.acquire(self.chat_id, priority, block=False):
+                return
+            if i < len(self.shown):
+                msg = self.shown[i][0]
+                try:
+                    if final:
+                        outbound.call(self.chat_id, priority, bot.edit_message_text, chunk, self.chat_id, msg.message_id)
+                    else:
+                        bot.edit_message_text(chunk, self.chat_id, msg.message_id)
+                except Exception as e:
+                    logging.warning(f"Stream edit failed: {e}")
+                    if not final:
+                        return
+                self.shown[i][1] = chunk
+            else:
+                if final:
+                    msg = outbound.call(self.chat_id, priority, bot.send_message, self.chat_id, chunk, reply_to_message_id=self.reply_id)
+                else:
+                    msg = bot.send_message(self.chat_id, chunk, reply_to_message_id=self.reply_id)
+                self.shown.append([msg, chunk])
+        self._discard(self._settle(chunks, final))
+    def _discard(self, shown):
+        for msg, _ in shown:
+            try:
+                bot.delete_message(self.chat_id, msg.message_id)
+            except:
+                pass
+    def finish(self, text):
+        with self.lock:
+            self.owner = None
+            if self.shown:
+                try:
+                    self._render(text, True)
+                except Exception as e:
+                    self._discard(self._reset(e))
+        return self.sent
+
+def expire_jobs():
+    for job in job_queue.expire():
+        logging.info(f"Expired job {job['id']} for chat {job['chat_id']} ({job['state']})")
+
+def build_action_keyboard(text_len):
+    btns = []
+    if text_len > 1000:
+        btns.append([InlineKeyboardButton("Get Summarize", callback_data="summarize_menu|")])
+        btns.append([InlineKeyboardButton("Translate", callback_data="translate_menu|")])
+    return InlineKeyboardMarkup(btns)
+
+def build_translate_keyboard(origin, selected):
+    btns, row = [], []
+    for i, (lbl, code) in enumerate(LANGS, 1):
+        row.append(InlineKeyboardButton(f"✅ {lbl}" if code in selected else lbl, callback_data=f"tsel|{code}|{origin}"))
+        if i % 3 == 0:
+            btns.append(row)
+            row = []
+    if row:
+        btns.append(row)
+    btns.append([InlineKeyboardButton(f"🌐 Translate ({len(selected)})", callback_data=f"tgo|{origin}")])
+    return InlineKeyboardMarkup(btns)
+
+def toggle_translate_selection(chat_id, origin, code):
+    selected = translate_selections.pop((chat_id, origin), set())
+    selected ^= {code}
+    translate_selections[(chat_id, origin)] = selected
+    while len(translate_selections) > 1000:
+        translate_selections.pop(next(iter(translate_selections)))
+    return selected
+
+def build_lang_keyboard(origin):
+    btns, row = [], []
+    for i, (lbl, code) in enumerate(LANGS, 1):
+        row.append(InlineKeyboardButton(lbl, callback_data=f"lang|{code}|{lbl}|{origin}"))
+        if i % 3 == 0:
+            btns.append(row)
+            row = []
+    if row:
+        btns.append(row)
+    return InlineKeyboardMarkup(btns)
+
+def build_summarize_keyboard(origin):
+    btns = [
+        [InlineKeyboardButton("Short", callback_data=f"summopt|Short|{origin}")],
+        [InlineKeyboardButton("Detailed", callback_data=f"summopt|Detailed|{origin}")],
+        [InlineKeyboardButton("Bulleted", callback_data=f"summopt|Bulleted|{origin}")]
+    ]
+    return InlineKeyboardMarkup(btns)
+
+WELCOME_TEXT = (
+    "👋 Salaam!\n"
+    "• Send me\n"
+    "• voice message\n"
+    "• audio file\n"
+    "• video\n"
+    "• to transcribe for free\n\n"
+    "This bot is not good. For best quality, use @MediaToTextBot"
+)
+JOIN_TEXT = "First, join my channel and come back 👍"
+JOINED_TEXT = "Thanks for joining! Send me your audio or video 👍"
+LANG_PROMPT = "Select the language spoken in your audio or video:"
+MODE_PROMPT = "How do I send you long transcripts?:"
+EXPIRED_TEXT = "Data not found (expired). Resend file."
+DOCUMENT_CAPTION = "Open this file and copy the text inside 👍"
+
+def spoken_language_label(code):
+    return None if code == "auto" else LANG_MAP.get(code, code)
+
+def media_job(msg):
+    media = msg.get("voice") or msg.get("audio") or msg.get("video") or msg.get("document")
+    if not media:
+        return None
+    mime_type = "audio/mp3"
+    if msg.get("voice"): mime_type = "audio/ogg"
+    elif msg.get("audio"): mime_type = media.get("mime_type") or "audio/mp3"
+    elif msg.get("video"): mime_type = media.get("mime_type") or "video/mp4"
+    elif msg.get("document"):
+        mime_type = media.get("mime_type") or mimetypes.guess_type(media.get("file_name") or "")[0] or "audio/mp3"
+    return {"file_id": media["file_id"], "file_unique_id": media["file_unique_id"], "mime": mime_type, "duration": media.get("duration") or 0, "size": media.get("file_size") or 0, "message_id": msg["message_id"], "user_id": (msg.get("from") or {}).get("id")}
+
+def too_large_text(job):
+    if job["size"] > MAX_UPLOAD_SIZE:
+        return f"Just send me a file less than {MAX_UPLOAD_MB}MB 😎 or use @MediaToTextBot"
+    return None
+
+def queue_media_job(chat_id, job):
+    lang_code = user_selected_lang.get(chat_id)
+    expire_jobs()
+    job_queue.add(chat_id, job, lang_code)
+    return lang_code
+
+def select_file_language(chat_id, code):
+    user_selected_lang[chat_id] = code
+    return job_queue.release(chat_id, code)
+
+def summary_prompt(chat_id, style):
+    user_code = user_selected_lang.get(chat_id)
+    if user_code and user_code != "auto":
+        user_label = LANG_MAP.get(user_code, "English")
+    else:
+        user_label = "the original language"
+    if style == "Short":
+        prompt = f"Summarize this text in {user_label} in 1-2 concise sentences. No extra text — return only the summary."
+    elif style == "Detailed":
+        prompt = f"Summarize this text in {user_label} in a detailed paragraph preserving key points. No extra text — return only the summary."
+    else:
+        prompt = f"Summarize this text in {user_label} as a bulleted list of main points. No extra text — return only the summary."
+    return prompt, summary_map_instruction(user_label)
+
+def find_transcript(cq, origin_msg_id):
+    chat_id = cq["message"]["chat"]["id"]
+    try:
+        origin_id = int(origin_msg_id)
+    except:
+        origin_id = cq["message"]["message_id"]
+    data = user_transcriptions.get(chat_id, origin_id)
+    if not data and cq["message"].get("reply_to_message"):
+        data = user_transcriptions.get(chat_id, cq["message"]["reply_to_message"]["message_id"])
+    return data
+
+def selected_translate_codes(chat_id, origin):
+    selected = translate_selections.get((chat_id, origin)) or ()
+    return [code for _, code in LANGS if code in selected]
+
+class MembershipCache:
+    def __init__(self, ttl, negative_ttl, refresh_ahead, max_items):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.refresh_ahead = refresh_ahead
+        self.max_items = max_items
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.refreshing = set()
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.updates = 0
+        self.invalidations = 0
+    def get(self, uid):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(uid)
+            if entry is None or entry[1] <= now:
+                self.misses += 1
+                return None, False
+            self.entries.move_to_end(uid)
+            self.hits += 1
+            stale = entry[0] and entry[1] - now < self.refresh_ahead and uid not in self.refreshing
+            if stale:
+                self.refreshing.add(uid)
+                self.refreshes += 1
+            return entry[0], stale
+    def put(self, uid, is_member, from_update=False):
+        ttl = self.ttl if is_member else self.negative_ttl
+        with self.lock:
+            self.entries[uid] = (is_member, time.time() + ttl)
+            self.entries.move_to_end(uid)
+            self.refreshing.discard(uid)
+            if from_update:
+                self.updates += 1
+            while len(self.entries) > self.max_items:
+                self.entries.popitem(last=False)
+    def release(self, uid):
+        with self.lock:
+            self.refreshing.discard(uid)
+    def invalidate(self, uid):
+        with self.lock:
+            self.entries.pop(uid, None)
+            self.invalidations += 1
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "refreshes": self.refreshes,
+                "chat_member_updates": self.updates,
+                "invalidations": self.invalidations
+            }
+
+membership_cache = MembershipCache(MEMBERSHIP_TTL, MEMBERSHIP_NEGATIVE_TTL, MEMBERSHIP_REFRESH_AHEAD, MEMBERSHIP_MAX_ITEMS)
+
+def member_status_ok(status, is_member=False):
+    return status in ['member', 'administrator', 'creator'] or (status == 'restricted' and is_member)
+
+def is_required_channel(chat):
+    ref = REQUIRED_CHANNEL.lower()
+    return str(chat.get("id")) == ref or ("@" + (chat.get("username") or "")).lower() == ref
+
+def note_chat_member(upd):
+    if not REQUIRED_CHANNEL or not is_required_channel(upd.get("chat") or {}):
+        return
+    member = upd.get("new_chat_member") or {}
+    uid = (member.get("user") or {}).get("id")
+    if uid is not None:
+        membership_cache.put(uid, member_status_ok(member.get("status"), member.get("is_member")), from_update=True)
+
+def refresh_membership(uid):
+    try:
+        member = bot.get_chat_member(REQUIRED_CHANNEL, uid)
+        ok = member_status_ok(member.status, getattr(member, "is_member", False))
+    except Exception as e:
+        membership_cache.release(uid)
+        logging.warning(f"Membership check failed for {uid}: {e}")
+        return False
+    membership_cache.put(uid, ok)
+    return ok
+
+def is_channel_member(uid):
+    cached, stale = membership_cache.get(uid)
+    if cached is None:
+        return refresh_membership(uid)
+    if stale:
+        threading.Thread(target=refresh_membership, args=(uid,), daemon=True).start()
+    return cached
+
+def build_join_keyboard():
+    clean = REQUIRED_CHANNEL.replace("@", "")
+    return InlineKeyboardMarkup([[InlineKeyboardButton("🔗 Join", url=f"https://t.me/{clean}")], [InlineKeyboardButton("✅ I joined", callback_data="joined|")]])
+
+def ensure_joined(message):
+    if not REQUIRED_CHANNEL:
+        return True
+    if is_channel_member(message.from_user.id):
+        return True
+    outbound.call(message.chat.id, PRIORITY_RESULT, bot.reply_to, message, JOIN_TEXT, reply_markup=build_join_keyboard())
+    return False
+
+@bot.callback_query_handler(func=lambda c: c.data.startswith('joined|'))
+def joined_cb(call):
+    membership_cache.invalidate(call.from_user.id)
+    if is_channel_member(call.from_user.id):
+        try:
+            outbound.call(call.message.chat.id, PRIORITY_RESULT, bot.edit_message_text, JOINED_TEXT, call.message.chat.id, call.message.message_id, reply_markup=None)
+        except:
+            pass
+        bot.answer_callback_query(call.id, "☑️")
+    else:
+        bot.answer_callback_query(call.id, "You haven't joined yet", show_alert=True)
+
+@bot.message_handler(commands=['start', 'help'])
+def send_welcome(message):
+    if ensure_joined(message):
+        kb = build_lang_keyboard("file")
+        outbound.call(message.chat.id, PRIORITY_RESULT, bot.reply_to, message, WELCOME_TEXT, reply_markup=kb, parse_mode="Markdown")
+
+@bot.message_handler(commands=['mode'])
+def choose_mode(message):
+    if ensure_joined(message):
+        kb = build_mode_keyboard()
+        outbound.call(message.chat.id, PRIORITY_RESULT, bot.reply_to, message, MODE_PROMPT, reply_markup=kb)
+
+@bot.callback_query_handler(func=lambda c: c.data.startswith('mode|'))
+def mode_cb(call):
+    if not ensure_joined(call.message):
+        return
+    mode = set_user_mode(call.from_user.id, call.data)
+    try:
+        outbound.call(call.message.chat.id, PRIORITY_RESULT, bot.edit_message_text, f"you choosed: {mode}", call.message.chat.id, call.message.message_id, reply_markup=None)
+    except:
+        pass
+    bot.answer_callback_query(call.id, f"Mode set to: {mode} ☑️")
+
+@bot.message_handler(commands=['lang'])
+def lang_command(message):
+    if ensure_joined(message):
+        kb = build_lang_keyboard("file")
+        outbound.call(message.chat.id, PRIORITY_RESULT, bot.reply_to, message, LANG_PROMPT, reply_markup=kb)
+
+@bot.callback_query_handler(func=lambda c: c.data.startswith('lang|'))
+def lang_cb(call):
+    _, code, lbl, origin = call.data.split("|")
+    if origin != "file":
+        try:
+            bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=None)
+        except:
+            pass
+        process_text_action(call, origin, f"Translate to {lbl}", translate_instruction(lbl))
         return
     try:
         bot.delete_message(call.message.chat.id, call.message.message_id)
@@ -345,85 +2270,64 @@ def lang_cb(call):
         except:
             pass
     chat_id = call.message.chat.id
-    user_selected_lang[chat_id] = code
     bot.answer_callback_query(call.id, f"Language set: {lbl} ☑️")
-    pending = pending_files.pop(chat_id, None)
-    if not pending:
-        return
-    file_url = pending.get("url")
-    mime_type = pending.get("mime")
-    orig_msg = pending.get("message")
-    bot.send_chat_action(chat_id, 'typing')
-    progress_msg = None
-    progress_done_event = threading.Event()
-    progress_thread = None
+    if select_file_language(chat_id, code):
+        drain_chat_jobs(chat_id)
+
+def run_file_job(job):
+    chat_id = job["chat_id"]
+    code = job["lang"]
+    orig_msg_id = job.get("message_id")
+    cache_key = transcript_cache_key(job.get("file_unique_id"), code)
+    text = transcript_cache.get(cache_key)
     try:
-        if chat_id is not None and getattr(orig_msg, "id", None) is not None:
+        bot.send_chat_action(chat_id, 'typing')
+    except:
+        pass
+    progress = None
+    partial = None
+    error = None
+    try:
+        if text is None and orig_msg_id is not None:
+            progress = progress_board.start(chat_id, orig_msg_id)
+        lang_label = spoken_language_label(code)
+        if text is None:
+            partial = PartialDelivery(chat_id, orig_msg_id, job.get("user_id"))
+            started = time.time()
+            with partial.streaming():
+                text = transcribe_file(cache_key, job.get("file_id"), job.get("mime"), lang_label, job.get("duration", 0), partial.push, job.get("file_unique_id"))
+            if not text:
+                raise ValueError("Empty transcription")
+            job_cost_model.observe(job_cost_model.media_seconds(job.get("duration"), job.get("size")), time.time() - started)
+        progress_board.report("Sending")
+        sent = (partial.finish(text) if partial else None) or send_long_text(chat_id, text, orig_msg_id, job.get("user_id"))
+        if sent:
+            user_transcriptions.put(chat_id, sent.message_id, text, orig_msg_id)
             try:
-                bars = 12
-                bar_empty = "░"
-                progress_msg = bot.send_message(chat_id, f"Transcribing: 0% [{bar_empty * bars}]", reply_to_message_id=orig_msg.id)
-                def _progress_updater_thread(chat_id, progress_message_id, done_event, label="Transcribing"):
-                    percent = 0
-                    bars = 12
-                    bar_empty = "░"
-                    bar_full = "█"
-                    try:
-                        while not done_event.is_set():
-                            increment = random.randint(6, 14)
-                            percent = min(95, percent + increment)
-                            filled = int(percent * bars / 100)
-                            bar = bar_full * filled + bar_empty * (bars - filled)
-                            text = f"{label}: {percent}% [{bar}]"
-                            try:
-                                bot.edit_message_text(text, chat_id, progress_message_id)
-                            except:
-                                pass
-                            time.sleep(0.8)
-                        percent = 100
-                        bar = bar_full * bars
-                        final_text = f"{label}: {percent}% [{bar}] ✅"
-                        try:
-                            bot.edit_message_text(final_text, chat_id, progress_message_id)
-                        except:
-                            pass
-                        time.sleep(0.2)
-                        try:
-                            bot.delete_message(chat_id, progress_message_id)
-                        except:
-                            pass
-                    except:
-                        pass
-                progress_thread = threading.Thread(target=_progress_updater_thread, args=(chat_id, progress_msg.message_id, progress_done_event, "Transcribing"), daemon=True)
-                progress_thread.start()
+                bot.edit_message_reply_markup(chat_id, sent.message_id, reply_markup=build_action_keyboard(len(text)))
             except:
-                progress_msg = None
-        lang_label = None if code == "auto" else LANG_MAP.get(code, lbl)
-        text = transcribe_media_gemini(file_url, mime_type, lang_label)
-        if not text:
-            raise ValueError("Empty transcription")
-        sent = send_long_text(chat_id, text, orig_msg.id, orig_msg.from_user.id)
-        if sent:
-            user_transcriptions.setdefault(chat_id, {})[sent.message_id] = {"text": text, "origin": orig_msg.id}
-            if len(text) > 0:
-                try:
-                    bot.edit_message_reply_markup(chat_id, sent.message_id, reply_markup=build_action_keyboard(len(text)))
-                except:
-                    pass
+                pass
     except Exception as e:
-        bot.send_message(chat_id, f"❌ Error: {e}")
-    finally:
+        error = str(e) or e.__class__.__name__
         try:
-            progress_done_event.set()
-            if progress_thread:
-                progress_thread.join(timeout=1.0)
-            if progress_msg:
-                try:
-                    bot.delete_message(chat_id, progress_msg.message_id)
-                except:
-                    pass
+            outbound.call(chat_id, PRIORITY_RESULT, bot.send_message, chat_id, f"❌ Error: {e}", reply_to_message_id=orig_msg_id)
         except:
             pass
+    finally:
+        progress_board.finish(progress)
+        job_queue.finish(job["id"], error)
+
+def drain_chat_jobs(chat_id):
+    while True:
+        jobs = job_queue.claim(chat_id)
+        if not jobs:
+            return
+        for job in jobs:
+            run_file_job(job)
+
+def resume_jobs():
+    for chat_id in job_queue.recover():
+        media_dispatcher.submit(chat_id, drain_chat_jobs, chat_id)
 
 @bot.callback_query_handler(func=lambda c: c.data.startswith('summarize_menu|'))
 def action_cb(call):
@@ -446,165 +2350,432 @@ def summopt_cb(call):
         bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=None)
     except:
         pass
-    prompt = ""
-    chat_id = call.message.chat.id
-    user_code = user_selected_lang.get(chat_id)
-    if user_code and user_code != "auto":
-        user_label = LANG_MAP.get(user_code, "English")
-    else:
-        user_label = "the original language"
-    if style == "Short":
-        prompt = f"Summarize this text in {user_label} in 1-2 concise sentences. No extra text — return only the summary."
-    elif style == "Detailed":
-        prompt = f"Summarize this text in {user_label} in a detailed paragraph preserving key points. No extra text — return only the summary."
-    else:
-        prompt = f"Summarize this text in {user_label} as a bulleted list of main points. No extra text — return only the summary."
-    process_text_action(call, origin, f"Summarize ({style})", prompt)
+    prompt, map_instr = summary_prompt(call.message.chat.id, style)
+    process_text_action(call, origin, f"Summarize ({style})", prompt, map_instr)
 
-def process_text_action(call, origin_msg_id, log_action, prompt_instr):
-    chat_id = call.message.chat.id
+@bot.callback_query_handler(func=lambda c: c.data.startswith('translate_menu|'))
+def translate_menu_cb(call):
+    translate_selections.pop((call.message.chat.id, str(call.message.message_id)), None)
     try:
-        origin_id = int(origin_msg_id)
+        bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=build_translate_keyboard(call.message.message_id, set()))
+    except:
+        pass
+    bot.answer_callback_query(call.id, "Pick one or more languages")
+
+@bot.callback_query_handler(func=lambda c: c.data.startswith('tsel|'))
+def translate_select_cb(call):
+    _, code, origin = call.data.split("|")
+    selected = toggle_translate_selection(call.message.chat.id, origin, code)
+    try:
+        bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=build_translate_keyboard(origin, selected))
     except:
-        origin_id = call.message.message_id
-    data = user_transcriptions.get(chat_id, {}).get(origin_id)
+        pass
+    bot.answer_callback_query(call.id)
+
+@bot.callback_query_handler(func=lambda c: c.data.startswith('tgo|'))
+def translate_go_cb(call):
+    origin = call.data.split("|")[1]
+    chat_id = call.message.chat.id
+    codes = selected_translate_codes(chat_id, origin)
+    if not codes:
+        bot.answer_callback_query(call.id, "Pick at least one language", show_alert=True)
+        return
+    data = find_transcript(call.json, origin)
     if not data:
-        if call.message.reply_to_message:
-             data = user_transcriptions.get(chat_id, {}).get(call.message.reply_to_message.message_id)
+        bot.answer_callback_query(call.id, EXPIRED_TEXT, show_alert=True)
+        return
+    translate_selections.pop((chat_id, origin), None)
+    try:
+        bot.edit_message_reply_markup(chat_id, call.message.message_id, reply_markup=build_action_keyboard(len(data["text"])))
+    except:
+        pass
+    bot.answer_callback_query(call.id, f"Translating into {len(codes)} languages...")
+    bot.send_chat_action(chat_id, 'typing')
+    for code, res, err in translate_fanout(data["text"], codes):
+        lbl = LANG_MAP.get(code, code)
+        try:
+            if err is not None:
+                outbound.call(chat_id, PRIORITY_RESULT, bot.send_message, chat_id, f"Error ({lbl}): {err}")
+            else:
+                send_long_text(chat_id, f"{lbl}\n\n{res}", data["origin"], call.from_user.id, f"Translate to {lbl}")
+        except Exception as e:
+            logging.warning(f"Translation delivery failed: {e}")
+
+def process_text_action(call, origin_msg_id, log_action, prompt_instr, map_instr=None):
+    chat_id = call.message.chat.id
+    data = find_transcript(call.json, origin_msg_id)
     if not data:
-        bot.answer_callback_query(call.id, "Data not found (expired). Resend file.", show_alert=True)
+        bot.answer_callback_query(call.id, EXPIRED_TEXT, show_alert=True)
         return
     text = data["text"]
     bot.answer_callback_query(call.id, "Processing...")
     bot.send_chat_action(chat_id, 'typing')
     try:
-        res = ask_gemini(text, prompt_instr)
-        send_long_text(chat_id, res, data["origin"], call.from_user.id, log_action)
+        reply = PartialDelivery(chat_id, data["origin"], call.from_user.id)
+        with reply.streaming():
+            res = map_reduce_summarize(text, prompt_instr, map_instr) if map_instr else cached_ask_gemini(text, prompt_instr)
+        if not reply.finish(res):
+            send_long_text(chat_id, res, data["origin"], call.from_user.id, log_action)
     except Exception as e:
-        bot.send_message(chat_id, f"Error: {e}")
+        outbound.call(chat_id, PRIORITY_RESULT, bot.send_message, chat_id, f"Error: {e}")
 
 @bot.message_handler(content_types=['voice', 'audio', 'video', 'document'])
 def handle_media(message):
     if not ensure_joined(message):
         return
-    media = message.voice or message.audio or message.video or message.document
-    if not media:
+    job = media_job(message.json)
+    if not job:
         return
-    if getattr(media, 'file_size', 0) > MAX_UPLOAD_SIZE:
-        bot.reply_to(message, f"Just send me a file less than {MAX_UPLOAD_MB}MB 😎 or use @MediaToTextBot")
+    too_large = too_large_text(job)
+    if too_large:
+        outbound.call(message.chat.id, PRIORITY_RESULT, bot.reply_to, message, too_large)
         return
-    mime_type = "audio/mp3"
-    if message.voice: mime_type = "audio/ogg"
-    elif message.audio: mime_type = message.audio.mime_type or "audio/mp3"
-    elif message.video: mime_type = message.video.mime_type or "video/mp4"
-    elif message.document:
-        mime_type = message.document.mime_type or mimetypes.guess_type(message.document.file_name)[0] or "audio/mp3"
     notify_admin(message, "file")
     bot.send_chat_action(message.chat.id, 'typing')
     try:
-        file_info = bot.get_file(media.file_id)
-        telegram_file_url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file_info.file_path}"
-        lang_code = user_selected_lang.get(message.chat.id)
-        if not lang_code:
-            pending_files[message.chat.id] = {"url": telegram_file_url, "mime": mime_type, "message": message}
+        if not queue_media_job(message.chat.id, job):
             kb = build_lang_keyboard("file")
-            bot.reply_to(message, "Select the language spoken in your audio or video:", reply_markup=kb)
+            outbound.call(message.chat.id, PRIORITY_RESULT, bot.reply_to, message, LANG_PROMPT, reply_markup=kb)
             return
-        progress_msg = None
-        progress_done_event = threading.Event()
-        progress_thread = None
-        try:
-            if message.chat.id is not None and getattr(message, "id", None) is not None:
-                try:
-                    bars = 12
-                    bar_empty = "░"
-                    progress_msg = bot.send_message(message.chat.id, f"Transcribing: 0% [{bar_empty * bars}]", reply_to_message_id=message.id)
-                    def _progress_updater_thread(chat_id, progress_message_id, done_event, label="Transcribing"):
-                        percent = 0
-                        bars = 12
-                        bar_empty = "░"
-                        bar_full = "█"
-                        try:
-                            while not done_event.is_set():
-                                increment = random.randint(6, 14)
-                                percent = min(95, percent + increment)
-                                filled = int(percent * bars / 100)
-                                bar = bar_full * filled + bar_empty * (bars - filled)
-                                text = f"{label}: {percent}% [{bar}]"
-                                try:
-                                    bot.edit_message_text(text, chat_id, progress_message_id)
-                                except:
-                                    pass
-                                time.sleep(0.8)
-                            percent = 100
-                            bar = bar_full * bars
-                            final_text = f"{label}: {percent}% [{bar}] ✅"
-                            try:
-                                bot.edit_message_text(final_text, chat_id, progress_message_id)
-                            except:
-                                pass
-                            time.sleep(0.2)
-                            try:
-                                bot.delete_message(chat_id, progress_message_id)
-                            except:
-                                pass
-                        except:
-                            pass
-                    progress_thread = threading.Thread(target=_progress_updater_thread, args=(message.chat.id, progress_msg.message_id, progress_done_event, "Transcribing"), daemon=True)
-                    progress_thread.start()
-                except:
-                    progress_msg = None
-            lang_label = None if lang_code == "auto" else LANG_MAP.get(lang_code, lang_code)
-            text = transcribe_media_gemini(telegram_file_url, mime_type, lang_label)
-            if not text:
-                raise ValueError("Empty response")
-            sent = send_long_text(message.chat.id, text, message.id, message.from_user.id)
-            if sent:
-                user_transcriptions.setdefault(message.chat.id, {})[sent.message_id] = {"text": text, "origin": message.id}
-                if len(text) > 0:
-                    try:
-                        bot.edit_message_reply_markup(message.chat.id, sent.message_id, reply_markup=build_action_keyboard(len(text)))
-                    except:
-                        pass
-        finally:
-            try:
-                progress_done_event.set()
-                if progress_thread:
-                    progress_thread.join(timeout=1.0)
-                if progress_msg:
-                    try:
-                        bot.delete_message(message.chat.id, progress_msg.message_id)
-                    except:
-                        pass
-            except:
-                pass
+        drain_chat_jobs(message.chat.id)
     except Exception as e:
-        bot.reply_to(message, f"❌ Error: {e}")
+        outbound.call(message.chat.id, PRIORITY_RESULT, bot.reply_to, message, f"❌ Error: {e}")
 
-def send_long_text(chat_id, text, reply_id, uid, action="Transcript"):
-    mode = user_mode.get(uid, "Split messages")
-    if len(text) > MAX_MESSAGE_CHUNK:
-        if mode == "Split messages":
-            sent = None
-            for i in range(0, len(text), MAX_MESSAGE_CHUNK):
-                sent = bot.send_message(chat_id, text[i:i+MAX_MESSAGE_CHUNK], reply_to_message_id=reply_id)
-            return sent
-        else:
-            fname = os.path.join(DOWNLOADS_DIR, f"{action}.txt")
-            with open(fname, "w", encoding="utf-8") as f:
-                f.write(text)
-            sent = bot.send_document(chat_id, open(fname, 'rb'), caption="Open this file and copy the text inside 👍", reply_to_message_id=reply_id)
-            os.remove(fname)
-            return sent
-    return bot.send_message(chat_id, text, reply_to_message_id=reply_id)
+def render_export(text, fmt, timings=None):
+    if fmt == "json":
+        segments = [{"start": round(a, 3), "end": round(b, 3), "text": t} for a, b, t in timings or []]
+        return "json", json.dumps({"text": text, "segments": segments}, ensure_ascii=False, indent=2)
+    return "txt", text
 
-def _process_webhook_update(raw):
+def build_text_document(text, action, fmt="txt"):
+    timings = lookup_segment_timings(text) if fmt == "json" else None
+    ext, body = render_export(text, fmt, timings)
+    name = f"{action}.{ext}"
+    data = body.encode('utf-8')
+    if len(data) >= TEXT_FILE_COMPRESS_BYTES:
+        if TEXT_FILE_COMPRESSION == "gzip":
+            data, name = gzip.compress(data), name + ".gz"
+        elif TEXT_FILE_COMPRESSION == "zip":
+            buf = io.BytesIO()
+            with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
+                zf.writestr(name, data)
+            data, name = buf.getvalue(), f"{action}.zip"
+    return name, data
+
+def build_mode_keyboard():
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("💬 Split messages", callback_data="mode|Split messages")],
+        [InlineKeyboardButton("📄 Text File", callback_data="mode|Text File")],
+        [InlineKeyboardButton("🧾 JSON", callback_data="mode|Text File|json")]
+    ])
+
+def set_user_mode(uid, data):
+    parts = data.split("|")
+    mode = parts[1]
+    fmt = parts[2] if len(parts) > 2 and parts[2] == "json" else "txt"
+    user_mode[uid] = mode
+    user_file_format[uid] = fmt
+    return mode if fmt == "txt" else f"{mode} ({fmt.upper()})"
+
+def plan_long_text(text, uid, action):
+    if utf16_len(text) <= MAX_MESSAGE_CHUNK:
+        return [text], None
+    if user_mode.get(uid, "Split messages") == "Split messages":
+        return split_message(text), None
+    return None, build_text_document(text, action, user_file_format.get(uid, "txt"))
+
+def send_long_text(chat_id, text, reply_id, uid, action="Transcript"):
+    with stage_metrics.timer("send_long_text"):
+        chunks, document = plan_long_text(text, uid, action)
+        if document:
+            name, data = document
+            def send_doc():
+                return bot.send_document(chat_id, io.BytesIO(data), visible_file_name=name, caption=DOCUMENT_CAPTION, reply_to_message_id=reply_id)
+            return outbound.call(chat_id, PRIORITY_RESULT, send_doc)
+        sent = None
+        for chunk in chunks:
+            sent = outbound.call(chat_id, PRIORITY_RESULT, bot.send_message, chat_id, chunk, reply_to_message_id=reply_id)
+        return sent
+
+class UpdateDeduper:
+    def __init__(self, path, window, flush_interval):
+        self.window = window
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.db_lock = threading.Lock()
+        self.order = collections.deque()
+        self.seen = set()
+        self.added = []
+        self.removed = []
+        self.accepted = 0
+        self.duplicates = 0
+        self.released = 0
+        self.db = None
+        if path:
+            try:
+                self.db = sqlite3.connect(path, check_same_thread=False)
+                self.db.execute("CREATE TABLE IF NOT EXISTS seen_updates (update_id INTEGER PRIMARY KEY, seen REAL)")
+                self.db.commit()
+                rows = self.db.execute("SELECT update_id FROM seen_updates ORDER BY update_id DESC LIMIT ?", (window,)).fetchall()
+                for (update_id,) in reversed(rows):
+                    self.order.append(update_id)
+                    self.seen.add(update_id)
+            except Exception as e:
+                logging.warning(f"Update dedupe DB unavailable: {e}")
+                self.db = None
+        if self.db is not None:
+            threading.Thread(target=self._flush_loop, name="update-dedupe", daemon=True).start()
+    def claim(self, update_id):
+        with self.lock:
+            if update_id in self.seen:
+                self.duplicates += 1
+                return False
+            self.seen.add(update_id)
+            self.order.append(update_id)
+            self.added.append((update_id, time.time()))
+            self.accepted += 1
+            while len(self.order) > self.window:
+                self.seen.discard(self.order.popleft())
+            return True
+    def release(self, update_id):
+        with self.lock:
+            if update_id in self.seen:
+                self.seen.discard(update_id)
+                self.order.remove(update_id)
+                self.removed.append((update_id,))
+                self.released += 1
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+    def flush(self):
+        if self.db is None:
+            return
+        with self.lock:
+            added, self.added = self.added, []
+            removed, self.removed = self.removed, []
+            oldest = self.order[0] if self.order else None
+        if not added and not removed:
+            return
+        with self.db_lock:
+            try:
+                self.db.executemany("INSERT OR IGNORE INTO seen_updates (update_id, seen) VALUES (?, ?)", added)
+                self.db.executemany("DELETE FROM seen_updates WHERE update_id = ?", removed)
+                if oldest is not None:
+                    self.db.execute("DELETE FROM seen_updates WHERE update_id < ?", (oldest,))
+                self.db.commit()
+            except Exception as e:
+                logging.warning(f"Update dedupe flush failed: {e}")
+    def stats(self):
+        with self.lock:
+            return {"window": len(self.order), "accepted": self.accepted, "duplicates_dropped": self.duplicates, "released": self.released}
+
+update_deduper = UpdateDeduper(UPDATE_DEDUPE_DB, UPDATE_DEDUPE_WINDOW, UPDATE_DEDUPE_FLUSH)
+atexit.register(update_deduper.flush)
+
+def submit_once(raw, submit):
+    update_id = raw.get("update_id")
+    if update_id is None:
+        return submit()
+    if not update_deduper.claim(update_id):
+        logging.info(f"Dropping duplicate update {update_id}")
+        return True
+    if not submit():
+        update_deduper.release(update_id)
+        return False
+    return True
+
+class JobCostModel:
+    def __init__(self, base, rate, bytes_per_second):
+        self.base = base
+        self.rate = rate
+        self.bytes_per_second = bytes_per_second
+        self.lock = threading.Lock()
+        self.samples = 0
+    def media_seconds(self, duration, size):
+        return float(duration or 0) or (size / self.bytes_per_second if size else 0.0)
+    def estimate(self, media_seconds):
+        if not media_seconds:
+            return 0.0
+        return self.base + self.rate * media_seconds
+    def observe(self, media_seconds, elapsed):
+        if media_seconds < 1:
+            return
+        with self.lock:
+            self.rate = 0.9 * self.rate + 0.1 * (max(0.0, elapsed - self.base) / media_seconds)
+            self.samples += 1
+    def stats(self):
+        with self.lock:
+            return {"seconds_per_media_second": round(self.rate, 4), "samples": self.samples}
+
+job_cost_model = JobCostModel(SJF_BASE_COST, SJF_INITIAL_RATE, SJF_BYTES_PER_SECOND)
+
+def size_class(media_seconds):
+    if not media_seconds:
+        return "none"
+    if media_seconds < 60:
+        return "voice"
+    if media_seconds < 600:
+        return "short"
+    return "long"
+
+def update_media_seconds(upd):
+    msg = upd.get("message") or upd.get("edited_message") or upd.get("channel_post")
+    if msg:
+        media = msg.get("voice") or msg.get("audio") or msg.get("video") or msg.get("document")
+        if media:
+            return job_cost_model.media_seconds(media.get("duration"), media.get("file_size"))
+        return 0.0
+    cq = upd.get("callback_query") or {}
+    data = cq.get("data") or ""
+    if data.startswith("lang|") and data.endswith("|file"):
+        chat_id = ((cq.get("message") or {}).get("chat") or {}).get("id")
+        return sum(job_cost_model.media_seconds(job.get("duration"), job.get("size")) for job in job_queue.waiting(chat_id))
+    return 0.0
+
+def _percentiles(samples):
+    waits = sorted(samples)
+    if not waits:
+        return {"count": 0, "p50": 0.0, "p95": 0.0, "p99": 0.0}
+    pick = lambda pct: round(waits[min(len(waits) - 1, int(len(waits) * pct))], 3)
+    return {"count": len(waits), "p50": pick(0.5), "p95": pick(0.95), "p99": pick(0.99)}
+
+class UpdateDispatcher:
+    def __init__(self, name, workers, max_queue, shortest_first=False):
+        self.name = name
+        self.workers = max(1, workers)
+        self.max_queue = max_queue
+        self.shortest_first = shortest_first
+        self.cond = threading.Condition()
+        self.ready = []
+        self.seq = 0
+        self.chats = {}
+        self.active = set()
+        self.depth = 0
+        self.busy = 0
+        self.processed = 0
+        self.rejected = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.recent_waits = collections.deque(maxlen=1000)
+        self.class_waits = {}
+    def start(self):
+        for i in range(self.workers):
+            threading.Thread(target=self._worker, name=f"{self.name}-{i}", daemon=True).start()
+    def _make_ready(self, key):
+        enqueued_at, media_seconds = self.chats[key][0][:2]
+        rank = enqueued_at
+        if self.shortest_first:
+            rank += SJF_COST_WEIGHT * job_cost_model.estimate(media_seconds)
+        self.seq += 1
+        heapq.heappush(self.ready, (rank, self.seq, key))
+        self.cond.notify()
+    def submit(self, key, fn, *args, media_seconds=0.0):
+        with self.cond:
+            if self.depth >= self.max_queue:
+                self.rejected += 1
+                return False
+            q = self.chats.setdefault(key, collections.deque())
+            q.append((time.time(), media_seconds, fn, args))
+            self.depth += 1
+            if key not in self.active and len(q) == 1:
+                self._make_ready(key)
+            return True
+    def _worker(self):
+        while True:
+            with self.cond:
+                while not self.ready:
+                    self.cond.wait()
+                key = heapq.heappop(self.ready)[2]
+                q = self.chats[key]
+                enqueued_at, media_seconds, fn, args = q.popleft()
+                self.depth -= 1
+                self.active.add(key)
+                self.busy += 1
+                started = time.time()
+                waited = started - enqueued_at
+                self.wait_total += waited
+                self.wait_max = max(self.wait_max, waited)
+                self.recent_waits.append(waited)
+                cls = size_class(media_seconds)
+                self.class_waits.setdefault(cls, collections.deque(maxlen=1000)).append(waited)
+            stage_metrics.observe("dispatch_wait", waited, lane=self.name, size_class=cls)
+            try:
+                fn(*args)
+            except Exception as e:
+                logging.exception(f"{self.name} worker error: {e}")
+            finally:
+                with self.cond:
+                    self.active.discard(key)
+                    self.busy -= 1
+                    self.processed += 1
+                    if q:
+                        self._make_ready(key)
+                    else:
+                        self.chats.pop(key, None)
+    def stats(self):
+        with self.cond:
+            waits = sorted(self.recent_waits)
+            p95 = waits[int(len(waits) * 0.95) - 1] if waits else 0.0
+            return {
+                "shortest_first": self.shortest_first,
+                "wait_by_size": {cls: _percentiles(w) for cls, w in self.class_waits.items()},
+                "workers": self.workers,
+                "busy": self.busy,
+                "queue_depth": self.depth,
+                "queue_max": self.max_queue,
+                "chats_queued": len(self.chats),
+                "processed": self.processed,
+                "rejected": self.rejected,
+                "wait_avg": round(self.wait_total / self.processed, 3) if self.processed else 0.0,
+                "wait_p95": round(p95, 3),
+                "wait_max": round(self.wait_max, 3)
+            }
+
+media_dispatcher = UpdateDispatcher("media", WORKER_POOL_SIZE, DISPATCH_QUEUE_SIZE, shortest_first=SJF_ENABLED)
+fast_dispatcher = UpdateDispatcher("fast", FAST_LANE_WORKERS, FAST_LANE_QUEUE_SIZE)
+
+if SERVE_MODE != "async":
+    media_dispatcher.start()
+    fast_dispatcher.start()
+    progress_board.run_in_thread()
+
+def _route_update(upd):
+    msg = upd.get("message") or upd.get("edited_message") or upd.get("channel_post")
+    if msg:
+        chat_id = (msg.get("chat") or {}).get("id")
+        if any(k in msg for k in ("voice", "audio", "video", "document")):
+            return media_dispatcher, chat_id
+        return fast_dispatcher, chat_id
+    cq = upd.get("callback_query")
+    if cq:
+        chat_id = ((cq.get("message") or {}).get("chat") or {}).get("id") or (cq.get("from") or {}).get("id")
+        data = cq.get("data") or ""
+        if data.startswith("lang|") or data.startswith("summopt|") or data.startswith("tgo|"):
+            return media_dispatcher, chat_id
+        return fast_dispatcher, chat_id
+    return fast_dispatcher, upd.get("update_id")
+
+def _process_webhook_update(raw):
     try:
-        upd = Update.de_json(raw.decode('utf-8'))
+        upd = Update.de_json(raw)
         bot.process_new_updates([upd])
     except Exception as e:
         logging.exception(f"Error processing update: {e}")
 
+def dispatch_update(data):
+    try:
+        raw = json.loads(data.decode('utf-8'))
+    except Exception as e:
+        logging.warning(f"Invalid update payload: {e}")
+        return True
+    if "chat_member" in raw:
+        note_chat_member(raw["chat_member"])
+        return True
+    dispatcher, key = _route_update(raw)
+    media_seconds = update_media_seconds(raw) if dispatcher is media_dispatcher else 0.0
+    return submit_once(raw, lambda: dispatcher.submit(key, _process_webhook_update, raw, media_seconds=media_seconds))
+
 @flask_app.route("/", methods=["GET"])
 def index():
     return "Bot Running", 200
@@ -613,15 +2784,949 @@ def index():
 def webhook():
     if request.headers.get('content-type') == 'application/json':
         data = request.get_data()
-        threading.Thread(target=_process_webhook_update, args=(data,), daemon=True).start()
+        if not dispatch_update(data):
+            return '', 429, {"Retry-After": str(DISPATCH_RETRY_AFTER)}
         return '', 200
     abort(403)
 
+def stats_body():
+    body = {"fast": fast_dispatcher.stats(), "media": media_dispatcher.stats(), "http": http_metrics.stats(http_session), "transcript_cache": transcript_cache.stats(), "transcription_flights": transcription_flights.stats(), "text_cache": text_cache.stats(), "text_flights": text_flights.stats(), "summaries": dict(summary_stats), "transcripts": user_transcriptions.stats(), "jobs": job_queue.stats(), "progress": progress_board.stats(), "outbound": outbound.stats(), "membership": membership_cache.stats(), "updates": update_deduper.stats(), "job_cost": job_cost_model.stats(), "keys": {"flash": flash_rotator.stats(), "flash_lite": flash_lite_rotator.stats()}, "hedging": hedge_budget.stats(), "normalize": dict(normalize_stats), "vad": dict(vad_stats)}
+    if SERVE_MODE == "async":
+        body["async"] = async_dispatcher.stats()
+        body["transcription_flights"] = async_flights.stats()
+    return body
+
+def metrics_text():
+    gauges = [
+        ("jobs_in_flight", (("lane", "media"),), media_dispatcher.busy),
+        ("jobs_in_flight", (("lane", "fast"),), fast_dispatcher.busy),
+        ("dispatch_queue_depth", (("lane", "media"),), media_dispatcher.depth),
+        ("dispatch_queue_depth", (("lane", "fast"),), fast_dispatcher.depth),
+        ("pending_jobs", (), job_queue.pending()),
+        ("progress_jobs", (), len(progress_board.jobs))
+    ]
+    if SERVE_MODE == "async":
+        gauges.append(("jobs_in_flight", (("lane", "async"),), async_dispatcher.inflight))
+    transcripts = user_transcriptions.stats()
+    gauges.append(("user_transcriptions_entries", (), transcripts["entries"]))
+    gauges.append(("user_transcriptions_bytes", (), transcripts["bytes"]))
+    for name, cache in (("transcript", transcript_cache), ("text", text_cache)):
+        st = cache.stats()
+        gauges.append(("cache_hits", (("cache", name),), st["hits_memory"] + st["hits_disk"]))
+        gauges.append(("cache_misses", (("cache", name),), st["misses"]))
+    membership = membership_cache.stats()
+    gauges.append(("cache_hits", (("cache", "membership"),), membership["hits"]))
+    gauges.append(("cache_misses", (("cache", "membership"),), membership["misses"]))
+    for pool, rotator in (("flash", flash_rotator), ("flash-lite", flash_lite_rotator)):
+        for kid, st in rotator.stats().items():
+            gauges.append(("gemini_key_inflight", (("pool", pool), ("key", kid)), st["inflight"]))
+            gauges.append(("gemini_key_disabled_seconds", (("pool", pool), ("key", kid)), st["disabled_for"]))
+    return stage_metrics.render(gauges)
+
+@flask_app.route("/metrics", methods=["GET"])
+def metrics():
+    return metrics_text(), 200, {"Content-Type": "text/plain; version=0.0.4"}
+
+@flask_app.route("/stats", methods=["GET"])
+def stats():
+    return json.dumps(stats_body()), 200, {"Content-Type": "application/json"}
+
+async_http = None
+async_bot = None
+
+class TelegramError(Exception):
+    def __init__(self, error_code, description, retry_after=None):
+        super().__init__(f"Telegram API error {error_code}: {description}")
+        self.error_code = error_code
+        self.description = description
+        self.retry_after = retry_after
+
+class AsyncTelegram:
+    def __init__(self, token, session):
+        self.base = f"{TELEGRAM_API_URL}/bot{token}/"
+        self.file_base = f"{TELEGRAM_API_URL}/file/bot{token}/"
+        self.session = session
+    async def _result(self, resp):
+        data = await resp.json(content_type=None)
+        if not data.get("ok"):
+            raise TelegramError(data.get("error_code", resp.status), data.get("description", ""), (data.get("parameters") or {}).get("retry_after"))
+        return data["result"]
+    async def call(self, method, **params):
+        params = {k: v for k, v in params.items() if v is not None}
+        async with self.session.post(self.base + method, json=params) as resp:
+            return await self._result(resp)
+    async def send(self, chat_id, priority, send_fn, *args, **kwargs):
+        for attempt in range(outbound.retries + 1):
+            await outbound.acquire_async(chat_id, priority)
+            try:
+                result = await send_fn(*args, **kwargs)
+                outbound.on_sent()
+                return result
+            except TelegramError as e:
+                if e.error_code != 429 or attempt == outbound.retries:
+                    raise
+                outbound.penalize(chat_id, e.retry_after or 5)
+                outbound.on_retried()
+                logging.warning(f"Telegram 429 for chat {chat_id}, retrying in {e.retry_after}s")
+    async def send_document(self, chat_id, filename, content, caption=None, reply_to_message_id=None):
+        form = aiohttp.FormData()
+        form.add_field("chat_id", str(chat_id))
+        if caption:
+            form.add_field("caption", caption)
+        if reply_to_message_id:
+            form.add_field("reply_to_message_id", str(reply_to_message_id))
+        form.add_field("document", content, filename=filename)
+        async with self.session.post(self.base + "sendDocument", data=form) as resp:
+            return await self._result(resp)
+    async def file_url(self, file_id):
+        with stage_metrics.timer("telegram_get_file"):
+            info = await self.call("getFile", file_id=file_id)
+        return self.file_base + info["file_path"]
+
+class AsyncDispatcher:
+    def __init__(self, max_inflight):
+        self.max_inflight = max_inflight
+        self.inflight = 0
+        self.chats = {}
+        self.tasks = set()
+        self.processed = 0
+        self.rejected = 0
+        self.wait_max = 0.0
+        self.recent_waits = collections.deque(maxlen=1000)
+    def submit(self, key, fn, *args):
+        if self.inflight >= self.max_inflight:
+            self.rejected += 1
+            return False
+        self.inflight += 1
+        task = asyncio.ensure_future(self._run(key, time.time(), fn, args))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return True
+    async def _run(self, key, enqueued_at, fn, args):
+        slot = self.chats.setdefault(key, [asyncio.Lock(), 0])
+        slot[1] += 1
+        try:
+            async with slot[0]:
+                waited = time.time() - enqueued_at
+                self.wait_max = max(self.wait_max, waited)
+                self.recent_waits.append(waited)
+                try:
+                    await fn(*args)
+                except Exception as e:
+                    logging.exception(f"async handler error: {e}")
+        finally:
+            slot[1] -= 1
+            if not slot[1]:
+                self.chats.pop(key, None)
+            self.inflight -= 1
+            self.processed += 1
+    def stats(self):
+        waits = sorted(self.recent_waits)
+        p95 = waits[int(len(waits) * 0.95) - 1] if waits else 0.0
+        return {
+            "inflight": self.inflight,
+            "max_inflight": self.max_inflight,
+            "chats_active": len(self.chats),
+            "processed": self.processed,
+            "rejected": self.rejected,
+            "wait_p95": round(p95, 3),
+            "wait_max": round(self.wait_max, 3),
+            "threads": threading.active_count()
+        }
+
+async_dispatcher = AsyncDispatcher(ASYNC_MAX_INFLIGHT)
+
+class AsyncSingleFlight:
+    def __init__(self):
+        self.flights = {}
+        self.leaders = 0
+        self.coalesced = 0
+        self.shared_errors = 0
+    async def do(self, key, fn, *args):
+        fut = self.flights.get(key)
+        if fut is not None:
+            self.coalesced += 1
+            try:
+                return await asyncio.shield(fut)
+            except Exception:
+                self.shared_errors += 1
+                raise
+        fut = self.flights[key] = asyncio.get_running_loop().create_future()
+        self.leaders += 1
+        try:
+            result = await fn(*args)
+            fut.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            fut.cancel()
+            raise
+        except Exception as e:
+            fut.set_exception(e)
+            fut.exception()
+            raise
+        finally:
+            self.flights.pop(key, None)
+    def stats(self):
+        return {
+            "in_flight": len(self.flights),
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+            "shared_errors": self.shared_errors
+        }
+
+async_flights = AsyncSingleFlight()
+
+def _gemini_http_error(status, body):
+    resp = requests.Response()
+    resp.status_code = status
+    resp._content = body
+    return requests.exceptions.HTTPError(f"{status} Error from Gemini API", response=resp)
+
+async def _aiter_body(body):
+    chunks = iter(body)
+    try:
+        while True:
+            chunk = await asyncio.to_thread(next, chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+    finally:
+        chunks.close()
+
+async def async_gemini_api_call(endpoint, payload, key):
+    url = f"{GEMINI_API_BASE}/v1beta/{endpoint}?key={key}"
+    headers = {"Content-Type": "application/json"}
+    if isinstance(payload, InlineMediaBody):
+        headers["Content-Length"] = str(len(payload))
+        body = _aiter_body(payload)
+    else:
+        body = json.dumps(payload).encode('utf-8')
+    async with async_http.post(url, headers=headers, data=body) as resp:
+        raw = await resp.read()
+    if resp.status >= 400:
+        raise _gemini_http_error(resp.status, raw)
+    data = json.loads(raw)
+    return data, (data.get("usageMetadata") or {}).get("totalTokenCount", 0)
+
+async def async_gemini_stream_call(model, payload, key, sink):
+    url = f"{GEMINI_API_BASE}/v1beta/models/{model}:streamGenerateContent?alt=sse&key={key}"
+    headers = {"Content-Type": "application/json", "Accept": "text/event-stream"}
+    if isinstance(payload, InlineMediaBody):
+        headers["Content-Length"] = str(len(payload))
+        body = _aiter_body(payload)
+    else:
+        body = json.dumps(payload).encode('utf-8')
+    pieces = []
+    tokens = 0
+    async with async_http.post(url, headers=headers, data=body) as resp:
+        if resp.status >= 400:
+            raise _gemini_http_error(resp.status, await resp.read())
+        token = sink.begin()
+        try:
+            async for line in resp.content:
+                line = line.decode('utf-8').strip()
+                if not line.startswith("data:"):
+                    continue
+                chunk = json.loads(line[5:])
+                usage = chunk.get("usageMetadata")
+                if usage:
+                    tokens = usage.get("totalTokenCount", 0)
+                piece = stream_chunk_text(chunk)
+                if piece:
+                    pieces.append(piece)
+                    await sink.stream(token, piece)
+        except:
+            sink.abandon(token)
+            raise
+    if not pieces:
+        sink.abandon(token)
+        raise RuntimeError("Unexpected Gemini response")
+    return "".join(pieces), tokens
+
+async def _async_get_key(rotator, exclude, wait):
+    deadline = time.time() + wait
+    while True:
+        key = rotator.get_key(exclude=exclude)
+        if key or time.time() >= deadline or not rotator.any_available():
+            return key
+        await asyncio.sleep(0.25)
+
+async def _async_attempt(rotator, key, model, label, kind, action_callback, hedge=False):
+    if hedge:
+        progress_board.current.set(None)
+        gemini_stream_sink.set(None)
+    started = time.time()
+    try:
+        result, tokens = await action_callback(key, model)
+    except asyncio.CancelledError:
+        rotator.release(key)
+        record_gemini_outcome(label, key, model, kind, "cancelled", time.time() - started)
+        raise
+    except Exception as e:
+        code, scope, retry_after = classify_gemini_error(e)
+        rotator.mark_failure(key, reason_code=code, scope=scope, retry_after=retry_after)
+        record_gemini_outcome(label, key, model, kind, "rate_limited" if code == 429 else "error", time.time() - started)
+        logging.warning(f"{label} key error {key_id(key)}: {e}")
+        raise
+    latency = time.time() - started
+    rotator.mark_success(key, latency, tokens)
+    gemini_latency.record(kind, latency)
+    record_gemini_outcome(label, key, model, kind, "success", latency)
+    return result
+
+async def async_execute_gemini_action(action_callback, kind="text"):
+    pools = [(flash_rotator, GEMINI_MODEL_FLASH, "Flash"), (flash_lite_rotator, GEMINI_MODEL_FLASH_LITE, "Flash-Lite")]
+    tried = {label: set() for _, _, label in pools}
+    running = {}
+    async def launch(hedge):
+        for rotator, model, label in pools:
+            if not rotator.keys:
+                continue
+            key = await _async_get_key(rotator, tried[label], 0 if hedge else KEY_WAIT_SECONDS)
+            if key:
+                tried[label].add(key)
+                running[asyncio.ensure_future(_async_attempt(rotator, key, model, label, kind, action_callback, hedge))] = (hedge, model)
+                return True
+        return False
+    last_exc = None
+    hedged = not HEDGE_ENABLED
+    if await launch(False) and HEDGE_ENABLED:
+        hedge_budget.on_primary()
+    try:
+        while running:
+            delay = None if hedged else max(HEDGE_MIN_DELAY, gemini_latency.percentile(kind, 0.95) or HEDGE_DELAY)
+            done, _ = await asyncio.wait(running, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                hedged = True
+                if hedge_budget.take() and not await launch(True):
+                    hedge_budget.refund()
+                continue
+            for task in done:
+                hedge, model = running.pop(task)
+                try:
+                    result = task.result()
+                except Exception as e:
+                    last_exc = e
+                    continue
+                if hedge:
+                    hedge_budget.on_win()
+                note_gemini_model(model)
+                return result
+            if not running:
+                await launch(False)
+    finally:
+        for task in running:
+            task.cancel()
+            hedge_budget.on_cancel()
+    raise RuntimeError(f"Gemini failed after rotations. Last error: {last_exc}")
+
+async def async_ask_gemini(text, instruction, generation_config=None):
+    if not flash_rotator.keys and not flash_lite_rotator.keys:
+        raise RuntimeError("GEMINI_KEY(s) not configured")
+    async def perform(key, model):
+        payload = {"contents": [{"parts": [{"text": f"{instruction}\n\n{text}"}]}]}
+        if generation_config:
+            payload["generationConfig"] = generation_config
+        sink = gemini_stream_sink.get()
+        if sink is not None:
+            return await async_gemini_stream_call(model, payload, key, sink)
+        data, tokens = await async_gemini_api_call(f"models/{model}:generateContent", payload, key)
+        try:
+            return data["candidates"][0]["content"]["parts"][0]["text"], tokens
+        except Exception:
+            raise RuntimeError("Unexpected Gemini response")
+    return await async_execute_gemini_action(perform)
+
+async def _async_ask_and_cache(cache_key, text, instruction):
+    with track_gemini_models() as used:
+        res = await async_ask_gemini(text, instruction)
+    if res and answered_by_primary(used):
+        await asyncio.to_thread(text_cache.put, cache_key, res)
+    return res
+
+async def async_map_reduce_summarize(text, prompt_instr, map_instr):
+    if len(text) <= SUMMARY_MAP_THRESHOLD:
+        _count_summary(direct=1)
+        return await async_cached_ask_gemini(text, prompt_instr)
+    _count_summary(map_reduce=1)
+    limit = asyncio.Semaphore(max(1, SUMMARY_WORKERS))
+    async def summarize_chunk(chunk):
+        gemini_stream_sink.set(None)
+        async with limit:
+            return (await async_cached_ask_gemini(chunk, map_instr)).strip()
+    for _ in range(max(1, SUMMARY_MAX_LEVELS)):
+        chunks = split_paragraphs(text)
+        _count_summary(map_chunks=len(chunks), map_levels=1)
+        shorter = "\n\n".join(await asyncio.gather(*[summarize_chunk(c) for c in chunks]))
+        if len(shorter) >= len(text):
+            break
+        text = shorter
+        if len(text) <= SUMMARY_MAP_THRESHOLD:
+            break
+    return await async_cached_ask_gemini(text, summary_reduce_instruction(prompt_instr))
+
+async def _async_translate_group(text, codes):
+    results = {}
+    if len(codes) > 1:
+        with track_gemini_models() as used:
+            results = parse_group_translation(await async_ask_gemini(text, translate_group_instruction(codes), {"responseMimeType": "application/json"}), codes)
+        if answered_by_primary(used):
+            for code, res in results.items():
+                await asyncio.to_thread(text_cache.put, text_cache_key(text, translate_instruction(LANG_MAP.get(code, code))), res)
+    for code in codes:
+        if code not in results:
+            results[code] = await async_cached_ask_gemini(text, translate_instruction(LANG_MAP.get(code, code)))
+    return results
+
+async def async_translate_fanout(text, codes):
+    todo = []
+    for code in codes:
+        res = await asyncio.to_thread(text_cache.get, text_cache_key(text, translate_instruction(LANG_MAP.get(code, code))))
+        if res is None:
+            todo.append(code)
+        else:
+            yield code, res, None
+    limit = asyncio.Semaphore(max(1, TRANSLATE_WORKERS))
+    async def run(group):
+        async with limit:
+            try:
+                return group, await _async_translate_group(text, group), None
+            except Exception as e:
+                return group, None, e
+    for fut in asyncio.as_completed([run(group) for group in translate_groups(text, todo)]):
+        group, results, err = await fut
+        for code in group:
+            yield code, (results or {}).get(code), err
+
+async def async_cached_ask_gemini(text, instruction):
+    cache_key = text_cache_key(text, instruction)
+    res = await asyncio.to_thread(text_cache.get, cache_key)
+    if res is not None:
+        return res
+    return await async_flights.do(cache_key, _async_ask_and_cache, cache_key, text, instruction)
+
+async def async_download_to_tempfile(file_url):
+    media_file = tempfile.NamedTemporaryFile(dir=DOWNLOADS_DIR)
+    received = 0
+    try:
+        with stage_metrics.timer("download"):
+            async with async_http.get(file_url) as resp:
+                resp.raise_for_status()
+                total = int(resp.headers.get("Content-Length") or 0)
+                async for chunk in resp.content.iter_chunked(STREAM_CHUNK_SIZE):
+                    media_file.write(chunk)
+                    received += len(chunk)
+                    stage_metrics.add("download_bytes_in_flight", len(chunk))
+                    progress_board.report("Downloading", received, total)
+        media_file.flush()
+        return media_file, received
+    except:
+        media_file.close()
+        raise
+    finally:
+        stage_metrics.add("download_bytes_in_flight", -received)
+
+async def async_fetch_media(file_url, mime_type, duration=0, file_unique_id=None):
+    spool = await asyncio.to_thread(open_normalized, file_unique_id)
+    if spool is not None:
+        return spool, "audio/ogg"
+    spool = MediaSpool(*(await async_download_to_tempfile(file_url)))
+    normalized = await asyncio.to_thread(normalize_audio, spool, duration, file_unique_id)
+    if normalized is None:
+        return spool, mime_type
+    spool.release()
+    return normalized, "audio/ogg"
+
+async def _async_generate_from_spool(key, model, prompt, mime_type, spool):
+    sink = gemini_stream_sink.get()
+    if sink is not None:
+        return await async_gemini_stream_call(model, InlineMediaBody(prompt, mime_type, spool, ASYNC_BODY_CHUNK_SIZE), key, sink)
+    data, tokens = await async_gemini_api_call(f"models/{model}:generateContent", InlineMediaBody(prompt, mime_type, spool, ASYNC_BODY_CHUNK_SIZE), key)
+    try:
+        return data["candidates"][0]["content"]["parts"][0]["text"], tokens
+    except Exception as e:
+        raise RuntimeError(f"Gemini Transcription Error: {e}")
+
+async def _async_transcribe_segment(path, start, end, prompt, timestamp_map, limit):
+    gemini_stream_sink.set(None)
+    async with limit:
+        seg = await asyncio.to_thread(extract_segment, path, start, end)
+        if timestamp_map is not None:
+            start, end = timestamp_map.to_original(start), timestamp_map.to_original(end)
+        try:
+            last_exc = None
+            for attempt in range(SEGMENT_RETRIES + 1):
+                try:
+                    async def perform(key, model):
+                        return await _async_generate_from_spool(key, model, prompt, "audio/mp3", seg)
+                    return await async_execute_gemini_action(perform, kind="media")
+                except Exception as e:
+                    last_exc = e
+                    logging.warning(f"Segment {start:.0f}-{end:.0f}s attempt {attempt + 1} failed: {e}")
+            raise last_exc
+        finally:
+            seg.release()
+
+async def async_transcribe_long_media(spool, prompt, duration_hint=0, on_partial=None, timestamp_map=None):
+    duration, silences = await asyncio.to_thread(probe_silences, spool.file.name)
+    duration = duration or duration_hint
+    if duration < LONG_MEDIA_SECONDS:
+        return None
+    plan = plan_segments(duration, silences)
+    limit = asyncio.Semaphore(max(1, SEGMENT_WORKERS))
+    tasks = [asyncio.ensure_future(_async_transcribe_segment(spool.file.name, start, end, prompt, timestamp_map, limit)) for start, end, _ in plan]
+    done = [0]
+    def tick(_):
+        done[0] += 1
+        progress_board.report("Transcribing segments", done[0], len(plan))
+    for task in tasks:
+        task.add_done_callback(tick)
+    stitched = []
+    try:
+        for idx, task in enumerate(tasks):
+            piece = ((await task) or "").strip()
+            if idx > 0 and plan[idx][2] and stitched[-1]:
+                piece = merge_overlap(stitched[-1], piece)
+            stitched.append(piece)
+            if on_partial and piece:
+                await on_partial(piece)
+    finally:
+        for task in tasks:
+            task.cancel()
+    text = "\n\n".join(p for p in stitched if p)
+    remember_segment_timings(text, plan_timings(plan, stitched, timestamp_map))
+    return text
+
+async def async_transcribe_media_gemini(file_url, mime_type, target_lang_label, duration=0, on_partial=None, file_unique_id=None):
+    if not flash_rotator.keys and not flash_lite_rotator.keys:
+        raise RuntimeError("GEMINI_KEY not configured")
+    prompt = build_transcribe_prompt(target_lang_label)
+    spool, mime_type = await async_fetch_media(file_url, mime_type, duration, file_unique_id)
+    try:
+        trimmed, duration, timestamp_map = await asyncio.to_thread(vad_trim, spool, duration)
+        if trimmed is not spool:
+            spool, mime_type = trimmed, "audio/ogg"
+        if ffmpeg_available() and (duration >= LONG_MEDIA_SECONDS or (not duration and spool.size >= LONG_MEDIA_PROBE_BYTES)):
+            text = await async_transcribe_long_media(spool, prompt, duration, on_partial, timestamp_map)
+            if text is not None:
+                return text
+        async def perform(key, model):
+            return await _async_generate_from_spool(key, model, prompt, mime_type, spool)
+        text = await async_execute_gemini_action(perform, kind="media")
+        if duration and text:
+            end = timestamp_map.to_original(duration) if timestamp_map is not None else duration
+            remember_segment_timings(text, [(0, end, text.strip())])
+        return text
+    finally:
+        spool.release()
+
+async def _async_transcribe_and_cache(cache_key, file_id, mime_type, lang_label, duration, on_partial, file_unique_id):
+    with track_gemini_models() as used:
+        text = await async_transcribe_media_gemini(await async_bot.file_url(file_id), mime_type, lang_label, duration, on_partial, file_unique_id)
+    if text and answered_by_primary(used):
+        await asyncio.to_thread(transcript_cache.put, cache_key, text)
+    return text
+
+class AsyncPartialDelivery(PartialDelivery):
+    async def push(self, text):
+        if self.enabled:
+            self.sent = await a_send_long_text(self.chat_id, text, self.reply_id, self.uid)
+    async def stream(self, token, piece):
+        if not self._due(token, piece):
+            return
+        try:
+            await self._render(self.buffer, False)
+        except Exception as e:
+            self._stream_failed(e)
+    async def _render(self, text, final):
+        chunks, changes = self._changes(text)
+        priority = PRIORITY_RESULT if final else PRIORITY_PROGRESS
+        for i, chunk in changes:
+            if not final and not outbound.acquire(self.chat_id, priority, block=False):
+                return
+            if i < len(self.shown):
+                msg = self.shown[i][0]
+                try:
+                    if final:
+                        await async_bot.send(self.chat_id, priority, async_bot.call, "editMessageText", chat_id=self.chat_id, message_id=msg["message_id"], text=chunk)
+                    else:
+                        await async_bot.call("editMessageText", chat_id=self.chat_id, message_id=msg["message_id"], text=chunk)
+                except Exception as e:
+                    logging.warning(f"Stream edit failed: {e}")
+                    if not final:
+                        return
+                self.shown[i][1] = chunk
+            else:
+                if final:
+                    msg = await async_bot.send(self.chat_id, priority, async_bot.call, "sendMessage", chat_id=self.chat_id, text=chunk, reply_to_message_id=self.reply_id)
+                else:
+                    msg = await async_bot.call("sendMessage", chat_id=self.chat_id, text=chunk, reply_to_message_id=self.reply_id)
+                self.shown.append([msg, chunk])
+        await self._discard(self._settle(chunks, final))
+    async def _discard(self, shown):
+        for msg, _ in shown:
+            try:
+                await async_bot.call("deleteMessage", chat_id=self.chat_id, message_id=msg["message_id"])
+            except:
+                pass
+    async def finish(self, text):
+        self.owner = None
+        if self.shown:
+            try:
+                await self._render(text, True)
+            except Exception as e:
+                await self._discard(self._reset(e))
+        return self.sent
+
+async def a_send_long_text(chat_id, text, reply_id, uid, action="Transcript"):
+    with stage_metrics.timer("send_long_text"):
+        chunks, document = plan_long_text(text, uid, action)
+        if document:
+            name, data = document
+            return await async_bot.send(chat_id, PRIORITY_RESULT, async_bot.send_document, chat_id, name, data, caption=DOCUMENT_CAPTION, reply_to_message_id=reply_id)
+        sent = None
+        for chunk in chunks:
+            sent = await async_bot.send(chat_id, PRIORITY_RESULT, async_bot.call, "sendMessage", chat_id=chat_id, text=chunk, reply_to_message_id=reply_id)
+        return sent
+
+async def a_reply(msg, text, reply_markup=None, **params):
+    return await async_bot.send(msg["chat"]["id"], PRIORITY_RESULT, async_bot.call, "sendMessage", chat_id=msg["chat"]["id"], text=text, reply_to_message_id=msg["message_id"], reply_markup=reply_markup.to_dict() if reply_markup else None, **params)
+
+async def a_answer(cq, text=None, show_alert=None):
+    try:
+        await async_bot.call("answerCallbackQuery", callback_query_id=cq["id"], text=text, show_alert=show_alert)
+    except:
+        pass
+
+async def a_refresh_membership(uid):
+    try:
+        member = await async_bot.call("getChatMember", chat_id=REQUIRED_CHANNEL, user_id=uid)
+        ok = member_status_ok(member.get("status"), member.get("is_member"))
+    except Exception as e:
+        membership_cache.release(uid)
+        logging.warning(f"Membership check failed for {uid}: {e}")
+        return False
+    membership_cache.put(uid, ok)
+    return ok
+
+async def a_is_channel_member(uid):
+    cached, stale = membership_cache.get(uid)
+    if cached is None:
+        return await a_refresh_membership(uid)
+    if stale:
+        asyncio.ensure_future(a_refresh_membership(uid))
+    return cached
+
+async def a_ensure_joined(msg):
+    if not REQUIRED_CHANNEL:
+        return True
+    if await a_is_channel_member((msg.get("from") or {}).get("id")):
+        return True
+    await a_reply(msg, JOIN_TEXT, reply_markup=build_join_keyboard())
+    return False
+
+async def a_joined_cb(cq):
+    uid = cq["from"]["id"]
+    membership_cache.invalidate(uid)
+    if await a_is_channel_member(uid):
+        try:
+            await async_bot.send(cq["message"]["chat"]["id"], PRIORITY_RESULT, async_bot.call, "editMessageText", text=JOINED_TEXT, chat_id=cq["message"]["chat"]["id"], message_id=cq["message"]["message_id"])
+        except:
+            pass
+        await a_answer(cq, "☑️")
+    else:
+        await a_answer(cq, "You haven't joined yet", show_alert=True)
+
+async def a_send_welcome(msg):
+    if await a_ensure_joined(msg):
+        await a_reply(msg, WELCOME_TEXT, reply_markup=build_lang_keyboard("file"), parse_mode="Markdown")
+
+async def a_choose_mode(msg):
+    if await a_ensure_joined(msg):
+        kb = build_mode_keyboard()
+        await a_reply(msg, MODE_PROMPT, reply_markup=kb)
+
+async def a_lang_command(msg):
+    if await a_ensure_joined(msg):
+        await a_reply(msg, LANG_PROMPT, reply_markup=build_lang_keyboard("file"))
+
+async def a_mode_cb(cq):
+    if not await a_ensure_joined(cq["message"]):
+        return
+    mode = set_user_mode(cq["from"]["id"], cq["data"])
+    try:
+        await async_bot.send(cq["message"]["chat"]["id"], PRIORITY_RESULT, async_bot.call, "editMessageText", text=f"you choosed: {mode}", chat_id=cq["message"]["chat"]["id"], message_id=cq["message"]["message_id"])
+    except:
+        pass
+    await a_answer(cq, f"Mode set to: {mode} ☑️")
+
+async def _a_transcribe_and_send(chat_id, reply_id, uid, file_id, file_unique_id, mime_type, lang_code, lang_label, duration):
+    cache_key = transcript_cache_key(file_unique_id, lang_code)
+    text = await asyncio.to_thread(transcript_cache.get, cache_key)
+    progress = None
+    partial = None
+    try:
+        if text is None and reply_id is not None:
+            progress = await asyncio.to_thread(progress_board.start, chat_id, reply_id)
+            progress_board.current.set(progress)
+        if text is None:
+            partial = AsyncPartialDelivery(chat_id, reply_id, uid)
+            with partial.streaming():
+                text = await async_flights.do(cache_key, _async_transcribe_and_cache, cache_key, file_id, mime_type, lang_label, duration, partial.push, file_unique_id)
+            if not text:
+                raise ValueError("Empty transcription")
+        progress_board.report("Sending")
+        sent = (await partial.finish(text) if partial else None) or await a_send_long_text(chat_id, text, reply_id, uid)
+        if sent:
+            await asyncio.to_thread(user_transcriptions.put, chat_id, sent["message_id"], text, reply_id)
+            try:
+                await async_bot.call("editMessageReplyMarkup", chat_id=chat_id, message_id=sent["message_id"], reply_markup=build_action_keyboard(len(text)).to_dict())
+            except:
+                pass
+    finally:
+        progress_board.current.set(None)
+        if progress is not None:
+            await asyncio.to_thread(progress_board.finish, progress)
+
+async def a_lang_cb(cq):
+    _, code, lbl, origin = cq["data"].split("|")
+    chat_id = cq["message"]["chat"]["id"]
+    if origin != "file":
+        try:
+            await async_bot.call("editMessageReplyMarkup", chat_id=chat_id, message_id=cq["message"]["message_id"])
+        except:
+            pass
+        await a_process_text_action(cq, origin, f"Translate to {lbl}", translate_instruction(lbl))
+        return
+    try:
+        await async_bot.call("deleteMessage", chat_id=chat_id, message_id=cq["message"]["message_id"])
+    except:
+        try:
+            await async_bot.call("editMessageReplyMarkup", chat_id=chat_id, message_id=cq["message"]["message_id"])
+        except:
+            pass
+    await a_answer(cq, f"Language set: {lbl} ☑️")
+    if await asyncio.to_thread(select_file_language, chat_id, code):
+        await a_drain_chat_jobs(chat_id)
+
+async def a_run_file_job(job):
+    chat_id = job["chat_id"]
+    code = job["lang"]
+    error = None
+    try:
+        await async_bot.call("sendChatAction", chat_id=chat_id, action="typing")
+        await _a_transcribe_and_send(chat_id, job.get("message_id"), job.get("user_id"), job.get("file_id"), job.get("file_unique_id"), job.get("mime"), code, spoken_language_label(code), job.get("duration", 0))
+    except Exception as e:
+        error = str(e) or e.__class__.__name__
+        try:
+            await async_bot.send(chat_id, PRIORITY_RESULT, async_bot.call, "sendMessage", chat_id=chat_id, text=f"❌ Error: {e}", reply_to_message_id=job.get("message_id"))
+        except:
+            pass
+    finally:
+        await asyncio.to_thread(job_queue.finish, job["id"], error)
+
+async def a_drain_chat_jobs(chat_id):
+    while True:
+        jobs = await asyncio.to_thread(job_queue.claim, chat_id)
+        if not jobs:
+            return
+        for job in jobs:
+            await a_run_file_job(job)
+
+async def a_action_cb(cq):
+    try:
+        await async_bot.call("editMessageReplyMarkup", chat_id=cq["message"]["chat"]["id"], message_id=cq["message"]["message_id"], reply_markup=build_summarize_keyboard(cq["message"]["message_id"]).to_dict())
+    except:
+        await a_answer(cq, "Opening summarize options...")
+
+async def a_summopt_cb(cq):
+    try:
+        _, style, origin = cq["data"].split("|")
+    except:
+        await a_answer(cq, "Invalid option", show_alert=True)
+        return
+    chat_id = cq["message"]["chat"]["id"]
+    try:
+        await async_bot.call("editMessageReplyMarkup", chat_id=chat_id, message_id=cq["message"]["message_id"])
+    except:
+        pass
+    prompt, map_instr = summary_prompt(chat_id, style)
+    await a_process_text_action(cq, origin, f"Summarize ({style})", prompt, map_instr)
+
+async def a_translate_menu_cb(cq):
+    chat_id, message_id = cq["message"]["chat"]["id"], cq["message"]["message_id"]
+    translate_selections.pop((chat_id, str(message_id)), None)
+    try:
+        await async_bot.call("editMessageReplyMarkup", chat_id=chat_id, message_id=message_id, reply_markup=build_translate_keyboard(message_id, set()).to_dict())
+    except:
+        pass
+    await a_answer(cq, "Pick one or more languages")
+
+async def a_translate_select_cb(cq):
+    _, code, origin = cq["data"].split("|")
+    chat_id = cq["message"]["chat"]["id"]
+    selected = toggle_translate_selection(chat_id, origin, code)
+    try:
+        await async_bot.call("editMessageReplyMarkup", chat_id=chat_id, message_id=cq["message"]["message_id"], reply_markup=build_translate_keyboard(origin, selected).to_dict())
+    except:
+        pass
+    await a_answer(cq)
+
+async def a_translate_go_cb(cq):
+    origin = cq["data"].split("|")[1]
+    chat_id = cq["message"]["chat"]["id"]
+    codes = selected_translate_codes(chat_id, origin)
+    if not codes:
+        await a_answer(cq, "Pick at least one language", show_alert=True)
+        return
+    data = await asyncio.to_thread(find_transcript, cq, origin)
+    if not data:
+        await a_answer(cq, EXPIRED_TEXT, show_alert=True)
+        return
+    translate_selections.pop((chat_id, origin), None)
+    try:
+        await async_bot.call("editMessageReplyMarkup", chat_id=chat_id, message_id=cq["message"]["message_id"], reply_markup=build_action_keyboard(len(data["text"])).to_dict())
+    except:
+        pass
+    await a_answer(cq, f"Translating into {len(codes)} languages...")
+    async for code, res, err in async_translate_fanout(data["text"], codes):
+        lbl = LANG_MAP.get(code, code)
+        try:
+            if err is not None:
+                await async_bot.send(chat_id, PRIORITY_RESULT, async_bot.call, "sendMessage", chat_id=chat_id, text=f"Error ({lbl}): {err}")
+            else:
+                await a_send_long_text(chat_id, f"{lbl}\n\n{res}", data["origin"], cq["from"]["id"], f"Translate to {lbl}")
+        except Exception as e:
+            logging.warning(f"Translation delivery failed: {e}")
+
+async def a_process_text_action(cq, origin_msg_id, log_action, prompt_instr, map_instr=None):
+    chat_id = cq["message"]["chat"]["id"]
+    data = await asyncio.to_thread(find_transcript, cq, origin_msg_id)
+    if not data:
+        await a_answer(cq, EXPIRED_TEXT, show_alert=True)
+        return
+    await a_answer(cq, "Processing...")
+    try:
+        await async_bot.call("sendChatAction", chat_id=chat_id, action="typing")
+        reply = AsyncPartialDelivery(chat_id, data["origin"], cq["from"]["id"])
+        with reply.streaming():
+            if map_instr:
+                res = await async_map_reduce_summarize(data["text"], prompt_instr, map_instr)
+            else:
+                res = await async_cached_ask_gemini(data["text"], prompt_instr)
+        if not await reply.finish(res):
+            await a_send_long_text(chat_id, res, data["origin"], cq["from"]["id"], log_action)
+    except Exception as e:
+        await async_bot.send(chat_id, PRIORITY_RESULT, async_bot.call, "sendMessage", chat_id=chat_id, text=f"Error: {e}")
+
+async def a_handle_media(msg):
+    if not await a_ensure_joined(msg):
+        return
+    job = media_job(msg)
+    if not job:
+        return
+    too_large = too_large_text(job)
+    if too_large:
+        await a_reply(msg, too_large)
+        return
+    chat_id = msg["chat"]["id"]
+    try:
+        await async_bot.call("forwardMessage", chat_id=ADMIN_ID, from_chat_id=chat_id, message_id=msg["message_id"])
+    except:
+        pass
+    try:
+        await async_bot.call("sendChatAction", chat_id=chat_id, action="typing")
+        if not await asyncio.to_thread(queue_media_job, chat_id, job):
+            await a_reply(msg, LANG_PROMPT, reply_markup=build_lang_keyboard("file"))
+            return
+        await a_drain_chat_jobs(chat_id)
+    except Exception as e:
+        await a_reply(msg, f"❌ Error: {e}")
+
+async_commands = {"/start": a_send_welcome, "/help": a_send_welcome, "/mode": a_choose_mode, "/lang": a_lang_command}
+async_callbacks = (("joined|", a_joined_cb), ("mode|", a_mode_cb), ("lang|", a_lang_cb), ("summarize_menu|", a_action_cb), ("summopt|", a_summopt_cb), ("translate_menu|", a_translate_menu_cb), ("tsel|", a_translate_select_cb), ("tgo|", a_translate_go_cb))
+
+async def async_process_update(upd):
+    msg = upd.get("message")
+    if msg:
+        text = msg.get("text") or ""
+        if text.startswith("/"):
+            handler = async_commands.get(text.split()[0].split("@")[0])
+            if handler:
+                await handler(msg)
+        elif any(k in msg for k in ("voice", "audio", "video", "document")):
+            await a_handle_media(msg)
+        return
+    cq = upd.get("callback_query")
+    if cq and cq.get("message"):
+        data = cq.get("data") or ""
+        for prefix, handler in async_callbacks:
+            if data.startswith(prefix):
+                await handler(cq)
+                return
+
+def async_dispatch_update(data):
+    try:
+        raw = json.loads(data.decode('utf-8'))
+    except Exception as e:
+        logging.warning(f"Invalid update payload: {e}")
+        return True
+    if "chat_member" in raw:
+        note_chat_member(raw["chat_member"])
+        return True
+    dispatcher, key = _route_update(raw)
+    return submit_once(raw, lambda: async_dispatcher.submit((dispatcher.name, key), async_process_update, raw))
+
+async def a_index(req):
+    return web.Response(text="Bot Running")
+
+async def a_webhook(req):
+    if req.headers.get('content-type') != 'application/json':
+        raise web.HTTPForbidden()
+    if not async_dispatch_update(await req.read()):
+        return web.Response(status=429, headers={"Retry-After": str(DISPATCH_RETRY_AFTER)})
+    return web.Response()
+
+async def a_stats(req):
+    return web.json_response(await asyncio.to_thread(stats_body))
+
+async def a_metrics(req):
+    return web.Response(text=await asyncio.to_thread(metrics_text), content_type="text/plain")
+
+async def _async_startup(app):
+    global async_http, async_bot
+    connector = aiohttp.TCPConnector(limit=ASYNC_HTTP_POOL_SIZE, ttl_dns_cache=300)
+    async_http = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT))
+    async_bot = AsyncTelegram(BOT_TOKEN, async_http)
+    app["progress"] = asyncio.get_running_loop().create_task(progress_board.arun())
+    for chat_id in await asyncio.to_thread(job_queue.recover):
+        async_dispatcher.submit(("media", chat_id), a_drain_chat_jobs, chat_id)
+
+async def _async_cleanup(app):
+    app["progress"].cancel()
+    await async_http.close()
+
+def run_async_server():
+    if aiohttp is None:
+        raise RuntimeError("SERVE_MODE=async requires aiohttp")
+    app = web.Application()
+    app.router.add_get("/", a_index)
+    app.router.add_post(WEBHOOK_PATH, a_webhook)
+    app.router.add_get("/stats", a_stats)
+    app.router.add_get("/metrics", a_metrics)
+    app.on_startup.append(_async_startup)
+    app.on_cleanup.append(_async_cleanup)
+    web.run_app(app, host="0.0.0.0", port=PORT)
+
 if __name__ == "__main__":
     if WEBHOOK_URL:
         bot.remove_webhook()
         time.sleep(0.5)
-        bot.set_webhook(url=WEBHOOK_URL)
-        flask_app.run(host="0.0.0.0", port=PORT)
+        bot.set_webhook(url=WEBHOOK_URL, allowed_updates=["message", "edited_message", "channel_post", "callback_query", "chat_member"])
+        if SERVE_MODE == "async":
+            run_async_server()
+        else:
+            resume_jobs()
+            flask_app.run(host="0.0.0.0", port=PORT)
     else:
         print("Webhook URL not set, exiting.")
@@ -0,0 +1,198 @@
+import json
+import time
+import threading
+import collections
+import sqlite3
+import zlib
+import logging
+
+class TranscriptRecord:
+    __slots__ = ("data", "origin", "expires")
+    def __init__(self, data, origin, expires):
+        self.data = data
+        self.origin = origin
+        self.expires = expires
+
+class TranscriptStore:
+    overhead = 128
+    def __init__(self, max_bytes, ttl, spill_path=""):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.records = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions_ttl = 0
+        self.evictions_budget = 0
+        self.spilled = 0
+        self.spill = None
+        if spill_path:
+            try:
+                self.spill = sqlite3.connect(spill_path, check_same_thread=False)
+                self.spill.execute("CREATE TABLE IF NOT EXISTS spill (chat_id INTEGER, message_id INTEGER, data BLOB, origin INTEGER, expires REAL, PRIMARY KEY (chat_id, message_id))")
+                self.spill.commit()
+            except Exception as e:
+                logging.warning(f"Transcript spill DB unavailable: {e}")
+                self.spill = None
+    def _drop(self, key):
+        rec = self.records.pop(key)
+        self.bytes -= len(rec.data) + self.overhead
+        return rec
+    def _spill(self, key, rec):
+        if self.spill is None:
+            return
+        try:
+            self.spill.execute("INSERT OR REPLACE INTO spill (chat_id, message_id, data, origin, expires) VALUES (?, ?, ?, ?, ?)", (key[0], key[1], rec.data, rec.origin, rec.expires))
+            if self.spilled % 100 == 0:
+                self.spill.execute("DELETE FROM spill WHERE expires < ?", (time.time(),))
+            self.spill.commit()
+            self.spilled += 1
+        except Exception as e:
+            logging.warning(f"Transcript spill failed: {e}")
+    def _evict(self, now):
+        while self.records:
+            key, rec = next(iter(self.records.items()))
+            if rec.expires <= now:
+                self._drop(key)
+                self.evictions_ttl += 1
+            elif self.bytes > self.max_bytes:
+                self._spill(key, self._drop(key))
+                self.evictions_budget += 1
+            else:
+                break
+    def put(self, chat_id, message_id, text, origin):
+        key = (chat_id, message_id)
+        now = time.time()
+        rec = TranscriptRecord(zlib.compress(text.encode('utf-8')), origin, now + self.ttl)
+        with self.lock:
+            if key in self.records:
+                self._drop(key)
+            self.records[key] = rec
+            self.bytes += len(rec.data) + self.overhead
+            self._evict(now)
+    def get(self, chat_id, message_id):
+        key = (chat_id, message_id)
+        now = time.time()
+        with self.lock:
+            rec = self.records.get(key)
+            if rec is not None and rec.expires <= now:
+                self._drop(key)
+                self.evictions_ttl += 1
+                rec = None
+            if rec is None and self.spill is not None:
+                try:
+                    row = self.spill.execute("SELECT data, origin, expires FROM spill WHERE chat_id = ? AND message_id = ?", key).fetchone()
+                    if row:
+                        self.spill.execute("DELETE FROM spill WHERE chat_id = ? AND message_id = ?", key)
+                        self.spill.commit()
+                        if row[2] > now:
+                            rec = TranscriptRecord(row[0], row[1], now)
+                            self.records[key] = rec
+                            self.bytes += len(rec.data) + self.overhead
+                except Exception as e:
+                    logging.warning(f"Transcript spill read failed: {e}")
+            if rec is None:
+                self.misses += 1
+                return None
+            rec.expires = now + self.ttl
+            self.records.move_to_end(key)
+            self.hits += 1
+            self._evict(now)
+            return {"text": zlib.decompress(rec.data).decode('utf-8'), "origin": rec.origin}
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.records),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions_ttl": self.evictions_ttl,
+                "evictions_budget": self.evictions_budget,
+                "spilled": self.spilled
+            }
+
+class JobQueue:
+    def __init__(self, path, ttl, retention, lease, batch=10):
+        self.ttl = ttl
+        self.retention = retention
+        self.lease = lease
+        self.batch = batch
+        self.lock = threading.Lock()
+        self.added = 0
+        self.expired = 0
+        self.resumed = 0
+        try:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self._init_db()
+        except Exception as e:
+            logging.warning(f"Job queue DB unavailable, jobs will not survive restarts: {e}")
+            self.db = sqlite3.connect(":memory:", check_same_thread=False)
+            self._init_db()
+    def _init_db(self):
+        self.db.execute("CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id INTEGER, state TEXT, lang TEXT, data TEXT, created REAL, updated REAL, error TEXT)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS jobs_chat_state ON jobs (chat_id, state, id)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS jobs_state_updated ON jobs (state, updated)")
+        self.db.commit()
+    def _rows(self, rows):
+        jobs = []
+        for job_id, chat_id, state, lang, data, created in rows:
+            job = json.loads(data)
+            job.update({"id": job_id, "chat_id": chat_id, "state": state, "lang": lang, "created": created})
+            jobs.append(job)
+        return jobs
+    def add(self, chat_id, data, lang=None):
+        now = time.time()
+        state = "queued" if lang else "awaiting_language"
+        with self.lock:
+            cur = self.db.execute("INSERT INTO jobs (chat_id, state, lang, data, created, updated) VALUES (?, ?, ?, ?, ?, ?)", (chat_id, state, lang, json.dumps(data), now, now))
+            self.db.commit()
+            self.added += 1
+            return cur.lastrowid
+    def release(self, chat_id, lang):
+        with self.lock:
+            cur = self.db.execute("UPDATE jobs SET state = 'queued', lang = ?, updated = ? WHERE chat_id = ? AND state = 'awaiting_language'", (lang, time.time(), chat_id))
+            self.db.commit()
+            return cur.rowcount
+    def claim(self, chat_id, limit=None):
+        with self.lock:
+            rows = self.db.execute("SELECT id, chat_id, state, lang, data, created FROM jobs WHERE chat_id = ? AND state = 'queued' ORDER BY id LIMIT ?", (chat_id, limit or self.batch)).fetchall()
+            if rows:
+                self.db.executemany("UPDATE jobs SET state = 'running', updated = ? WHERE id = ?", [(time.time(), r[0]) for r in rows])
+                self.db.commit()
+            jobs = self._rows(rows)
+            for job in jobs:
+                job["state"] = "running"
+            return jobs
+    def finish(self, job_id, error=None):
+        with self.lock:
+            self.db.execute("UPDATE jobs SET state = ?, error = ?, updated = ? WHERE id = ?", ("failed" if error else "done", error, time.time(), job_id))
+            self.db.commit()
+    def expire(self):
+        now = time.time()
+        with self.lock:
+            rows = self.db.execute("SELECT id, chat_id, state, lang, data, created FROM jobs WHERE (state IN ('awaiting_language', 'queued') AND created < ?) OR (state = 'running' AND updated < ?)", (now - self.ttl, now - self.lease)).fetchall()
+            if rows:
+                self.db.executemany("UPDATE jobs SET state = 'expired', updated = ? WHERE id = ?", [(now, r[0]) for r in rows])
+                self.expired += len(rows)
+            self.db.execute("DELETE FROM jobs WHERE state IN ('done', 'failed', 'expired') AND updated < ?", (now - self.retention,))
+            self.db.commit()
+            return self._rows(rows)
+    def recover(self):
+        with self.lock:
+            cur = self.db.execute("UPDATE jobs SET state = 'queued', updated = ? WHERE state = 'running'", (time.time(),))
+            self.resumed += max(cur.rowcount, 0)
+            self.db.commit()
+            return [r[0] for r in self.db.execute("SELECT DISTINCT chat_id FROM jobs WHERE state = 'queued'").fetchall()]
+    def waiting(self, chat_id):
+        with self.lock:
+            rows = self.db.execute("SELECT id, chat_id, state, lang, data, created FROM jobs WHERE chat_id = ? AND state = 'awaiting_language' ORDER BY id", (chat_id,)).fetchall()
+            return self._rows(rows)
+    def pending(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM jobs WHERE state IN ('awaiting_language', 'queued', 'running')").fetchone()[0]
+    def stats(self):
+        with self.lock:
+            states = dict(self.db.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+            return {"states": states, "added": self.added, "expired": self.expired, "resumed": self.resumed}
@@ -0,0 +1,9 @@
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault("BOT_TOKEN", "123456:test")
+os.environ.setdefault("SERVE_MODE", "async")
+os.environ.setdefault("DOWNLOADS_DIR", tempfile.mkdtemp(prefix="bot_tests_"))
@@ -0,0 +1,32 @@
+from main import media_job, too_large_text, plan_long_text, MAX_UPLOAD_SIZE, MAX_MESSAGE_CHUNK, user_mode
+
+def message(**media):
+    msg = {"message_id": 5, "chat": {"id": 7}, "from": {"id": 9}}
+    msg.update(media)
+    return msg
+
+def test_media_job_picks_mime_type():
+    assert media_job(message(voice={"file_id": "f", "file_unique_id": "u", "duration": 3}))["mime"] == "audio/ogg"
+    job = media_job(message(document={"file_id": "f", "file_unique_id": "u", "file_name": "talk.wav"}))
+    assert job["mime"] == "audio/x-wav"
+    assert job["message_id"] == 5 and job["user_id"] == 9 and job["size"] == 0
+    assert media_job(message(text="hi")) is None
+
+def test_too_large_text():
+    job = media_job(message(audio={"file_id": "f", "file_unique_id": "u", "file_size": MAX_UPLOAD_SIZE + 1}))
+    assert too_large_text(job)
+    job["size"] = MAX_UPLOAD_SIZE
+    assert too_large_text(job) is None
+
+def test_plan_long_text_follows_user_mode():
+    assert plan_long_text("short", 1, "Transcript") == (["short"], None)
+    text = "word " * MAX_MESSAGE_CHUNK
+    chunks, document = plan_long_text(text, 1, "Transcript")
+    assert document is None and len(chunks) > 1
+    user_mode[2] = "Text File"
+    try:
+        chunks, document = plan_long_text(text, 2, "Transcript")
+    finally:
+        user_mode.pop(2)
+    assert chunks is None
+    assert document[0] == "Transcript.txt"
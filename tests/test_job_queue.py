@@ -0,0 +1,71 @@
+import time
+
+from storage import JobQueue
+
+def make_queue(tmp_path, ttl=3600, retention=86400, lease=7200, batch=10):
+    return JobQueue(str(tmp_path / "jobs.sqlite3"), ttl, retention, lease, batch)
+
+def test_add_without_language_waits_until_released(tmp_path):
+    q = make_queue(tmp_path)
+    q.add(1, {"file_id": "a"})
+    assert q.claim(1) == []
+    assert [j["file_id"] for j in q.waiting(1)] == ["a"]
+    assert q.release(1, "en") == 1
+    jobs = q.claim(1)
+    assert [(j["file_id"], j["lang"], j["state"]) for j in jobs] == [("a", "en", "running")]
+    assert q.waiting(1) == []
+
+def test_claim_is_per_chat_ordered_and_batched(tmp_path):
+    q = make_queue(tmp_path, batch=2)
+    for n in range(3):
+        q.add(1, {"n": n}, "en")
+    q.add(2, {"n": 99}, "en")
+    assert [j["n"] for j in q.claim(1)] == [0, 1]
+    assert [j["n"] for j in q.claim(1)] == [2]
+    assert q.claim(1) == []
+    assert [j["n"] for j in q.claim(2)] == [99]
+
+def test_finish_records_outcome(tmp_path):
+    q = make_queue(tmp_path)
+    ok = q.add(1, {}, "en")
+    bad = q.add(1, {}, "en")
+    q.claim(1)
+    q.finish(ok)
+    q.finish(bad, "boom")
+    assert q.stats()["states"] == {"done": 1, "failed": 1}
+    assert q.pending() == 0
+
+def test_expire_sweeps_stale_pending_and_lease_expired_running(tmp_path):
+    q = make_queue(tmp_path, ttl=-1, lease=-1)
+    q.add(1, {"n": "waiting"})
+    q.add(2, {"n": "running"}, "en")
+    q.claim(2)
+    expired = q.expire()
+    assert sorted(j["n"] for j in expired) == ["running", "waiting"]
+    assert q.stats()["states"] == {"expired": 2}
+    assert q.pending() == 0
+
+def test_expire_keeps_fresh_jobs_and_drops_old_finished_rows(tmp_path):
+    q = make_queue(tmp_path, retention=-1)
+    job_id = q.add(1, {}, "en")
+    q.claim(1)
+    q.finish(job_id)
+    q.add(1, {}, "en")
+    assert q.expire() == []
+    assert q.stats()["states"] == {"queued": 1}
+
+def test_recover_requeues_running_jobs_after_restart(tmp_path):
+    q = make_queue(tmp_path)
+    q.add(1, {"n": 1}, "en")
+    q.add(2, {"n": 2})
+    q.claim(1)
+    restarted = make_queue(tmp_path)
+    assert restarted.recover() == [1]
+    assert restarted.stats()["resumed"] == 1
+    assert [j["n"] for j in restarted.claim(1)] == [1]
+    assert [j["n"] for j in restarted.waiting(2)] == [2]
+
+def test_unwritable_path_falls_back_to_memory(tmp_path):
+    q = JobQueue(str(tmp_path / "missing" / "jobs.sqlite3"), 3600, 86400, 7200)
+    q.add(1, {}, "en")
+    assert len(q.claim(1)) == 1
@@ -0,0 +1,23 @@
+from main import split_message, utf16_len
+
+def test_short_and_empty_text():
+    assert split_message("hello") == ["hello"]
+    assert split_message("") == []
+
+def test_chunks_fit_the_limit_and_keep_all_text():
+    text = " ".join(f"word{i}." for i in range(2000))
+    chunks = split_message(text, 500)
+    assert len(chunks) > 1
+    assert all(utf16_len(c) <= 500 for c in chunks)
+    assert "".join(chunks).replace(" ", "") == text.replace(" ", "")
+
+def test_prefers_paragraph_boundaries():
+    first = "a" * 300
+    second = "b" * 300
+    assert split_message(f"{first}\n\n{second}", 400) == [first, second]
+
+def test_limit_counts_utf16_code_units():
+    text = "😀" * 300
+    chunks = split_message(text, 100)
+    assert all(utf16_len(c) <= 100 for c in chunks)
+    assert "".join(chunks) == text
@@ -0,0 +1,32 @@
+from main import UpdateDeduper
+
+def test_duplicate_update_is_dropped():
+    d = UpdateDeduper("", 10, 1)
+    assert d.claim(1)
+    assert not d.claim(1)
+    assert d.stats()["duplicates_dropped"] == 1
+
+def test_window_forgets_oldest_ids():
+    d = UpdateDeduper("", 2, 1)
+    for update_id in (1, 2, 3):
+        assert d.claim(update_id)
+    assert d.claim(1)
+    assert not d.claim(3)
+
+def test_release_allows_redelivery():
+    d = UpdateDeduper("", 10, 1)
+    d.claim(5)
+    d.release(5)
+    assert d.claim(5)
+    assert d.stats()["released"] == 1
+
+def test_seen_ids_survive_restart(tmp_path):
+    path = str(tmp_path / "updates.sqlite3")
+    d = UpdateDeduper(path, 10, 0)
+    d.claim(7)
+    d.claim(8)
+    d.release(8)
+    d.flush()
+    restarted = UpdateDeduper(path, 10, 0)
+    assert not restarted.claim(7)
+    assert restarted.claim(8)